@@ -0,0 +1,84 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple, cast
+from uuid import UUID
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+
+from accounts.models import User
+from api import settings
+
+
+class UserCache:
+    """
+    A bounded, thread-safe LRU cache of user rows keyed by their `id`, with entries expiring after a fixed time.
+
+    Entries are removed when the user is saved or deleted (see `accounts/signals.py`), however this only affects the
+    process that made the change, so the TTL bounds how stale other processes can be. If a shared Django cache alias is
+    configured, users are also stored there so that a miss in one process can be served without the database.
+    """
+
+    def __init__(self, max_size: int, ttl: float, shared_cache: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.shared_cache = shared_cache
+        self._lock = threading.Lock()
+        self._users: OrderedDict[str, Tuple[float, User]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: str | UUID) -> Optional[User]:
+        """Fetch a user, only querying the database if they are not cached. Returns `None` if the user does not exist"""
+        key = str(user_id)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._users.get(key)
+            if cached and cached[0] > now:
+                self._users.move_to_end(key)
+                self.hits += 1
+                # return a copy so that a request modifying its user cannot affect other requests
+                return copy.copy(cached[1])
+            self.misses += 1
+        user = None
+        if self.shared_cache:
+            user = caches[self.shared_cache].get(self._shared_key(key))
+        if user is None:
+            user = get_user_model().objects.filter(id=key).first()
+            if user is None:
+                return None
+            if self.shared_cache:
+                caches[self.shared_cache].set(self._shared_key(key), user, timeout=self.ttl)
+        with self._lock:
+            self._users[key] = (now + self.ttl, user)
+            self._users.move_to_end(key)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+        return copy.copy(user)
+
+    def invalidate(self, user_id: str | UUID) -> None:
+        key = str(user_id)
+        with self._lock:
+            self._users.pop(key, None)
+        if self.shared_cache:
+            caches[self.shared_cache].delete(self._shared_key(key))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._users.clear()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._users)}
+
+    @staticmethod
+    def _shared_key(key: str) -> str:
+        return f"accounts:user:{key}"
+
+
+user_cache = UserCache(
+    max_size=cast(int, settings.USER_CACHE["MAX_SIZE"]),
+    ttl=cast(float, settings.USER_CACHE["TTL"]),
+    shared_cache=cast(Optional[str], settings.USER_CACHE["SHARED_CACHE"]),
+)
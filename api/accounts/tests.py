@@ -1,3 +1,107 @@
-from django.test import TestCase
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.test import APITestCase
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from api.authentication import get_user_from_token
+from api.testing import create_user
+
+from .models import User
+from .services import user_cache
+from .services.user_cache import UserCache
+
+
+class UserCacheTests(TestCase):
+    """Users should only be fetched from the database on the first lookup within the cache's TTL"""
+
+    def setUp(self):
+        self.users = [create_user(i) for i in range(3)]
+        self.cache = UserCache(max_size=2, ttl=60)
+
+    def test_cached(self):
+        with self.assertNumQueries(1):
+            first = self.cache.get(self.users[0].id)
+            second = self.cache.get(str(self.users[0].id))
+        self.assertEqual((first, second), (self.users[0], self.users[0]))
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 1, "size": 1})
+
+    def test_copies_returned(self):
+        self.cache.get(self.users[0].id).first_name = "Changed"
+        self.assertEqual(self.cache.get(self.users[0].id).first_name, "Test")
+
+    def test_missing_user(self):
+        self.assertIsNone(self.cache.get(User().id))
+
+    def test_expires(self):
+        now = 1000.0
+        with mock.patch.object(user_cache.time, "monotonic", side_effect=lambda: now):
+            self.cache.get(self.users[0].id)
+            now += 61
+            with self.assertNumQueries(1):
+                self.cache.get(self.users[0].id)
+
+    def test_least_recently_used_evicted(self):
+        self.cache.get(self.users[0].id)
+        self.cache.get(self.users[1].id)
+        self.cache.get(self.users[0].id)
+        self.cache.get(self.users[2].id)
+        with self.assertNumQueries(0):
+            self.cache.get(self.users[0].id)
+        with self.assertNumQueries(1):
+            self.cache.get(self.users[1].id)
+
+    def test_invalidated_on_save(self):
+        user_cache.user_cache.get(self.users[0].id)
+        self.users[0].first_name = "Changed"
+        self.users[0].save()
+        self.assertEqual(user_cache.user_cache.get(self.users[0].id).first_name, "Changed")
+
+    def test_invalidated_on_delete(self):
+        user_cache.user_cache.get(self.users[0].id)
+        user_id = self.users[0].id
+        self.users[0].delete()
+        self.assertIsNone(user_cache.user_cache.get(user_id))
+
+    @override_settings(CACHES={"shared": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+    def test_shared_cache(self):
+        UserCache(max_size=2, ttl=60, shared_cache="shared").get(self.users[0].id)
+        # another process has its own cache, but finds the user in the shared one
+        with self.assertNumQueries(0):
+            self.assertEqual(UserCache(max_size=2, ttl=60, shared_cache="shared").get(self.users[0].id), self.users[0])
+
+
+class CachedJWTAuthenticationTests(APITestCase):
+    """Requests should be authenticated from their access token, without querying the user on every request"""
+
+    def setUp(self):
+        self.user = create_user(0)
+        self.url = reverse("accounts:users-list")
+        user_cache.user_cache.clear()
+
+    def get(self, token) -> int:
+        return self.client.get(self.url, HTTP_AUTHORIZATION=f"Bearer {token}").status_code
+
+    def test_access_token(self):
+        self.assertEqual(self.get(AccessToken.for_user(self.user)), status.HTTP_200_OK)
+
+    def test_missing_token(self):
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_invalid_tokens(self):
+        expired = AccessToken.for_user(self.user)
+        expired.set_exp(from_time=timezone.now() - timedelta(days=1))
+        for token in (expired, RefreshToken.for_user(self.user), "not-a-token"):
+            with self.subTest(token=token):
+                self.assertEqual(self.get(token), status.HTTP_403_FORBIDDEN)
+
+    def test_user_cached(self):
+        token = str(AccessToken.for_user(self.user))
+        with self.assertNumQueries(1):
+            self.assertEqual(get_user_from_token(token), self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_user_from_token(token), self.user)
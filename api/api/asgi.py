@@ -12,14 +12,17 @@ import os
 from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 
-from websockets.routing import websocket_urlpatterns
-
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api.settings")
 
+# the Django application must be set up before importing anything that uses the ORM
+django_asgi_application = get_asgi_application()
+
+from websockets.middleware import JWTAuthMiddleware  # noqa: E402
+from websockets.routing import websocket_urlpatterns  # noqa: E402
 
 application = ProtocolTypeRouter(
     {
-        "http": get_asgi_application(),
-        "websocket": URLRouter(websocket_urlpatterns),
+        "http": django_asgi_application,
+        "websocket": JWTAuthMiddleware(URLRouter(websocket_urlpatterns)),
     }
 )
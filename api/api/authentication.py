@@ -0,0 +1,46 @@
+from typing import Optional
+
+import jwt
+from django.utils import timezone
+from rest_framework.authentication import BaseAuthentication
+
+from accounts.models import User
+from accounts.services.user_cache import user_cache
+from api import settings
+
+
+def get_user_from_token(auth_token: str) -> Optional[User]:
+    """
+    Resolve the user an access token was issued to. The user is looked up from the token's `id` claim through the user
+    cache, so a database query is only made the first time a user is seen within the cache's TTL
+    """
+    try:
+        algorithm = str(settings.SIMPLE_JWT["ALGORITHM"])
+        payload = jwt.decode(auth_token, key=settings.SECRET_KEY, algorithms=[algorithm])
+        expiry = payload["exp"]
+        token_type = payload["token_type"]
+        expired = timezone.now().timestamp() >= expiry
+        if expired or token_type != "access":  # nosec: B105
+            return None
+        return user_cache.get(payload["id"])
+    except (Exception,):
+        # Intentionally passing due to being handled below
+        pass
+    return None
+
+
+class CachedJWTAuthentication(BaseAuthentication):
+    """
+    Authenticates requests using the access token in the `Authorization` header, setting `request.user` once per
+    request. Requests without a valid token are left unauthenticated, leaving the decision to the view's permissions
+    """
+
+    def authenticate(self, request):
+        try:
+            auth_token = request.headers["Authorization"].split("Bearer ")[1]
+        except (KeyError, IndexError):
+            return None
+        user = get_user_from_token(auth_token)
+        if user is None:
+            return None
+        return user, auth_token
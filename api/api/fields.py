@@ -0,0 +1,51 @@
+import base64
+import binascii
+from typing import Optional
+
+from rest_framework import serializers
+
+from api.renderers import MessagePackRenderer
+
+
+class Base64BinaryField(serializers.Field):
+    """
+    A field backed by a `BinaryField`. Over JSON the value is sent as base64 text, while binary transports (MessagePack)
+    send and receive the raw bytes
+    """
+
+    default_error_messages = {
+        "invalid": "Must be a valid base64 encoded string.",
+        "blank": "This field may not be blank.",
+        "max_length": "Ensure this field has no more than {max_length} bytes.",
+    }
+
+    def __init__(self, allow_empty: bool = False, max_length: Optional[int] = None, **kwargs):
+        self.allow_empty = allow_empty
+        self.max_length = max_length
+        super().__init__(**kwargs)
+
+    def to_internal_value(self, data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            value = bytes(data)
+        elif isinstance(data, str):
+            try:
+                value = base64.b64decode(data, validate=True)
+            except (binascii.Error, ValueError):
+                self.fail("invalid")
+        else:
+            self.fail("invalid")
+        if not value and not self.allow_empty:
+            self.fail("blank")
+        if self.max_length is not None and len(value) > self.max_length:
+            self.fail("max_length", max_length=self.max_length)
+        return value
+
+    def to_representation(self, value):
+        value = bytes(value)
+        if self._binary_transport():
+            return value
+        return base64.b64encode(value).decode()
+
+    def _binary_transport(self) -> bool:
+        request = self.context.get("request")
+        return isinstance(getattr(request, "accepted_renderer", None), MessagePackRenderer)
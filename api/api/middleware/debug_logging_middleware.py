@@ -12,5 +12,9 @@ class DebugLoggingMiddleware:
             return self._get_response(request)
         logging.info(f"Incoming request {request.method} {request.path} with body {request.body[:255]}")
         response = self._get_response(request)
+        if response.streaming:
+            # reading the content of a streaming response would consume it before it is sent to the client
+            logging.info(f"Streaming response for request {request.path}")
+            return response
         logging.info(f"Response for request {request.path}: {response.content[:255]}")
         return response
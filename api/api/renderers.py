@@ -0,0 +1,21 @@
+import msgpack
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Renders responses as MessagePack. Binary fields (such as a message's cipher text) are sent as raw bytes rather than
+    base64 when this renderer is negotiated
+    """
+
+    media_type = "application/msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        # fall back on the JSON encoder for the types msgpack does not know about (UUIDs, datetimes, decimals...)
+        return msgpack.packb(data, default=JSONEncoder().default)
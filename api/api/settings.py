@@ -152,6 +152,16 @@ CHANNEL_LAYERS = {
     }
 }
 
+# the most websocket events waiting to be published by the event dispatcher. Events queued beyond it are dropped, with
+# clients catching up on any messages they missed from the gaps in their sequence numbers
+EVENT_DISPATCHER_QUEUE_SIZE = 10000
+# seconds between logging the event dispatcher's queue depth, throughput and publish latency, or 0 to never log them
+EVENT_DISPATCHER_STATS_INTERVAL = 60
+
+# number of worker processes used to encrypt and sign a new group key for every member of the group, once the key has
+# been committed. Setting this to 0 performs the work in the server's background key wrapping thread instead
+KEY_WRAPPING_WORKERS = 4
+
 LOG_REQUEST_ID_HEADER = "HTTP_X_REQUEST_ID"
 LOG_REQUESTS = True
 
@@ -198,7 +208,41 @@ SIMPLE_JWT = {
 }
 
 
+# users resolved from access tokens are cached to avoid a database query on every request. Set "SHARED_CACHE" to the
+# alias of a cache in `CACHES` to also share cached users between processes
+USER_CACHE = {
+    "MAX_SIZE": 1024,
+    "TTL": 60,
+    "SHARED_CACHE": None,
+}
+
+# the members of each group are cached to check websocket subscriptions without a database query per subscription
+MEMBERSHIP_CACHE = {
+    "MAX_SIZE": 4096,
+    "TTL": 30,
+}
+
+# the most messages that can be created in one request to the batch message endpoint
+MESSAGE_BATCH_LIMIT = 500
+
+# where the messages of old partitions of the message table are archived to by the `message_partitions` command.
+# Archived messages are read by every API server and removed when their group is deleted, so in production this must
+# be storage shared by all of them and the commands, e.g. a network file system, rather than a node's local disk
+MESSAGE_ARCHIVE_DIR = os.environ.get("MESSAGE_ARCHIVE_DIR", os.path.join(BASE_DIR, "archive"))
+
 REST_FRAMEWORK = {
+    "DEFAULT_AUTHENTICATION_CLASSES": ("api.authentication.CachedJWTAuthentication",),
+    "DEFAULT_RENDERER_CLASSES": (
+        "rest_framework.renderers.JSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+        "api.renderers.MessagePackRenderer",
+    ),
+    "DEFAULT_PARSER_CLASSES": (
+        "rest_framework.parsers.JSONParser",
+        "rest_framework.parsers.FormParser",
+        "rest_framework.parsers.MultiPartParser",
+        "api.parsers.MessagePackParser",
+    ),
     "DEFAULT_FILTER_BACKENDS": (
         "django_filters.rest_framework.DjangoFilterBackend",
         "rest_framework.filters.SearchFilter",
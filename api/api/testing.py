@@ -0,0 +1,37 @@
+from typing import Iterable, List
+
+from rest_framework.test import APITestCase
+
+from accounts.models import User
+from messages.models import MessageGroup, UserGroup
+
+
+def create_user(index: int) -> User:
+    email = f"user{index}@example.com"
+    return User.objects.create(email=email, username=email, first_name="Test", last_name=f"User{index}")
+
+
+def create_users(count: int) -> List[User]:
+    return [create_user(index) for index in range(count)]
+
+
+def create_group(creator: User, members: Iterable[User]) -> MessageGroup:
+    """A group created by `creator`, which gives it its first key, with each of `members` added to it"""
+    group = MessageGroup.objects.create(user=creator, group_name="Test group")
+    for member in members:
+        UserGroup.objects.create(user=member, group=group)
+    return group
+
+
+class UserTestCase(APITestCase):
+    """`user_count` users, with requests authenticated as the first of them"""
+
+    user_count = 3
+
+    def setUp(self):
+        self.users = create_users(self.user_count)
+        self.user = self.users[0]
+        self.client.force_authenticate(self.user)
+
+    def create_group(self, members: Iterable[User]) -> MessageGroup:
+        return create_group(self.user, members)
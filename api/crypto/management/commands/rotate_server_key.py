@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from crypto.services.rsa import KEY_FILE, generate_private_key, write_key
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate a new RSA key for the server and atomically replace the key file. Running servers pick up the new "
+        "key on their next signing operation, as the key file's modification time will have changed"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--key-file", default=KEY_FILE, help="Path of the key file to replace")
+        parser.add_argument("--key-size", type=int, default=None, help="Size of the new key in bits")
+
+    def handle(self, *args, **options):
+        private_key = generate_private_key(key_size=options["key_size"])
+        write_key(private_key, options["key_file"])
+        self.stdout.write(self.style.SUCCESS(f"Rotated server key in {options['key_file']}"))
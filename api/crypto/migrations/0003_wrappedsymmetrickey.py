@@ -0,0 +1,52 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:28
+
+import uuid
+
+import django.db.models.deletion
+import django.utils.timezone
+import model_utils.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("crypto", "0002_asymmetricpublickey"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="WrappedSymmetricKey",
+            fields=[
+                ("pkid", models.BigAutoField(primary_key=True, serialize=False)),
+                ("id", models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ("created_at", model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False)),
+                (
+                    "updated_at",
+                    model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False),
+                ),
+                ("encrypted_key", models.TextField()),
+                ("signature", models.TextField()),
+                ("signer_fingerprint", models.CharField(max_length=64)),
+                (
+                    "public_key",
+                    models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="crypto.asymmetricpublickey"),
+                ),
+                (
+                    "symmetric_key",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE, to="crypto.symmetrickey", to_field="id"
+                    ),
+                ),
+            ],
+            options={
+                "ordering": ("-pkid",),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name="wrappedsymmetrickey",
+            constraint=models.UniqueConstraint(
+                fields=("symmetric_key", "public_key"), name="unique_wrapped_symmetric_key"
+            ),
+        ),
+    ]
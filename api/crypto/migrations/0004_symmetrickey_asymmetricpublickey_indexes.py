@@ -0,0 +1,24 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:48
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("crypto", "0003_wrappedsymmetrickey"),
+        ("custom_messages", "0011_message_binary_cipher_text_swap"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="asymmetricpublickey",
+            index=models.Index(fields=["user", "-pkid", "not_before", "not_after"], name="publickey_user_pkid_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="symmetrickey",
+            index=models.Index(fields=["group", "-pkid"], name="symmetrickey_group_pkid_idx"),
+        ),
+    ]
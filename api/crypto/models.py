@@ -12,6 +12,10 @@ class SymmetricKey(BaseModel):
     class Meta:
         app_label = "crypto"
         ordering = ("-pkid",)
+        indexes = [
+            # backs the lookup of a group's latest key
+            models.Index(fields=["group", "-pkid"], name="symmetrickey_group_pkid_idx"),
+        ]
 
 
 class AsymmetricPublicKey(BaseModel):
@@ -24,3 +28,28 @@ class AsymmetricPublicKey(BaseModel):
     class Meta:
         app_label = "crypto"
         ordering = ("-pkid",)
+        indexes = [
+            # backs the lookup of a user's latest valid key, filtering on validity while walking their keys newest first
+            models.Index(fields=["user", "-pkid", "not_before", "not_after"], name="publickey_user_pkid_idx"),
+        ]
+
+
+class WrappedSymmetricKey(BaseModel):
+    """
+    Cache of a group's AES key encrypted with a user's public RSA key and signed by the server. Wrapping and signing
+    with 4096-bit RSA keys is expensive, so the result is reused until either key is replaced
+    """
+
+    symmetric_key = models.ForeignKey(SymmetricKey, on_delete=models.CASCADE, to_field="id")
+    public_key = models.ForeignKey(AsymmetricPublicKey, on_delete=models.CASCADE)
+    encrypted_key = models.TextField(null=False, blank=False)
+    signature = models.TextField(null=False, blank=False)
+    # fingerprint of the server key that produced the signature, so that signatures are recomputed on key rotation
+    signer_fingerprint = models.CharField(null=False, blank=False, max_length=64)
+
+    class Meta:
+        app_label = "crypto"
+        ordering = ("-pkid",)
+        constraints = [
+            models.UniqueConstraint(fields=["symmetric_key", "public_key"], name="unique_wrapped_symmetric_key"),
+        ]
@@ -21,3 +21,9 @@ class AsymmetricPublicKeySerializer(serializers.ModelSerializer):
         """Triggerd by the client sending a POST request to `/crypto/rsa/`"""
         request = self.context["request"]
         return verify_and_create_public_key(**validated_data, user=request.user)
+
+
+class SymmetricKeyBatchSerializer(serializers.Serializer):
+    """Class to define the JSON body of a request for the latest keys of many groups"""
+
+    groups = serializers.ListField(child=serializers.UUIDField(), required=False, allow_empty=False)
@@ -1,16 +1,39 @@
 import base64
-from typing import Optional, Tuple
+import json
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Set, Tuple
 from uuid import UUID
 
+import django
+from django.db import connections, transaction
+from django.db.models import Exists, Max, OuterRef, Q, QuerySet, Subquery
 from django.utils import timezone
 from rest_framework.exceptions import ValidationError
 
 from accounts.models import User
-from messages.models import MessageGroup
+from api import settings
+from messages.models import Message, MessageGroup, UserGroup
+from messages.services import archive
 
-from ..models import AsymmetricPublicKey, SymmetricKey
+from ..models import AsymmetricPublicKey, SymmetricKey, WrappedSymmetricKey
 from .aes import generate_random_key
-from .rsa import encrypt, load_public_key_from_text, sign_message, verify_public_key
+from .rsa import encrypt, load_public_key_from_text, server_key_manager, sign_message, verify_public_key
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+_executor: Optional[ProcessPoolExecutor] = None
+# runs the work done after a key is created, such as wrapping it for every member, away from the request
+_background = ThreadPoolExecutor(max_workers=1, thread_name_prefix="key-wrapping")
+
+# the ids of the groups to rotate the keys of when the innermost `coalesce_key_rotations` block exits
+_pending_rotations: ContextVar[Optional[Set[UUID]]] = ContextVar("pending_rotations", default=None)
 
 
 def generate_key_for_group(group: MessageGroup) -> SymmetricKey:
@@ -23,6 +46,63 @@ def generate_key_for_group(group: MessageGroup) -> SymmetricKey:
     )
 
 
+@contextmanager
+def coalesce_key_rotations() -> Iterator[None]:
+    """
+    Run a block in a transaction, deferring the key rotations requested through `rotate_key_for_group` until the end of
+    the block so that each group's key is rotated at most once, however many of its members are removed. Groups that
+    were deleted in the block are not given a new key. Nested blocks are coalesced into the outermost one
+    """
+    if _pending_rotations.get() is not None:
+        yield
+        return
+    pending: Set[UUID] = set()
+    token = _pending_rotations.set(pending)
+    collecting = True
+    try:
+        with transaction.atomic():
+            yield
+            # the keys are generated outside the block, so that rotations they request happen immediately
+            _pending_rotations.reset(token)
+            collecting = False
+            for group in MessageGroup.objects.filter(id__in=pending):
+                generate_key_for_group(group)
+    finally:
+        if collecting:
+            _pending_rotations.reset(token)
+
+
+def rotate_key_for_group(group_id: UUID) -> None:
+    """Give a group a new key, immediately or, within `coalesce_key_rotations`, when the block exits"""
+    pending = _pending_rotations.get()
+    if pending is None:
+        generate_key_for_group(MessageGroup.objects.get(id=group_id))
+    else:
+        pending.add(group_id)
+
+
+def run_in_background(fn: Callable[..., Any], *args: Any) -> None:
+    """Run `fn` in the key wrapping thread, closing the database connection it opens once it is done"""
+
+    def run():
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception(f"Background key work {fn.__name__} failed")
+        finally:
+            connections.close_all()
+
+    _background.submit(run)
+
+
+def wait_for_background(timeout: Optional[float] = None) -> None:
+    """Block until the work already handed to `run_in_background` is done, such as before tearing down a database"""
+    try:
+        _background.submit(lambda: None).result(timeout)
+    except TimeoutError:
+        logger.error("Timed out waiting for background key work to finish")
+
+
 def verify_and_create_public_key(public_key: str, x509_pem: str, user: User) -> AsymmetricPublicKey:
     """Verifies a public key and if successful saves it to the database"""
     certificate = verify_public_key(public_key.encode(), x509_pem.encode())
@@ -30,6 +110,8 @@ def verify_and_create_public_key(public_key: str, x509_pem: str, user: User) ->
         # here certificate is `None`, so could not be verified and we raise a validation error to return a HTTP 400
         # response to the client
         raise ValidationError(detail="Could not validate public key!")
+    # the user's previous public keys are replaced by this one, so AES keys wrapped with them are no longer usable
+    WrappedSymmetricKey.objects.filter(public_key__user=user).delete()
     return AsymmetricPublicKey.objects.create(
         user=user,
         public_key=public_key,
@@ -46,6 +128,187 @@ def get_key_for_group_and_user(user: User, group_id: Optional[str | UUID]) -> Tu
     if not user.usergroup_set.filter(group_id=group_id):
         # user is not a member of the group and cannot receive the AES key
         raise ValidationError(detail="User is not a member of the group!")
+    rsa_key = get_public_key_for_user(user)
+    symmetric_key = SymmetricKey.objects.filter(group_id=group_id).order_by("-pkid").first()  # grab the latest AES key
+    wrapped_key = get_wrapped_key(symmetric_key, rsa_key)  # get ciphertext and signature
+    return wrapped_key.encrypted_key, wrapped_key.signature, symmetric_key.id
+
+
+def get_key_history_for_group_and_user(
+    user: User, group_id: Optional[str | UUID]
+) -> Tuple[QuerySet[SymmetricKey], AsymmetricPublicKey]:
+    """
+    Fetch every key of a group that the user is entitled to, along with the RSA key to encrypt them with. This is the
+    key that was in use when the user joined the group and all keys created since, newest first
+    """
+    if not group_id:
+        raise ValidationError(detail="Group id not provided")
+    membership = user.usergroup_set.filter(group_id=group_id).order_by("pkid").first()
+    if not membership:
+        # user is not a member of the group and cannot receive its AES keys
+        raise ValidationError(detail="User is not a member of the group!")
+    rsa_key = get_public_key_for_user(user)
+    return entitled_symmetric_keys(user, [group_id]).order_by("-pkid"), rsa_key
+
+
+def entitled_symmetric_keys(user: User, group_ids: Sequence[str | UUID]) -> QuerySet[SymmetricKey]:
+    """
+    The keys of the groups that the user is entitled to, which for each group they are a member of is the key that was
+    in use when they joined and all keys created since. Keys of the other groups are left out
+    """
+    key_at_joining = (
+        SymmetricKey.objects.filter(group_id=OuterRef("group_id"), created_at__lte=OuterRef("created_at"))
+        .order_by("-pkid")
+        .values("pkid")[:1]
+    )
+    memberships = (
+        UserGroup.objects.filter(user=user, group_id__in=group_ids)
+        .annotate(key_at_joining_pkid=Subquery(key_at_joining))
+        .values_list("group_id", "created_at", "key_at_joining_pkid")
+    )
+    entitled = Q()
+    for group_id, joined_at, key_at_joining_pkid in memberships:
+        if key_at_joining_pkid is None:
+            entitled |= Q(group_id=group_id, created_at__gte=joined_at)
+        else:
+            entitled |= Q(group_id=group_id, pkid__gte=key_at_joining_pkid)
+    if not entitled:
+        return SymmetricKey.objects.none()
+    return SymmetricKey.objects.filter(entitled)
+
+
+def get_keys_for_user(user: User, group_ids: Optional[List[UUID]] = None) -> Tuple[str, str]:
+    """
+    Fetch the latest key for many groups at once, encrypted for the user using their public RSA key. Rather than
+    signing each key, the keys are returned in a manifest with a single signature over the whole manifest. All of the
+    user's groups are included if `group_ids` is not provided
+    """
+    memberships = UserGroup.objects.filter(user=user)
+    if group_ids is not None:
+        memberships = memberships.filter(group_id__in=group_ids)
+    member_group_ids = set(memberships.values_list("group_id", flat=True))
+    if group_ids is not None and (non_member_group_ids := set(group_ids) - member_group_ids):
+        # user is not a member of some of the groups and cannot receive their AES keys
+        raise ValidationError(
+            detail=f"User is not a member of groups {', '.join(sorted(map(str, non_member_group_ids)))}!"
+        )
+    rsa_key = get_public_key_for_user(user)
+    # grab the latest AES key of every group in a single query
+    latest_pkids = (
+        SymmetricKey.objects.filter(group_id__in=member_group_ids)
+        .order_by()
+        .values("group_id")
+        .annotate(latest_pkid=Max("pkid"))
+        .values("latest_pkid")
+    )
+    symmetric_keys = list(SymmetricKey.objects.filter(pkid__in=latest_pkids))
+    wrapped_keys = get_wrapped_keys(symmetric_keys, rsa_key)
+    entries = [
+        {"group": str(symmetric_key.group_id), "id": str(symmetric_key.id), "key": wrapped_key.encrypted_key}
+        for symmetric_key, wrapped_key in zip(symmetric_keys, wrapped_keys)
+    ]
+    manifest_bytes = json.dumps(sorted(entries, key=lambda entry: entry["group"]), separators=(",", ":")).encode()
+    signature = sign_message(manifest_bytes)
+    return base64.b64encode(manifest_bytes).decode(), base64.b64encode(signature).decode()
+
+
+def get_wrapped_keys(symmetric_keys: List[SymmetricKey], rsa_key: AsymmetricPublicKey) -> List[WrappedSymmetricKey]:
+    """
+    Fetch many AES keys encrypted with a user's public RSA key, in the same order as `symmetric_keys`. Previously
+    computed results are fetched in a single query and any missing ones are computed in the worker pool
+    """
+    fingerprint = server_key_manager.fingerprint
+    cached = {
+        wrapped_key.symmetric_key_id: wrapped_key
+        for wrapped_key in WrappedSymmetricKey.objects.filter(
+            symmetric_key__in=[symmetric_key.id for symmetric_key in symmetric_keys],
+            public_key=rsa_key,
+            signer_fingerprint=fingerprint,
+        )
+    }
+    missing = [symmetric_key for symmetric_key in symmetric_keys if symmetric_key.id not in cached]
+    if missing:
+        results = _map_in_pool(
+            _encrypt_aes_key, [symmetric_key.key for symmetric_key in missing], [rsa_key.public_key] * len(missing)
+        )
+        wrapped_keys = [
+            WrappedSymmetricKey(
+                symmetric_key=symmetric_key,
+                public_key=rsa_key,
+                encrypted_key=encrypted_key,
+                signature=signature,
+                signer_fingerprint=fingerprint,
+            )
+            for symmetric_key, (encrypted_key, signature) in zip(missing, results)
+        ]
+        # rows signed by a previous server key are replaced rather than duplicated
+        WrappedSymmetricKey.objects.bulk_create(
+            wrapped_keys,
+            update_conflicts=True,
+            unique_fields=["symmetric_key", "public_key"],
+            update_fields=["encrypted_key", "signature", "signer_fingerprint", "updated_at"],
+        )
+        cached.update({wrapped_key.symmetric_key_id: wrapped_key for wrapped_key in wrapped_keys})
+    return [cached[symmetric_key.id] for symmetric_key in symmetric_keys]
+
+
+def get_wrapped_key(symmetric_key: SymmetricKey, rsa_key: AsymmetricPublicKey) -> WrappedSymmetricKey:
+    """
+    Fetch an AES key encrypted with a user's public RSA key, reusing a previously computed result if neither key has
+    changed and the server's signing key has not been rotated since
+    """
+    fingerprint = server_key_manager.fingerprint
+    wrapped_key = WrappedSymmetricKey.objects.filter(
+        symmetric_key=symmetric_key, public_key=rsa_key, signer_fingerprint=fingerprint
+    ).first()
+    if wrapped_key:
+        return wrapped_key
+    encrypted_key, signature = _encrypt_aes_key(symmetric_key.key, rsa_key.public_key)
+    # a row signed by a previous server key may exist, in which case it is replaced rather than duplicated
+    wrapped_key, _ = WrappedSymmetricKey.objects.update_or_create(
+        symmetric_key=symmetric_key,
+        public_key=rsa_key,
+        defaults={"encrypted_key": encrypted_key, "signature": signature, "signer_fingerprint": fingerprint},
+    )
+    return wrapped_key
+
+
+def wrap_key_for_members(symmetric_key: SymmetricKey) -> List[WrappedSymmetricKey]:
+    """
+    Encrypt and sign a new AES key for every member of its group that has a valid RSA key, so that members do not all
+    have to request it (and wait on the RSA work) as soon as they are told about it. The RSA operations are spread
+    across a pool of worker processes. Called once the key has been committed, from `run_in_background`
+    """
+    now = timezone.now().date()
+    members = UserGroup.objects.filter(group_id=symmetric_key.group_id).values("user_id")
+    rsa_keys: Dict[UUID, AsymmetricPublicKey] = {}
+    for rsa_key in AsymmetricPublicKey.objects.filter(
+        user_id__in=members, not_before__lte=now, not_after__gte=now
+    ).order_by("-pkid"):
+        # only the latest valid key for each user is used, matching `get_key_for_group_and_user`
+        rsa_keys.setdefault(rsa_key.user_id, rsa_key)
+    if not rsa_keys:
+        return []
+    fingerprint = server_key_manager.fingerprint
+    public_keys = [rsa_key.public_key for rsa_key in rsa_keys.values()]
+    results = _map_in_pool(_encrypt_aes_key, [symmetric_key.key] * len(public_keys), public_keys)
+    wrapped_keys = [
+        WrappedSymmetricKey(
+            symmetric_key=symmetric_key,
+            public_key=rsa_key,
+            encrypted_key=encrypted_key,
+            signature=signature,
+            signer_fingerprint=fingerprint,
+        )
+        for rsa_key, (encrypted_key, signature) in zip(rsa_keys.values(), results)
+    ]
+    # a member may have fetched the key while we were computing, in which case their existing row is kept
+    WrappedSymmetricKey.objects.bulk_create(wrapped_keys, ignore_conflicts=True)
+    return wrapped_keys
+
+
+def get_public_key_for_user(user: User) -> AsymmetricPublicKey:
+    """Fetch the user's latest valid public RSA key"""
     now = timezone.now().date()
     rsa_key = (
         AsymmetricPublicKey.objects.filter(user=user, not_before__lte=now, not_after__gte=now).order_by("-pkid").first()
@@ -53,9 +316,60 @@ def get_key_for_group_and_user(user: User, group_id: Optional[str | UUID]) -> Tu
     if not rsa_key:
         # the user may have access to the group, but we don't have an RSA key stored for them that is valid
         raise ValidationError(detail="Public RSA key not found for user!")
-    symmetric_key = SymmetricKey.objects.filter(group_id=group_id).order_by("-pkid").first()  # grab the latest AES key
-    encrypted_key, signature = _encrypt_aes_key(symmetric_key.key, rsa_key.public_key)  # get ciphertext and signature
-    return encrypted_key, signature, symmetric_key.id
+    return rsa_key
+
+
+def superseded_symmetric_keys(archive_directory: str) -> QuerySet[SymmetricKey]:
+    """
+    Keys that have been replaced by a newer key of their group and are no longer needed. A key is kept while it
+    encrypts a message, whether in the database or possibly in the archive at `archive_directory`, or while it is the
+    key a member was given on joining, as their history starts from that key and must not fall back to an earlier one
+    """
+    next_key = SymmetricKey.objects.filter(group_id=OuterRef("group_id"), pkid__gt=OuterRef("pkid")).order_by("pkid")
+    keys = (
+        SymmetricKey.objects.annotate(superseded_at=Subquery(next_key.values("created_at")[:1]))
+        .filter(superseded_at__isnull=False)
+        .exclude(Exists(Message.objects.filter(key_id=OuterRef("id"))))
+        .exclude(
+            Exists(
+                UserGroup.objects.filter(
+                    group_id=OuterRef("group_id"),
+                    created_at__gte=OuterRef("created_at"),
+                    created_at__lt=OuterRef("superseded_at"),
+                )
+            )
+        )
+    )
+    if archived_until := archive.archived_until(archive_directory):
+        keys = keys.filter(created_at__gte=archived_until)
+    return keys
+
+
+def expired_public_keys() -> QuerySet[AsymmetricPublicKey]:
+    """Public RSA keys whose certificates have expired and that have been replaced by a newer key of their user"""
+    newer_key = AsymmetricPublicKey.objects.filter(user_id=OuterRef("user_id"), pkid__gt=OuterRef("pkid"))
+    return AsymmetricPublicKey.objects.filter(Exists(newer_key), not_after__lt=timezone.now().date())
+
+
+def _map_in_pool(fn, *args: list) -> list:
+    """Run `fn` over the arguments in the worker pool, falling back to this process if the pool is disabled or broken"""
+    global _executor
+    if not settings.KEY_WRAPPING_WORKERS:
+        return list(map(fn, *args))
+    if _executor is None:
+        # workers are spawned rather than forked, as forking copies the state of the server's other threads, so they
+        # set Django up themselves
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.KEY_WRAPPING_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=django.setup,
+        )
+    try:
+        return list(_executor.map(fn, *args))
+    except BrokenProcessPool as e:
+        logger.error(f"Key wrapping pool failed, wrapping keys in process: {e}")
+        _executor = None
+        return list(map(fn, *args))
 
 
 def _encrypt_aes_key(aes_key: str, rsa_key: str) -> Tuple[str, str]:
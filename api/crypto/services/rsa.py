@@ -1,6 +1,8 @@
 import logging
+import os
+import threading
 from datetime import timedelta
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
 from cryptography import x509
 from cryptography.hazmat import backends
@@ -13,27 +15,126 @@ logging.basicConfig()
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+KEY_FILE = "key.pem"
+# the cached certificate is regenerated once it is within this window of expiring, so that clients are never handed a
+# certificate that is about to become invalid
+CERTIFICATE_RENEWAL_MARGIN = timedelta(weeks=1)
 
-def load_key() -> rsa.RSAPrivateKey:
+
+class ServerKeyManager:
+    """
+    Process-wide cache of the server's RSA private key and self-signed X.509 certificate.
+
+    The key is read from disk and deserialised once, then reused until the key file's modification time changes (e.g.
+    after `manage.py rotate_server_key`) or `reload()` is called. The certificate is reused until it is close to its
+    `not_valid_after` date. The cached values are swapped in as a whole under a lock, so concurrent callers never see a
+    key paired with a certificate for a different key.
+    """
+
+    def __init__(self, key_file: str = KEY_FILE):
+        self.key_file = key_file
+        self._lock = threading.Lock()
+        # (private key, key file mtime, public key fingerprint)
+        self._key: Optional[Tuple[rsa.RSAPrivateKey, Optional[float], str]] = None
+        # (private key the certificate was generated for, certificate, PEM encoding of the certificate)
+        self._certificate: Optional[Tuple[rsa.RSAPrivateKey, x509.Certificate, str]] = None
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    @property
+    def private_key(self) -> rsa.RSAPrivateKey:
+        """The server's private key, loading it from disk if it has not been loaded or the key file has changed"""
+        return self._get_key()[0]
+
+    @property
+    def fingerprint(self) -> str:
+        """A SHA-256 fingerprint of the server's public key, identifying which key produced a signature"""
+        return self._get_key()[2]
+
+    @property
+    def certificate_pem(self) -> str:
+        """The PEM encoding of the server's certificate, regenerating it if it is close to expiring"""
+        private_key = self.private_key
+        cached = self._certificate
+        if cached is not None and cached[0] is private_key and not _expiring(cached[1]):
+            self.hits += 1
+            return cached[2]
+        with self._lock:
+            cached = self._certificate
+            if cached is None or cached[0] is not private_key or _expiring(cached[1]):
+                self.misses += 1
+                certificate = _generate_x509_cert(private_key)
+                # store a string representation of the public bytes in PEM encoding
+                cached = (private_key, certificate, certificate.public_bytes(serialization.Encoding.PEM).decode())
+                self._certificate = cached
+            return cached[2]
+
+    def reload(self) -> None:
+        """Reload the key from disk, discarding the cached key and certificate"""
+        with self._lock:
+            self._load()
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "reloads": self.reloads}
+
+    def _get_key(self) -> Tuple[rsa.RSAPrivateKey, Optional[float], str]:
+        cached = self._key
+        if cached is not None and cached[1] == self._key_file_mtime():
+            self.hits += 1
+            return cached
+        with self._lock:
+            # another thread may have reloaded the key while we were waiting on the lock
+            cached = self._key
+            if cached is None or cached[1] != self._key_file_mtime():
+                self.misses += 1
+                cached = self._load()
+            return cached
+
+    def _load(self) -> Tuple[rsa.RSAPrivateKey, Optional[float], str]:
+        """Load the key from disk, must be called with the lock held"""
+        private_key = load_key(self.key_file)
+        self._key = (private_key, self._key_file_mtime(), _fingerprint(private_key))
+        self.reloads += 1
+        return self._key
+
+    def _key_file_mtime(self) -> Optional[float]:
+        try:
+            return os.stat(self.key_file).st_mtime
+        except OSError:
+            return None
+
+
+def load_key(key_file: str = KEY_FILE) -> rsa.RSAPrivateKey:
     """Load the server's RSA key, first attempting to load from a file and falling back to generating it"""
     try:
-        with open("key.pem", "rb") as key_file:
-            private_key = serialization.load_pem_private_key(key_file.read(), password=None)
+        with open(key_file, "rb") as f:
+            private_key = serialization.load_pem_private_key(f.read(), password=None)
             return private_key
     except (Exception,):
         # Key has not been saved to a file yet
         private_key = generate_private_key()
-        pem = private_key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.TraditionalOpenSSL,
-            encryption_algorithm=serialization.NoEncryption(),
-        )
         # create the key and write it to the file for future use
-        with open("key.pem", "wb") as key_file:
-            key_file.write(pem)
+        write_key(private_key, key_file)
         return private_key
 
 
+def write_key(private_key: rsa.RSAPrivateKey, key_file: str = KEY_FILE) -> None:
+    """
+    Write a private key to the key file. The key is written to a temporary file first and then moved into place, so
+    that other processes watching the file never read a partially written key
+    """
+    pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    tmp_file = f"{key_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(pem)
+    os.replace(tmp_file, key_file)
+
+
 def generate_private_key(key_size: Optional[int] = None, public_exponent: Optional[int] = None) -> rsa.RSAPrivateKey:
     """Generate a private key with the given parameters or default"""
     key_size = key_size or 4096
@@ -48,10 +149,7 @@ def generate_private_key(key_size: Optional[int] = None, public_exponent: Option
 
 def generate_x509_cert_pem() -> str:
     """High level method to generate an X.509 cert for an RSA key pair"""
-    rsa_key = load_key()
-    certificate = _generate_x509_cert(rsa_key)
-    # return a string representation of the public bytes in PEM encoding
-    return certificate.public_bytes(serialization.Encoding.PEM).decode()
+    return server_key_manager.certificate_pem
 
 
 def encrypt(
@@ -91,7 +189,7 @@ def verify_public_key(public_key: bytes, certificate: bytes) -> Optional[x509.Ce
 
 def sign_message(message: bytes) -> bytes:
     """Sign a bytestream using the PSS padding and the server's private key"""
-    private_key = load_key()
+    private_key = server_key_manager.private_key
     return private_key.sign(message, padding.PSS(salt_length=20, mgf=padding.MGF1(hashes.SHA256())), hashes.SHA256())
 
 
@@ -133,5 +231,22 @@ def _generate_x509_cert(private_key: rsa.RSAPrivateKey) -> x509.Certificate:
     return certificate
 
 
+def _expiring(certificate: x509.Certificate) -> bool:
+    return certificate.not_valid_after_utc - CERTIFICATE_RENEWAL_MARGIN <= timezone.now()
+
+
+def _fingerprint(private_key: rsa.RSAPrivateKey) -> str:
+    public_bytes = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo,
+    )
+    digest = hashes.Hash(hashes.SHA256())
+    digest.update(public_bytes)
+    return digest.finalize().hex()
+
+
 def _get_padding() -> padding.AsymmetricPadding:
     return padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+
+
+server_key_manager = ServerKeyManager()
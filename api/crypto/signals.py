@@ -1,22 +1,42 @@
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
+from functools import partial
+
+from django.db import transaction
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
+from messages.models import UserGroup
+from websockets.services.event_dispatcher import send_to_user
+
 from .models import SymmetricKey
+from .services import key_management_service
 
 
 @receiver(post_save, sender=SymmetricKey)
 def notify_users_of_new_symmetric_key(sender, instance: SymmetricKey, created: bool, **kwargs):
     """Triggered every time a SymmetricKey instance is updated or created in the database
-    We want to send a message to the group along the websocket indicating that the key for the group has been updated
+    We want to send a message to each group member along the websocket indicating that the key for the group has been
+    updated
     """
     if not created:
         return
-    channel_layer = get_channel_layer()
-    group_id = str(instance.group.id)
-    message = {"type": "send.message", "message_type": "new_key", "message": ""}
-    # send this message to all clients listening to the group's websocket channel, even those who are not group members
-    # this is required so that those who have been removed from the group are now aware they have been removed, even
-    # though the server already possesses this knowledge
-    async_to_sync(channel_layer.group_send)(group_id, message)
+    # the RSA work is done once the key has been committed, outside of the request that created it
+    transaction.on_commit(partial(key_management_service.run_in_background, send_wrapped_keys, instance))
+
+
+def send_wrapped_keys(symmetric_key: SymmetricKey) -> None:
+    """
+    Wrap a new key for every member of its group up front, so that members do not all have to request it from
+    `/crypto/aes/` at the same time, and send each member only their own wrapping. Members without a valid RSA key are
+    only sent the key's id
+    """
+    group_id = str(symmetric_key.group_id)
+    wrapped_keys = {
+        wrapped_key.public_key.user_id: wrapped_key
+        for wrapped_key in key_management_service.wrap_key_for_members(symmetric_key)
+    }
+    # removed members are no longer in the group, and so are never sent the key
+    for user_id in UserGroup.objects.filter(group_id=symmetric_key.group_id).values_list("user_id", flat=True):
+        message = {"id": str(symmetric_key.id)}
+        if wrapped_key := wrapped_keys.get(user_id):
+            message.update(key=wrapped_key.encrypted_key, signature=wrapped_key.signature)
+        send_to_user(str(user_id), group_id, "new_key", message)
@@ -1,3 +1,381 @@
-from django.test import TestCase
+import base64
+import json
+import os
+import tempfile
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+from django.db import connection
+from django.test import SimpleTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+
+from api import settings
+from api.testing import UserTestCase
+from messages.models import UserGroup
+
+from . import signals, views
+from .models import AsymmetricPublicKey, SymmetricKey, WrappedSymmetricKey
+from .services import key_management_service, rsa
+
+
+class ServerKeyManagerTests(SimpleTestCase):
+    """The server's key and certificate should be loaded once per process and only reloaded when they change"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # 4096 bit keys are slow to generate, and the size makes no difference to caching
+        cls.keys = [rsa.generate_private_key(key_size=2048) for _ in range(2)]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.key_file = os.path.join(directory.name, "key.pem")
+        rsa.write_key(self.keys[0], self.key_file)
+        self.manager = rsa.ServerKeyManager(self.key_file)
+
+    def replace_key_file(self, private_key) -> None:
+        rsa.write_key(private_key, self.key_file)
+        # modification times can be too coarse to tell two writes in quick succession apart
+        stat = os.stat(self.key_file)
+        os.utime(self.key_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+
+    def public_numbers(self, private_key):
+        return private_key.public_key().public_numbers()
+
+    def test_key_loaded_once(self):
+        first = self.manager.private_key
+        self.assertIs(self.manager.private_key, first)
+        self.assertEqual(self.public_numbers(first), self.public_numbers(self.keys[0]))
+        self.assertEqual(self.manager.stats()["reloads"], 1)
+
+    def test_key_reloaded_when_file_changes(self):
+        fingerprint = self.manager.fingerprint
+        self.replace_key_file(self.keys[1])
+        self.assertEqual(self.public_numbers(self.manager.private_key), self.public_numbers(self.keys[1]))
+        self.assertNotEqual(self.manager.fingerprint, fingerprint)
+        self.assertEqual(self.manager.stats()["reloads"], 2)
+
+    def test_certificate_cached(self):
+        certificate = self.manager.certificate_pem
+        misses = self.manager.stats()["misses"]
+        self.assertEqual(self.manager.certificate_pem, certificate)
+        self.assertEqual(self.manager.stats()["misses"], misses)
+
+    def test_certificate_regenerated_for_new_key(self):
+        certificate = self.manager.certificate_pem
+        self.replace_key_file(self.keys[1])
+        self.assertNotEqual(self.manager.certificate_pem, certificate)
+        public_key = x509.load_pem_x509_certificate(self.manager.certificate_pem.encode()).public_key()
+        self.assertEqual(public_key.public_numbers(), self.public_numbers(self.keys[1]))
+
+    def test_certificate_regenerated_when_expiring(self):
+        certificate = self.manager.certificate_pem
+        # certificates last a year, so every certificate is within a renewal margin of two years
+        with mock.patch.object(rsa, "CERTIFICATE_RENEWAL_MARGIN", timedelta(weeks=104)):
+            self.assertNotEqual(self.manager.certificate_pem, certificate)
+
+    def test_reload(self):
+        first = self.manager.private_key
+        self.manager.reload()
+        self.assertIsNot(self.manager.private_key, first)
+        self.assertEqual(self.manager.stats()["reloads"], 2)
+
+
+class KeyTestCase(UserTestCase):
+    """
+    Users with RSA keys, with the server signing using a throwaway key rather than generating or replacing `key.pem`.
+    Keys are wrapped in this process rather than in a pool of workers
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.client_key = rsa.generate_private_key(key_size=2048)
+        directory = tempfile.TemporaryDirectory()
+        cls.addClassCleanup(directory.cleanup)
+        cls.server_key_file = os.path.join(directory.name, "key.pem")
+        rsa.write_key(rsa.generate_private_key(key_size=2048), cls.server_key_file)
+        for patch in (
+            mock.patch.object(rsa.server_key_manager, "key_file", cls.server_key_file),
+            mock.patch.object(settings, "KEY_WRAPPING_WORKERS", 0),
+        ):
+            patch.start()
+            cls.addClassCleanup(patch.stop)
+
+    def create_public_key(self, user) -> AsymmetricPublicKey:
+        today = timezone.now().date()
+        public_key = self.client_key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        return AsymmetricPublicKey.objects.create(
+            user=user,
+            public_key=public_key.decode(),
+            x509_pem="certificate",
+            not_before=today - timedelta(days=1),
+            not_after=today + timedelta(days=30),
+        )
+
+    def rotate_server_key(self) -> None:
+        rsa.write_key(rsa.generate_private_key(key_size=2048), self.server_key_file)
+        rsa.server_key_manager.reload()
+
+    def unwrap(self, encrypted_key: str) -> str:
+        return self.client_key.decrypt(
+            base64.b64decode(encrypted_key),
+            padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None),
+        ).decode()
+
+    def assertSignedByServer(self, message: bytes, signature: str) -> None:
+        rsa.server_key_manager.private_key.public_key().verify(
+            base64.b64decode(signature),
+            message,
+            padding.PSS(salt_length=20, mgf=padding.MGF1(hashes.SHA256())),
+            hashes.SHA256(),
+        )
+
+
+class WrappedKeyCacheTests(KeyTestCase):
+    """A group's key should only be wrapped for a user once, until either of their keys or the server's key changes"""
+
+    def setUp(self):
+        super().setUp()
+        self.public_key = self.create_public_key(self.user)
+        self.group = self.create_group([self.user])
+        self.symmetric_key = SymmetricKey.objects.get(group=self.group)
+        self.url = reverse("crypto:aes-list")
+
+    def get_key(self) -> dict:
+        with mock.patch.object(
+            key_management_service, "_encrypt_aes_key", wraps=key_management_service._encrypt_aes_key
+        ) as encrypt:
+            response = self.client.get(self.url, {"group": str(self.group.id)})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.encryptions = encrypt.call_count
+        return response.data
+
+    def test_key_wrapped_for_user(self):
+        data = self.get_key()
+        self.assertEqual(data["id"], self.symmetric_key.id)
+        self.assertEqual(self.unwrap(data["key"]), self.symmetric_key.key)
+        self.assertSignedByServer(base64.b64decode(data["key"]), data["signature"])
+
+    def test_wrapped_key_reused(self):
+        first = self.get_key()
+        self.assertEqual(self.encryptions, 1)
+        second = self.get_key()
+        self.assertEqual(self.encryptions, 0)
+        self.assertEqual((second["key"], second["signature"]), (first["key"], first["signature"]))
+        self.assertEqual(WrappedSymmetricKey.objects.count(), 1)
+
+    def test_rewrapped_for_new_public_key(self):
+        self.get_key()
+        new_public_key = self.create_public_key(self.user)
+        self.get_key()
+        self.assertEqual(self.encryptions, 1)
+        self.assertTrue(WrappedSymmetricKey.objects.filter(public_key=new_public_key).exists())
+
+    def test_rewrapped_for_new_group_key(self):
+        self.get_key()
+        new_key = key_management_service.generate_key_for_group(self.group)
+        data = self.get_key()
+        self.assertEqual(self.encryptions, 1)
+        self.assertEqual(data["id"], new_key.id)
+        self.assertEqual(self.unwrap(data["key"]), new_key.key)
+
+    def test_resigned_after_server_key_rotation(self):
+        self.get_key()
+        self.rotate_server_key()
+        data = self.get_key()
+        self.assertEqual(self.encryptions, 1)
+        self.assertSignedByServer(base64.b64decode(data["key"]), data["signature"])
+        # the row signed by the previous key is replaced rather than duplicated
+        wrapped_key = WrappedSymmetricKey.objects.get()
+        self.assertEqual(wrapped_key.signer_fingerprint, rsa.server_key_manager.fingerprint)
+
+
+class KeyFanOutTests(KeyTestCase):
+    """A new key should be wrapped for every member once it commits, with each member only sent their own copy"""
+
+    def setUp(self):
+        super().setUp()
+        # the last user has no RSA key, so cannot be sent the key itself
+        for user in self.users[:2]:
+            self.create_public_key(user)
+        self.group = self.create_group(self.users)
+
+    def test_wrapped_after_commit(self):
+        with mock.patch.object(key_management_service, "run_in_background") as run_in_background:
+            with self.captureOnCommitCallbacks() as callbacks:
+                symmetric_key = key_management_service.generate_key_for_group(self.group)
+                run_in_background.assert_not_called()
+            for callback in callbacks:
+                callback()
+        run_in_background.assert_called_once_with(signals.send_wrapped_keys, symmetric_key)
+
+    def test_members_sent_own_key(self):
+        symmetric_key = key_management_service.generate_key_for_group(self.group)
+        with mock.patch.object(signals, "send_to_user") as send_to_user:
+            signals.send_wrapped_keys(symmetric_key)
+        messages = {}
+        for (user_id, group_id, message_type, message), _ in send_to_user.call_args_list:
+            self.assertEqual((group_id, message_type), (str(self.group.id), "new_key"))
+            messages[user_id] = message
+        self.assertEqual(set(messages), {str(user.id) for user in self.users})
+        for user in self.users[:2]:
+            message = messages[str(user.id)]
+            self.assertEqual(message["id"], str(symmetric_key.id))
+            self.assertEqual(self.unwrap(message["key"]), symmetric_key.key)
+            self.assertSignedByServer(base64.b64decode(message["key"]), message["signature"])
+        self.assertEqual(messages[str(self.users[2].id)], {"id": str(symmetric_key.id)})
+        # the wrappings are stored, so members fetching the key are not made to wait on the RSA work
+        self.assertEqual(WrappedSymmetricKey.objects.filter(symmetric_key=symmetric_key).count(), 2)
+
+    def test_removed_member_not_sent_key(self):
+        UserGroup.objects.filter(group=self.group, user=self.users[1]).delete()
+        symmetric_key = SymmetricKey.objects.filter(group=self.group).order_by("-pkid").first()
+        with mock.patch.object(signals, "send_to_user") as send_to_user:
+            signals.send_wrapped_keys(symmetric_key)
+        self.assertNotIn(str(self.users[1].id), {call.args[0] for call in send_to_user.call_args_list})
+
+    def test_existing_wrapping_kept(self):
+        symmetric_key = key_management_service.generate_key_for_group(self.group)
+        response = self.client.get(reverse("crypto:aes-list"), {"group": str(self.group.id)})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        key_management_service.wrap_key_for_members(symmetric_key)
+        wrapped_key = WrappedSymmetricKey.objects.get(symmetric_key=symmetric_key, public_key__user=self.user)
+        self.assertEqual(wrapped_key.encrypted_key, response.data["key"])
+
+
+class KeyBatchTests(KeyTestCase):
+    """The latest keys of many groups should be fetched at once, in a manifest signed as a whole"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_public_key(self.user)
+        self.groups = [self.create_group([self.user]) for _ in range(3)]
+        self.url = reverse("crypto:aes-batch")
+
+    def get_manifest(self, body: dict) -> list:
+        response = self.client.post(self.url, body, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        manifest = base64.b64decode(response.data["manifest"])
+        self.assertSignedByServer(manifest, response.data["signature"])
+        return json.loads(manifest)
+
+    def test_all_groups(self):
+        latest_keys = {str(group.id): key_management_service.generate_key_for_group(group) for group in self.groups}
+        # groups the user is not a member of are left out
+        self.create_group([self.users[1]])
+        manifest = self.get_manifest({})
+        self.assertEqual([entry["group"] for entry in manifest], sorted(latest_keys))
+        for entry in manifest:
+            symmetric_key = latest_keys[entry["group"]]
+            self.assertEqual(entry["id"], str(symmetric_key.id))
+            self.assertEqual(self.unwrap(entry["key"]), symmetric_key.key)
+
+    def test_some_groups(self):
+        manifest = self.get_manifest({"groups": [str(self.groups[0].id)]})
+        self.assertEqual([entry["group"] for entry in manifest], [str(self.groups[0].id)])
+
+    def test_not_member(self):
+        group = self.create_group([self.users[1]])
+        response = self.client.post(self.url, {"groups": [str(self.groups[0].id), str(group.id)]}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_count(self):
+        self.get_manifest({})
+        with CaptureQueriesContext(connection) as context:
+            self.get_manifest({})
+        expected = len(context.captured_queries)
+        for _ in range(3):
+            self.create_group([self.user])
+        self.get_manifest({})
+        with CaptureQueriesContext(connection) as context:
+            self.get_manifest({})
+        self.assertEqual(len(context.captured_queries), expected)
+
+
+class KeyHistoryTests(KeyTestCase):
+    """Members should be given every key since they joined, in pages that clients can revalidate with an ETag"""
+
+    def setUp(self):
+        super().setUp()
+        self.create_public_key(self.user)
+        self.group = self.create_group([self.users[1]])
+        self.url = reverse("crypto:aes-history")
+
+    def join(self) -> None:
+        # created at times are only as precise as the clock, so the keys so far are kept apart from joining
+        for symmetric_key in SymmetricKey.objects.filter(group=self.group):
+            SymmetricKey.objects.filter(pkid=symmetric_key.pkid).update(
+                created_at=symmetric_key.created_at - timedelta(seconds=10)
+            )
+        UserGroup.objects.create(user=self.user, group=self.group)
+
+    def get_history(self, **headers):
+        return self.client.get(self.url, {"group": str(self.group.id)}, **headers)
+
+    def test_keys_since_joining(self):
+        key_management_service.generate_key_for_group(self.group)
+        key_at_joining = SymmetricKey.objects.filter(group=self.group).order_by("-pkid").first()
+        self.join()
+        later_key = key_management_service.generate_key_for_group(self.group)
+        response = self.get_history()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        keys = response.data["results"]
+        # the key in use when the user joined is included, but not those before it
+        self.assertEqual([key["id"] for key in keys], [later_key.id, key_at_joining.id])
+        for key, symmetric_key in zip(keys, (later_key, key_at_joining)):
+            self.assertEqual(self.unwrap(key["key"]), symmetric_key.key)
+
+    def test_not_member(self):
+        self.assertEqual(self.get_history().status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_not_modified(self):
+        self.join()
+        response = self.get_history()
+        etag = response["ETag"]
+        with mock.patch.object(views, "get_wrapped_keys") as get_wrapped_keys:
+            response = self.get_history(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response["ETag"], etag)
+        get_wrapped_keys.assert_not_called()
+
+    def test_if_none_match_parsed(self):
+        self.join()
+        etag = self.get_history()["ETag"]
+        for if_none_match, not_modified in (
+            (f'"other", W/{etag}', True),
+            ("*", True),
+            # the ETag within another value is not a match
+            (f'"other{etag}"', False),
+            (etag[:-2] + '"', False),
+            ("", False),
+        ):
+            with self.subTest(if_none_match=if_none_match):
+                response = self.get_history(HTTP_IF_NONE_MATCH=if_none_match)
+                expected = status.HTTP_304_NOT_MODIFIED if not_modified else status.HTTP_200_OK
+                self.assertEqual(response.status_code, expected)
+
+    def test_etag_changes_with_keys(self):
+        self.join()
+        etag = self.get_history()["ETag"]
+        key_management_service.generate_key_for_group(self.group)
+        response = self.get_history(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_etag_changes_with_server_key(self):
+        self.join()
+        etag = self.get_history()["ETag"]
+        self.rotate_server_key()
+        response = self.get_history(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response["ETag"], etag)
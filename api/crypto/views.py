@@ -1,12 +1,27 @@
+import hashlib
+
+from django.utils.http import parse_etags
 from rest_framework import mixins, settings, status, viewsets
+from rest_framework.decorators import action
 from rest_framework.response import Response
 
 from api.permissions import IsAuthenticated
 
 from .models import AsymmetricPublicKey, SymmetricKey
-from .serializers import AsymmetricPublicKeySerializer
-from .services.key_management_service import get_key_for_group_and_user
-from .services.rsa import generate_x509_cert_pem
+from .serializers import AsymmetricPublicKeySerializer, SymmetricKeyBatchSerializer
+from .services.key_management_service import (
+    get_key_for_group_and_user,
+    get_key_history_for_group_and_user,
+    get_keys_for_user,
+    get_wrapped_keys,
+)
+from .services.rsa import generate_x509_cert_pem, server_key_manager
+
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    """Whether an `If-None-Match` header matches an ETag, comparing weakly as the header requires"""
+    etags = parse_etags(if_none_match)
+    return etags == ["*"] or etag.removeprefix("W/") in (other.removeprefix("W/") for other in etags)
 
 
 class RSAViewSet(viewsets.ReadOnlyModelViewSet, mixins.CreateModelMixin):
@@ -51,3 +66,44 @@ class SymmetricKeyViewSet(viewsets.ReadOnlyModelViewSet):
         # returned to the client
         encrypted_key, signature, key_id = get_key_for_group_and_user(user, group)
         return Response(status=status.HTTP_200_OK, data={"key": encrypted_key, "id": key_id, "signature": signature})
+
+    @action(methods=["post"], detail=False, url_path="batch")
+    def batch(self, request, *args, **kwargs):
+        """
+        Get the latest key for many groups, or all of the user's groups if no groups are provided. The response holds a
+        base64 encoded JSON manifest of the keys and a single signature over the manifest
+        """
+        serializer = SymmetricKeyBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        manifest, signature = get_keys_for_user(request.user, serializer.validated_data.get("groups"))
+        return Response(status=status.HTTP_200_OK, data={"manifest": manifest, "signature": signature})
+
+    @action(methods=["get"], detail=False, url_path="history")
+    def history(self, request, *args, **kwargs):
+        """
+        Get a page of every key for a group that the user is entitled to, so that messages sent with older keys can be
+        decrypted. Each page has an ETag, allowing clients to cache the keys and avoid repeating the RSA work
+        """
+        group = request.GET.get("group")
+        symmetric_keys, rsa_key = get_key_history_for_group_and_user(request.user, group)
+        page = self.paginate_queryset(symmetric_keys)
+        # the response only changes if the keys in the group, the user's RSA key or the server's signing key change
+        etag_content = [str(group), str(self.paginator.page.paginator.count), str(rsa_key.pkid)]
+        etag_content.append(server_key_manager.fingerprint)
+        etag_content.extend(str(symmetric_key.id) for symmetric_key in page)
+        etag = f'"{hashlib.sha256(",".join(etag_content).encode()).hexdigest()}"'
+        if etag_matches(etag, request.headers.get("If-None-Match", "")):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        wrapped_keys = get_wrapped_keys(page, rsa_key)
+        data = [
+            {
+                "id": symmetric_key.id,
+                "key": wrapped_key.encrypted_key,
+                "signature": wrapped_key.signature,
+                "created_at": symmetric_key.created_at,
+            }
+            for symmetric_key, wrapped_key in zip(page, wrapped_keys)
+        ]
+        response = self.get_paginated_response(data)
+        response["ETag"] = etag
+        return response
@@ -0,0 +1,156 @@
+import re
+from datetime import timedelta
+from typing import Dict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import QuerySet
+from django.utils import timezone
+
+from accounts.models import User
+from crypto.models import AsymmetricPublicKey, SymmetricKey, WrappedSymmetricKey
+from messages.models import Message, MessageGroup, UserGroup
+
+# plan lines showing a query reading every row of a table, by database vendor
+SEQUENTIAL_SCANS = {
+    "postgresql": re.compile(r"Seq Scan on (\w+)"),
+    "sqlite": re.compile(r"\bSCAN (\w+)$"),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a dataset, then EXPLAIN the queries made on every key fetch, message page and websocket subscription, "
+        "failing if any of them scans a whole table. Everything is rolled back once the plans have been checked"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=2000, help="Number of users to seed")
+        parser.add_argument("--groups", type=int, default=200, help="Number of groups to seed")
+        parser.add_argument("--members", type=int, default=20, help="Number of members of each group")
+        parser.add_argument("--keys", type=int, default=10, help="Number of keys of each group")
+        parser.add_argument("--messages", type=int, default=100, help="Number of messages in each group")
+
+    def handle(self, *args, **options):
+        sequential_scan = SEQUENTIAL_SCANS.get(connection.vendor)
+        if sequential_scan is None:
+            raise CommandError(f"Query plans cannot be checked on {connection.vendor} databases")
+
+        failures = []
+        with transaction.atomic():
+            user, group = self.seed(options)
+            self.analyze()
+            for name, queryset in self.hot_queries(user, group).items():
+                plan = queryset.explain()
+                scanned = {match.group(1) for line in plan.splitlines() if (match := sequential_scan.search(line))}
+                scanned -= self.single_page_tables(scanned)
+                self.stdout.write(f"{name}:\n{plan}\n")
+                if scanned:
+                    failures.append(f"{name} scans {', '.join(sorted(scanned))}")
+            transaction.set_rollback(True)
+
+        if failures:
+            raise CommandError("Sequential scans found:\n" + "\n".join(failures))
+        self.stdout.write(self.style.SUCCESS("No sequential scans found"))
+
+    def hot_queries(self, user: User, group: MessageGroup) -> Dict[str, QuerySet]:
+        today = timezone.now().date()
+        latest_key = SymmetricKey.objects.filter(group=group).order_by("-pkid")
+        public_key = AsymmetricPublicKey.objects.filter(user=user, not_before__lte=today, not_after__gte=today)
+        return {
+            "latest group key": latest_key[:1],
+            "latest public key of user": public_key.order_by("-pkid")[:1],
+            "membership of user": user.usergroup_set.filter(group_id=group.id),
+            "members of group": UserGroup.objects.filter(group_id=group.id).values_list("user_id", flat=True),
+            "page of group messages": Message.objects.filter(group=group).order_by("-pkid")[:50],
+            "messages in a sequence range": Message.objects.filter(group=group, sequence__gt=10, sequence__lt=20),
+            "wrapped key": WrappedSymmetricKey.objects.filter(
+                symmetric_key_id=latest_key[0].id, public_key=public_key.order_by("-pkid")[0]
+            ),
+        }
+
+    def seed(self, options):
+        """Create the dataset, returning a user and a group they are a member of to query for"""
+        today = timezone.now().date()
+        users = User.objects.bulk_create(
+            User(email=f"explain-{i}@example.com", username=f"explain-{i}", first_name="Explain", last_name=str(i))
+            for i in range(options["users"])
+        )
+        AsymmetricPublicKey.objects.bulk_create(
+            AsymmetricPublicKey(
+                user=user,
+                x509_pem="certificate",
+                public_key="key",
+                not_before=today - timedelta(days=365 * (1 - age)),
+                not_after=today + timedelta(days=365 * age),
+            )
+            for user in users
+            for age in range(2)
+        )
+        groups = MessageGroup.objects.bulk_create(
+            MessageGroup(user=users[i % len(users)], group_name=f"explain-{i}", message_sequence=options["messages"])
+            for i in range(options["groups"])
+        )
+        UserGroup.objects.bulk_create(
+            UserGroup(user=users[(i + j) % len(users)], group=group)
+            for i, group in enumerate(groups)
+            for j in range(min(options["members"], len(users)))
+        )
+        keys = SymmetricKey.objects.bulk_create(
+            SymmetricKey(group=group, key=f"key-{i}-{j}")
+            for i, group in enumerate(groups)
+            for j in range(options["keys"])
+        )
+        Message.objects.bulk_create(
+            Message(
+                user=users[(i + j) % len(users)],
+                group=group,
+                key=keys[(i + 1) * options["keys"] - 1],
+                cipher_text=b"cipher text",
+                initialisation_vector=bytes(16),
+                sequence=j + 1,
+            )
+            for i, group in enumerate(groups)
+            for j in range(options["messages"])
+        )
+        public_keys = AsymmetricPublicKey.objects.filter(user__in=users[: options["members"]], not_after__gte=today)
+        WrappedSymmetricKey.objects.bulk_create(
+            WrappedSymmetricKey(
+                symmetric_key=keys[options["keys"] - 1],
+                public_key=public_key,
+                encrypted_key="key",
+                signature="signature",
+                signer_fingerprint="fingerprint",
+            )
+            for public_key in public_keys
+        )
+        return users[0], groups[0]
+
+    def single_page_tables(self, tables) -> set:
+        """
+        Tables that fit in a single page, which are read faster in full than through an index, such as the partitions
+        of months with few or no messages when the message table is partitioned
+        """
+        if connection.vendor != "postgresql" or not tables:
+            return set()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT relname FROM pg_class WHERE relname = ANY(%s) AND relpages <= 1", [list(tables)])
+            return {name for (name,) in cursor.fetchall()}
+
+    def analyze(self):
+        """Refresh the planner's statistics so that it knows the size of the seeded tables"""
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                models = (
+                    User,
+                    AsymmetricPublicKey,
+                    MessageGroup,
+                    UserGroup,
+                    SymmetricKey,
+                    Message,
+                    WrappedSymmetricKey,
+                )
+                for model in models:
+                    cursor.execute(f"ANALYZE {model._meta.db_table}")  # nosec: B608
+            else:
+                cursor.execute("ANALYZE")
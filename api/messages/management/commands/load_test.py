@@ -0,0 +1,432 @@
+import asyncio
+import base64
+import json
+import logging
+import math
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from datetime import timedelta
+from typing import Any, Awaitable, Dict, Iterable, List, Optional, Tuple
+
+import msgpack
+from asgiref.sync import sync_to_async
+from channels.layers import DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer, channel_layers
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test.utils import setup_databases, teardown_databases
+from django.utils import timezone
+
+from api.asgi import application
+from crypto.services import key_management_service
+from websockets.services.event_dispatcher import event_dispatcher
+from websockets.services.frames import MSGPACK_SUBPROTOCOL
+
+# the password of the users registered in the throwaway test database
+PASSWORD = "load-test-Pa55word!"  # nosec: B105
+# the number of failures of each phase written out in full
+MAX_REPORTED_FAILURES = 5
+
+
+class LoadTestChannelLayer(InMemoryChannelLayer):
+    """
+    The in-memory channel layer, standing in for Redis. Events are published from the event dispatcher's own thread
+    and loop, while the in-memory layer is not thread safe, so sends are handed over to the loop the consumers run on
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, **kwargs):
+        super().__init__(**kwargs)
+        self.loop = loop
+
+    async def send(self, channel, message):
+        await self._on_loop(super().send(channel, message))
+
+    async def group_send(self, group, message):
+        await self._on_loop(super().group_send(group, message))
+
+    async def _on_loop(self, coroutine: Awaitable) -> None:
+        if asyncio.get_running_loop() is self.loop:
+            await coroutine
+        else:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.loop))
+
+
+@dataclass
+class LoadUser:
+    email: str
+    token: str = ""
+    id: str = ""
+    # the id of the latest key fetched for each of the user's groups
+    keys: Dict[str, str] = field(default_factory=dict)
+
+
+class Stats:
+    """
+    Latency samples in seconds and error counts of each operation, with the wall clock time of each phase and the
+    number of its tasks that failed
+    """
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.durations: Dict[str, float] = {}
+        self.failures: Dict[str, int] = defaultdict(int)
+
+    def record(self, operation: str, seconds: float, ok: bool = True) -> None:
+        self.samples[operation].append(seconds)
+        if not ok:
+            self.errors[operation] += 1
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        summary = {}
+        for operation, samples in self.samples.items():
+            samples = sorted(samples)
+            duration = self.durations.get(operation)
+            summary[operation] = {
+                "count": len(samples),
+                "errors": self.errors[operation],
+                "p50_ms": percentile(samples, 50) * 1000,
+                "p95_ms": percentile(samples, 95) * 1000,
+                "p99_ms": percentile(samples, 99) * 1000,
+                "max_ms": samples[-1] * 1000,
+                "per_second": len(samples) / duration if duration else 0.0,
+            }
+        return summary
+
+
+def percentile(samples: List[float], percent: float) -> float:
+    """The nearest-rank percentile of sorted samples"""
+    if not samples:
+        return 0.0
+    return samples[max(math.ceil(percent / 100 * len(samples)) - 1, 0)]
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate load against the API and websockets, reporting the p50/p95/p99 latency and throughput of each "
+        "operation and the delay between a message being posted and each websocket connection receiving it. Users are "
+        "registered, upload RSA keys, create groups, fetch group keys and post messages while holding websocket "
+        "connections open. Requests are driven through the ASGI application in this process, as daphne would, against "
+        "a throwaway test database and an in-memory channel layer standing in for Redis"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=20, help="Number of users to register")
+        parser.add_argument("--groups", type=int, default=5, help="Number of groups to create")
+        parser.add_argument("--members", type=int, default=5, help="Number of members of each group")
+        parser.add_argument("--connections", type=int, default=None, help="Websocket connections, one per member")
+        parser.add_argument("--messages", type=int, default=200, help="Number of messages to post")
+        parser.add_argument("--concurrency", type=int, default=10, help="Number of requests in flight at once")
+        parser.add_argument("--msgpack", action="store_true", help="Connect websockets with the msgpack subprotocol")
+        parser.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for each response")
+        parser.add_argument("--drain-timeout", type=float, default=10.0, help="Seconds to wait for deliveries")
+        parser.add_argument("--output", default=None, help="Write the report to this file as JSON")
+
+    def handle(self, *args, **options):
+        if min(options["users"], options["groups"], options["members"]) < 1:
+            raise CommandError("At least one user, group and member of each group are needed")
+        if options["members"] > options["users"]:
+            raise CommandError("Groups cannot have more members than there are users")
+        self.options = options
+        self.stats = Stats()
+        # every request would otherwise be logged, which would dominate the run, while failures are reported below
+        logging.disable(logging.WARNING)
+        database = connections["default"].settings_dict
+        # connections are closed after each request, so that none are left open when the test database is dropped
+        database["CONN_MAX_AGE"] = 0
+        if connections["default"].vendor == "sqlite":
+            # each request runs in its own thread, which would lock the others out of a shared in-memory database, and
+            # concurrent transactions deadlock on SQLite's single write lock, so requests are sent one at a time
+            database["TEST"]["NAME"] = os.path.join(tempfile.gettempdir(), f"load_test_{os.getpid()}.sqlite3")
+            options["concurrency"] = 1
+            self.stdout.write(self.style.WARNING("SQLite allows a single writer, so requests are sent one at a time"))
+        old_config = setup_databases(verbosity=0, interactive=False, aliases={"default"}, serialized_aliases=set())
+        try:
+            report = asyncio.run(self.run())
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            logging.disable(logging.NOTSET)
+        self.write_report(report)
+
+    async def run(self) -> Dict[str, Any]:
+        previous_layer = channel_layers.set(DEFAULT_CHANNEL_LAYER, LoadTestChannelLayer(asyncio.get_running_loop()))
+        try:
+            return await self.scenario()
+        finally:
+            # keys are wrapped for new members in the background, and their events must be sent before the loop closes
+            await sync_to_async(key_management_service.wait_for_background)(self.options["drain_timeout"])
+            await sync_to_async(event_dispatcher.flush)(self.options["drain_timeout"])
+            channel_layers.set(DEFAULT_CHANNEL_LAYER, previous_layer)
+            # the test database cannot be dropped while the connection of the thread running the views is open
+            await sync_to_async(connections.close_all)()
+
+    async def scenario(self) -> Dict[str, Any]:
+        options = self.options
+        users = [LoadUser(email=f"load-{index}@example.com") for index in range(options["users"])]
+        # generating RSA keys is client side work, so is done once up front rather than being timed
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+        await self.phase("register", [self.register(user) for user in users])
+        await self.phase("login", [self.login(user) for user in users])
+        await self.phase("upload rsa key", [self.upload_rsa_key(user, private_key) for user in users])
+
+        memberships: Dict[str, List[LoadUser]] = {}
+        creators = [users[(index * options["members"]) % len(users)] for index in range(options["groups"])]
+        group_ids = await self.phase(
+            "create group", [self.create_group(user, index) for index, user in enumerate(creators)]
+        )
+        for index, group_id in enumerate(group_ids):
+            if group_id is None:
+                continue
+            start = index * options["members"]
+            memberships[group_id] = [users[(start + offset) % len(users)] for offset in range(options["members"])]
+        if not memberships:
+            raise CommandError("No groups could be created, so there is nothing to load")
+        await self.phase(
+            "add members",
+            [self.add_members(members[0], group_id, members[1:]) for group_id, members in memberships.items()],
+        )
+        await self.phase(
+            "fetch group key",
+            [self.fetch_key(user, group_id) for group_id, members in memberships.items() for user in members],
+        )
+
+        # connections are spread over every membership in turn
+        pairs = [(group_id, user) for group_id, members in memberships.items() for user in members]
+        connection_count = options["connections"] if options["connections"] is not None else len(pairs)
+        pairs = [pairs[index % len(pairs)] for index in range(connection_count)]
+        sockets = await self.phase("websocket connect", [self.connect(user, group_id) for group_id, user in pairs])
+        self.listeners: Dict[str, int] = defaultdict(int)
+        for (group_id, _), socket in zip(pairs, sockets):
+            if socket is not None:
+                self.listeners[group_id] += 1
+        sockets = [socket for socket in sockets if socket is not None]
+
+        self.sent_at: Dict[str, float] = {}
+        self.deliveries: List[float] = []
+        self.expected = 0
+        self.delivered = asyncio.Event()
+        receivers = [asyncio.create_task(self.receive(socket)) for socket in sockets]
+        try:
+            group_list = list(memberships)
+            posts = []
+            for index in range(options["messages"]):
+                group_id = group_list[index % len(group_list)]
+                self.expected += self.listeners[group_id]
+                # the author only spreads the load, so need not be chosen securely
+                posts.append(self.post_message(random.choice(memberships[group_id]), group_id, index))  # nosec: B311
+            await self.phase("post message", posts)
+            await sync_to_async(event_dispatcher.flush)(options["drain_timeout"])
+            if len(self.deliveries) < self.expected:
+                try:
+                    await asyncio.wait_for(self.delivered.wait(), options["drain_timeout"])
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            for receiver in receivers:
+                receiver.cancel()
+            await asyncio.gather(*receivers, return_exceptions=True)
+            await asyncio.gather(*(socket.disconnect() for socket in sockets), return_exceptions=True)
+
+        deliveries = sorted(self.deliveries)
+        return {
+            "options": {
+                key: options[key] for key in ("users", "groups", "members", "messages", "concurrency", "msgpack")
+            },
+            "connections": len(sockets),
+            "operations": self.stats.summary(),
+            "fan_out": {
+                "expected": self.expected,
+                "delivered": len(deliveries),
+                "p50_ms": percentile(deliveries, 50) * 1000,
+                "p95_ms": percentile(deliveries, 95) * 1000,
+                "p99_ms": percentile(deliveries, 99) * 1000,
+                "max_ms": (deliveries[-1] if deliveries else 0.0) * 1000,
+            },
+            "failures": dict(self.stats.failures),
+            "dispatcher": event_dispatcher.stats(),
+        }
+
+    async def phase(self, operation: str, coroutines: Iterable[Awaitable]) -> list:
+        """
+        Run the coroutines of a phase with at most `--concurrency` in flight, timing the phase as a whole. A failed
+        coroutine does not stop the others, with its error reported and `None` returned in place of its result
+        """
+        semaphore = asyncio.Semaphore(self.options["concurrency"])
+
+        async def limited(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(limited(coroutine) for coroutine in coroutines), return_exceptions=True)
+        self.stats.durations[operation] = time.perf_counter() - started
+        failures = [result for result in results if isinstance(result, Exception)]
+        if failures:
+            self.stats.failures[operation] += len(failures)
+            # the same error is usually repeated by every task, so only the first few are shown
+            for failure in failures[:MAX_REPORTED_FAILURES]:
+                self.stderr.write(f"{operation}: {str(failure) or repr(failure)}")
+            if len(failures) > MAX_REPORTED_FAILURES:
+                self.stderr.write(f"{operation}: {len(failures) - MAX_REPORTED_FAILURES} more failures")
+        return [None if isinstance(result, Exception) else result for result in results]
+
+    async def request(
+        self, operation: str, method: str, path: str, user: Optional[LoadUser] = None, body: Any = None
+    ) -> Dict[str, Any]:
+        headers = [(b"host", b"localhost"), (b"content-type", b"application/json"), (b"accept", b"application/json")]
+        if user is not None and user.token:
+            headers.append((b"authorization", f"Bearer {user.token}".encode()))
+        content = json.dumps(body).encode() if body is not None else b""
+        headers.append((b"content-length", str(len(content)).encode()))
+        communicator = HttpCommunicator(application, method, path, content, headers)
+        started = time.perf_counter()
+        response = await communicator.get_response(timeout=self.options["timeout"])
+        # the application finishes once the client disconnects
+        await communicator.send_input({"type": "http.disconnect"})
+        await communicator.wait(self.options["timeout"])
+        ok = response["status"] < 400
+        self.stats.record(operation, time.perf_counter() - started, ok)
+        if not ok:
+            raise CommandError(f"{method} {path} failed with {response['status']}: {response['body'][:200]!r}")
+        return json.loads(response["body"]) if response["body"] else {}
+
+    async def register(self, user: LoadUser) -> None:
+        body = {
+            "first_name": "Load",
+            "last_name": user.email.split("@")[0],
+            "email": user.email,
+            "password": PASSWORD,
+            "confirm_password": PASSWORD,
+        }
+        await self.request("register", "POST", "/accounts/register/", body=body)
+
+    async def login(self, user: LoadUser) -> None:
+        tokens = await self.request(
+            "login", "POST", "/accounts/login/", body={"email": user.email, "password": PASSWORD}
+        )
+        user.token = tokens["access"]
+        payload = user.token.split(".")[1]
+        user.id = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))["id"]
+
+    async def upload_rsa_key(self, user: LoadUser, private_key: rsa.RSAPrivateKey) -> None:
+        name = x509.Name([x509.NameAttribute(x509.oid.NameOID.COMMON_NAME, user.email)])
+        now = timezone.now()
+        certificate = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(private_key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - timedelta(days=1))
+            .not_valid_after(now + timedelta(days=30))
+            .sign(private_key, hashes.SHA256())
+        )
+        body = {
+            "x509_pem": certificate.public_bytes(serialization.Encoding.PEM).decode(),
+            "public_key": private_key.public_key()
+            .public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+            .decode(),
+        }
+        await self.request("upload rsa key", "POST", "/crypto/rsa/", user, body)
+
+    async def create_group(self, user: LoadUser, index: int) -> str:
+        group = await self.request("create group", "POST", "/messages/groups/", user, {"group_name": f"load-{index}"})
+        return group["id"]
+
+    async def add_members(self, user: LoadUser, group_id: str, members: List[LoadUser]) -> None:
+        if members:
+            body = {"add": [member.id for member in members]}
+            await self.request("add members", "POST", f"/messages/groups/{group_id}/users/bulk/", user, body)
+
+    async def fetch_key(self, user: LoadUser, group_id: str) -> None:
+        key = await self.request("fetch group key", "GET", f"/crypto/aes/?group={group_id}", user)
+        user.keys[group_id] = key["id"]
+
+    async def connect(self, user: LoadUser, group_id: str) -> WebsocketCommunicator:
+        subprotocols = [MSGPACK_SUBPROTOCOL] if self.options["msgpack"] else None
+        socket = WebsocketCommunicator(
+            application, f"/websockets/messages/{group_id}/?token={user.token}", subprotocols=subprotocols
+        )
+        started = time.perf_counter()
+        connected, _ = await socket.connect(timeout=self.options["timeout"])
+        self.stats.record("websocket connect", time.perf_counter() - started, connected)
+        if not connected:
+            raise CommandError(f"Websocket connection to group {group_id} was refused")
+        return socket
+
+    async def post_message(self, user: LoadUser, group_id: str, index: int) -> None:
+        # the cipher text is opaque to the server, so it carries the index of the message to match deliveries to it
+        body = {
+            "cipher_text": base64.b64encode(str(index).encode()).decode(),
+            "initialisation_vector": base64.b64encode(os.urandom(16)).decode(),
+        }
+        # the user has no key if fetching it failed, in which case the message is sent without one
+        if group_id in user.keys:
+            body["key"] = user.keys[group_id]
+        self.sent_at[str(index)] = time.perf_counter()
+        try:
+            await self.request("post message", "POST", f"/messages/groups/{group_id}/messages/", user, body)
+        except Exception:
+            # a message that was not created will never be delivered
+            self.expected -= self.listeners[group_id]
+            raise
+
+    async def receive(self, socket: WebsocketCommunicator) -> None:
+        """Record the delay between each message being posted and this connection receiving it"""
+        while True:
+            output = await socket.receive_output(timeout=None)
+            if output["type"] != "websocket.send":
+                return
+            received_at = time.perf_counter()
+            frame, cipher_text = self.decode_frame(output)
+            if frame.get("type") != "new_message":
+                continue
+            sent_at = self.sent_at.get(cipher_text.decode())
+            if sent_at is not None:
+                self.deliveries.append(received_at - sent_at)
+                if len(self.deliveries) >= self.expected:
+                    self.delivered.set()
+
+    @staticmethod
+    def decode_frame(output: Dict[str, Any]) -> Tuple[Dict[str, Any], bytes]:
+        """The content of a frame, along with the cipher text of the message it holds, if any"""
+        if output.get("bytes") is not None:
+            frame = msgpack.unpackb(output["bytes"], raw=False)
+            message = frame.get("message")
+            return frame, message["cipher_text"] if isinstance(message, dict) else b""
+        frame = json.loads(output["text"])
+        message = frame.get("message")
+        return frame, base64.b64decode(message["cipher_text"]) if isinstance(message, dict) else b""
+
+    def write_report(self, report: Dict[str, Any]) -> None:
+        self.stdout.write(
+            f"{'operation':<20}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}"
+        )
+        for operation, summary in report["operations"].items():
+            self.stdout.write(
+                f"{operation:<20}{summary['count']:>8}{summary['errors']:>8}{summary['p50_ms']:>10.1f}"
+                f"{summary['p95_ms']:>10.1f}{summary['p99_ms']:>10.1f}{summary['per_second']:>10.1f}"
+            )
+        fan_out = report["fan_out"]
+        self.stdout.write(
+            f"fan-out to {report['connections']} connections: {fan_out['delivered']}/{fan_out['expected']} delivered, "
+            f"p50 {fan_out['p50_ms']:.1f} ms, p95 {fan_out['p95_ms']:.1f} ms, p99 {fan_out['p99_ms']:.1f} ms"
+        )
+        if self.options["output"]:
+            with open(self.options["output"], "w") as output_file:
+                json.dump(report, output_file, indent=2)
+        if report["failures"]:
+            failures = ", ".join(f"{count} {operation}" for operation, count in report["failures"].items())
+            self.stdout.write(self.style.WARNING(f"Some operations failed: {failures}"))
+        if fan_out["delivered"] < fan_out["expected"]:
+            self.stdout.write(self.style.WARNING("Some messages were not delivered to every connection"))
+        elif not report["failures"]:
+            self.stdout.write(self.style.SUCCESS("Load test complete"))
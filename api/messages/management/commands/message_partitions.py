@@ -0,0 +1,56 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from api import settings
+from messages.services import archive, partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the monthly partitions of the message table ahead of time and, with --archive-after, archive "
+        "partitions older than the given number of months to compressed files before dropping them. Archived messages "
+        "are still returned when paging through a group's history"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--months-ahead", type=int, default=3, help="Number of future months to create")
+        parser.add_argument(
+            "--archive-after", type=int, default=None, help="Archive partitions ending this many months ago or more"
+        )
+        parser.add_argument(
+            "--archive-dir", default=settings.MESSAGE_ARCHIVE_DIR, help="Directory to write archived partitions to"
+        )
+
+    def handle(self, *args, **options):
+        if not partitions.is_partitioned():
+            raise CommandError("The message table is not partitioned, which is only supported with PostgreSQL")
+
+        this_month = timezone.now().date().replace(day=1)
+        for months in range(options["months_ahead"] + 1):
+            with transaction.atomic():
+                partition = partitions.create_partition(partitions.add_months(this_month, months))
+            if partition is not None:
+                self.stdout.write(f"Created {partition.name}")
+
+        if options["archive_after"] is not None:
+            self.archive(this_month, options["archive_after"], options["archive_dir"])
+        self.stdout.write(self.style.SUCCESS("Message partitions are up to date"))
+
+    def archive(self, this_month, archive_after: int, archive_dir: str):
+        cutoff = partitions.month_partition(partitions.add_months(this_month, -archive_after)).start
+        for partition in partitions.list_partitions():
+            if partition.end > cutoff:
+                continue
+            # once detached, messages created in the partition's range are caught by the default partition, rather
+            # than being dropped with the partition without having been archived
+            with transaction.atomic():
+                partitions.detach_partition(partition)
+            try:
+                archived = archive.archive_partition(partition, archive_dir)
+            except BaseException:
+                with transaction.atomic():
+                    partitions.attach_partition(partition)
+                raise
+            partitions.drop_partition(partition)
+            self.stdout.write(f"Archived {archived} messages from {partition.name} and dropped the partition")
@@ -0,0 +1,74 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import settings
+from crypto.models import AsymmetricPublicKey, SymmetricKey
+from crypto.services import key_management_service
+from messages.models import Message, MessageGroup
+from messages.services import retention
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete messages older than their group's retention period, group keys that have been superseded and are no "
+        "longer needed, and public keys whose certificates have expired. Rows are deleted in small batches of "
+        "consecutive pkids, each in its own transaction, without sending signals. Keys are only deleted once the "
+        "archive has been found, as archived messages may still need them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Number of rows deleted in each transaction")
+        parser.add_argument("--pause", type=float, default=0.1, help="Seconds to wait between batches")
+        parser.add_argument("--dry-run", action="store_true", help="Count the rows that would be deleted")
+        parser.add_argument(
+            "--archive-dir", default=settings.MESSAGE_ARCHIVE_DIR, help="Directory holding archived partitions"
+        )
+
+    def handle(self, *args, **options):
+        batch_size, pause, archive_dir = options["batch_size"], options["pause"], options["archive_dir"]
+        if not os.path.isdir(archive_dir):
+            # without the archive, keys still encrypting archived messages cannot be told apart from unused ones
+            raise CommandError(
+                f"The archive directory {archive_dir} does not exist. Pass the directory partitions are archived to "
+                "with --archive-dir, or create it if no partitions have been archived"
+            )
+        if options["dry_run"]:
+            groups = MessageGroup.objects.filter(retention_days__isnull=False)
+            messages = sum(retention.expired_messages(group).count() for group in groups)
+            self.stdout.write(f"{messages} {Message._meta.verbose_name_plural} would be deleted")
+            for queryset in (
+                key_management_service.superseded_symmetric_keys(archive_dir),
+                key_management_service.expired_public_keys(),
+            ):
+                self.stdout.write(f"{queryset.count()} {queryset.model._meta.verbose_name_plural} would be deleted")
+            return
+
+        messages = retention.purge_expired_messages(batch_size, pause, self.group_progress, archive_dir)
+        self.stdout.write(f"Deleted {messages['database']} messages and {messages['archive']} archived messages")
+        symmetric_keys = retention.delete_in_batches(
+            key_management_service.superseded_symmetric_keys(archive_dir),
+            batch_size,
+            pause,
+            progress=self.progress(SymmetricKey),
+        )
+        self.stdout.write(f"Deleted {symmetric_keys} superseded {SymmetricKey._meta.verbose_name_plural}")
+        public_keys = retention.delete_in_batches(
+            key_management_service.expired_public_keys(),
+            batch_size,
+            pause,
+            progress=self.progress(AsymmetricPublicKey),
+        )
+        self.stdout.write(f"Deleted {public_keys} expired {AsymmetricPublicKey._meta.verbose_name_plural}")
+        self.stdout.write(self.style.SUCCESS("Purge complete"))
+
+    def group_progress(self, group: MessageGroup, deleted: int, remaining: int, rate: float):
+        self.stdout.write(f"  group {group.id}: {deleted} deleted, {remaining} remaining, {rate:.0f} rows/s")
+
+    def progress(self, model):
+        def report(deleted: int, remaining: int, rate: float):
+            self.stdout.write(
+                f"  {model._meta.verbose_name_plural}: {deleted} deleted, {remaining} remaining, {rate:.0f} rows/s"
+            )
+
+        return report
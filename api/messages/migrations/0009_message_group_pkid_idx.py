@@ -0,0 +1,20 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:37
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("crypto", "0003_wrappedsymmetrickey"),
+        ("custom_messages", "0008_message_key"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(fields=["group", "-pkid"], name="message_group_pkid_idx"),
+        ),
+    ]
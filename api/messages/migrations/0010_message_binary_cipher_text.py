@@ -0,0 +1,92 @@
+# Generated by Django 5.0.3 on 2026-10-18 18:02
+
+import base64
+import binascii
+import string
+
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+
+def _decode_cipher_text(value: str) -> bytes:
+    try:
+        return base64.b64decode(value, validate=True)
+    except (binascii.Error, ValueError):
+        # keep whatever was stored rather than losing it
+        return value.encode()
+
+
+def _decode_initialisation_vector(value: str) -> bytes:
+    # older rows may hold a hex encoded vector, the client sends base64
+    if len(value) == 32 and all(c in string.hexdigits for c in value):
+        return bytes.fromhex(value)
+    return _decode_cipher_text(value)
+
+
+def copy_to_binary(apps, schema_editor):
+    Message = apps.get_model("custom_messages", "Message")
+    last_pkid = 0
+    while True:
+        batch = list(
+            Message.objects.filter(pkid__gt=last_pkid)
+            .order_by("pkid")
+            .only("pkid", "cipher_text", "initialisation_vector")[:BATCH_SIZE]
+        )
+        if not batch:
+            return
+        for message in batch:
+            message.cipher_text_binary = _decode_cipher_text(message.cipher_text)
+            message.initialisation_vector_binary = _decode_initialisation_vector(message.initialisation_vector)
+        Message.objects.bulk_update(batch, ["cipher_text_binary", "initialisation_vector_binary"])
+        last_pkid = batch[-1].pkid
+
+
+def copy_to_text(apps, schema_editor):
+    Message = apps.get_model("custom_messages", "Message")
+    last_pkid = 0
+    while True:
+        batch = list(
+            Message.objects.filter(pkid__gt=last_pkid)
+            .order_by("pkid")
+            .only("pkid", "cipher_text_binary", "initialisation_vector_binary")[:BATCH_SIZE]
+        )
+        if not batch:
+            return
+        for message in batch:
+            message.cipher_text = base64.b64encode(bytes(message.cipher_text_binary)).decode()
+            message.initialisation_vector = base64.b64encode(bytes(message.initialisation_vector_binary)).decode()
+        Message.objects.bulk_update(batch, ["cipher_text", "initialisation_vector"])
+        last_pkid = batch[-1].pkid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("custom_messages", "0009_message_group_pkid_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="cipher_text_binary",
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name="message",
+            name="initialisation_vector_binary",
+            field=models.BinaryField(max_length=16, null=True),
+        ),
+        # the text columns are made nullable so that they can be dropped and, when reversing, restored and repopulated
+        migrations.AlterField(
+            model_name="message",
+            name="cipher_text",
+            field=models.TextField(null=True),
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="initialisation_vector",
+            field=models.CharField(max_length=32, null=True),
+        ),
+        migrations.RunPython(copy_to_binary, copy_to_text, elidable=True),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.0.3 on 2026-10-18 18:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("custom_messages", "0010_message_binary_cipher_text"),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name="message",
+            name="cipher_text",
+        ),
+        migrations.RemoveField(
+            model_name="message",
+            name="initialisation_vector",
+        ),
+        migrations.RenameField(
+            model_name="message",
+            old_name="cipher_text_binary",
+            new_name="cipher_text",
+        ),
+        migrations.RenameField(
+            model_name="message",
+            old_name="initialisation_vector_binary",
+            new_name="initialisation_vector",
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="cipher_text",
+            field=models.BinaryField(editable=True),
+        ),
+        migrations.AlterField(
+            model_name="message",
+            name="initialisation_vector",
+            field=models.BinaryField(editable=True, max_length=16),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.0.3 on 2026-10-18 19:40
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+
+def remove_duplicate_memberships(apps, schema_editor):
+    """Keep the earliest membership of each user and group, so that the pair can be made unique"""
+    UserGroup = apps.get_model("custom_messages", "UserGroup")
+    duplicates = (
+        UserGroup.objects.values("user_id", "group_id")
+        .annotate(first_pkid=Min("pkid"), memberships=Count("pkid"))
+        .filter(memberships__gt=1)
+    )
+    for duplicate in duplicates.iterator():
+        UserGroup.objects.filter(user_id=duplicate["user_id"], group_id=duplicate["group_id"]).exclude(
+            pkid=duplicate["first_pkid"]
+        ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("custom_messages", "0011_message_binary_cipher_text_swap"),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_memberships, migrations.RunPython.noop, elidable=True),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:48
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("custom_messages", "0012_dedupe_usergroup"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name="usergroup",
+            constraint=models.UniqueConstraint(fields=("user", "group"), name="unique_user_group"),
+        ),
+    ]
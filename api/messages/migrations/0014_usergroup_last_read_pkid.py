@@ -0,0 +1,29 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:50
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def mark_existing_messages_read(apps, schema_editor):
+    """Existing members start with the messages sent before read receipts were tracked read, rather than unread"""
+    Message = apps.get_model("custom_messages", "Message")
+    UserGroup = apps.get_model("custom_messages", "UserGroup")
+    latest = Message.objects.filter(group_id=OuterRef("group_id")).order_by("-pkid").values("pkid")[:1]
+    UserGroup.objects.update(last_read_pkid=Coalesce(Subquery(latest), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("custom_messages", "0013_usergroup_unique_user_group"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="usergroup",
+            name="last_read_pkid",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(mark_existing_messages_read, migrations.RunPython.noop, elidable=True),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:51
+
+from django.db import migrations, models
+
+BATCH_SIZE = 2000
+
+
+def number_messages(apps, schema_editor):
+    """Number each group's existing messages in the order they were created"""
+    Message = apps.get_model("custom_messages", "Message")
+    MessageGroup = apps.get_model("custom_messages", "MessageGroup")
+    for group in MessageGroup.objects.only("pkid", "id").iterator():
+        sequence = 0
+        while True:
+            batch = list(
+                Message.objects.filter(group_id=group.id, sequence__isnull=True)
+                .order_by("pkid")
+                .only("pkid")[:BATCH_SIZE]
+            )
+            if not batch:
+                break
+            for message in batch:
+                sequence += 1
+                message.sequence = sequence
+            Message.objects.bulk_update(batch, ["sequence"])
+        MessageGroup.objects.filter(pkid=group.pkid).update(message_sequence=sequence)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("custom_messages", "0014_usergroup_last_read_pkid"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="message",
+            name="sequence",
+            field=models.BigIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="messagegroup",
+            name="message_sequence",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(number_messages, migrations.RunPython.noop, elidable=True),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.0.3 on 2026-10-18 15:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("custom_messages", "0015_message_sequence"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="message",
+            name="sequence",
+            field=models.BigIntegerField(),
+        ),
+        migrations.AddConstraint(
+            model_name="message",
+            constraint=models.UniqueConstraint(fields=("group", "sequence"), name="unique_message_group_sequence"),
+        ),
+    ]
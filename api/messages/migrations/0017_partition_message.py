@@ -0,0 +1,135 @@
+# Generated by Django 5.0.3 on 2026-10-18 16:20
+
+from datetime import timedelta
+
+from django.db import migrations
+
+# months of partitions created ahead of the current month, see the `message_partitions` command
+MONTHS_AHEAD = 3
+
+
+def _tables(apps):
+    return {
+        "message": apps.get_model("custom_messages", "Message")._meta.db_table,
+        "group": apps.get_model("custom_messages", "MessageGroup")._meta.db_table,
+        "user": apps.get_model("accounts", "User")._meta.db_table,
+        "key": apps.get_model("crypto", "SymmetricKey")._meta.db_table,
+    }
+
+
+def _add_partition_unique_indexes(cursor, partition: str):
+    """
+    The unique keys of a partitioned table must include the partition key, which would no longer make `id` or
+    `(group, sequence)` unique, so they are instead enforced within each partition. Matches
+    `messages.services.partitions.add_unique_indexes`
+    """
+    cursor.execute(f"CREATE UNIQUE INDEX {partition}_id_key ON {partition} (id)")
+    cursor.execute(f"CREATE UNIQUE INDEX {partition}_group_sequence_key ON {partition} (group_id, sequence)")
+
+
+def partition_messages(apps, schema_editor):
+    """
+    Move messages into a table partitioned by month of creation. Only PostgreSQL supports partitioned tables.
+
+    The database no longer guarantees that `id` and `(group, sequence)` are unique across partitions, only within
+    each of them. Ids are random UUIDs and sequence numbers are only handed out by the group's counter, which
+    `messages.services.sequences.allocate_sequences` checks against the messages already in the group
+    """
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    tables = _tables(apps)
+    message = tables["message"]
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {message} IN ACCESS EXCLUSIVE MODE")
+        cursor.execute(f"ALTER TABLE {message} RENAME TO {message}_unpartitioned")
+        cursor.execute(
+            f"CREATE TABLE {message} (LIKE {message}_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)"
+        )
+        # a partition for every month with messages, up to the months ahead, with anything else caught by the default.
+        # Only the table's name and the constant number of months are interpolated, never user input
+        cursor.execute(
+            "SELECT month FROM generate_series("  # nosec: B608
+            f"  date_trunc('month', COALESCE((SELECT MIN(created_at) FROM {message}_unpartitioned), now())),"
+            f"  date_trunc('month', now()) + interval '{MONTHS_AHEAD} months',"
+            "  interval '1 month'"
+            ") AS month"
+        )
+        partitions = []
+        for (month,) in cursor.fetchall():
+            next_month = (month + timedelta(days=32)).replace(day=1)
+            partition = f"{message}_p{month:%Y_%m}"
+            cursor.execute(
+                f"CREATE TABLE {partition} PARTITION OF {message} "
+                f"FOR VALUES FROM ('{month.isoformat()}') TO ('{next_month.isoformat()}')"
+            )
+            partitions.append(partition)
+        cursor.execute(f"CREATE TABLE {message}_default PARTITION OF {message} DEFAULT")
+        partitions.append(f"{message}_default")
+        # the table names come from the model rather than user input, so are safe to interpolate
+        cursor.execute(f"INSERT INTO {message} SELECT * FROM {message}_unpartitioned")  # nosec: B608
+        cursor.execute(f"SELECT COALESCE(MAX(pkid), 0) + 1 FROM {message}_unpartitioned")  # nosec: B608
+        (next_pkid,) = cursor.fetchone()
+        # dropping the old table also drops its identity sequence and constraints, freeing their names
+        cursor.execute(f"DROP TABLE {message}_unpartitioned")
+        # identity columns are not supported by partitioned tables, so the primary key is drawn from a sequence
+        cursor.execute(f"CREATE SEQUENCE {message}_pkid_seq OWNED BY {message}.pkid")
+        cursor.execute(f"SELECT setval('{message}_pkid_seq', %s, false)", [next_pkid])
+        cursor.execute(f"ALTER TABLE {message} ALTER COLUMN pkid SET DEFAULT nextval('{message}_pkid_seq')")
+        # pkids are drawn from the sequence, so the primary key including `created_at` still identifies each row
+        cursor.execute(f"ALTER TABLE {message} ADD CONSTRAINT {message}_pkey PRIMARY KEY (pkid, created_at)")
+        for partition in partitions:
+            _add_partition_unique_indexes(cursor, partition)
+        # `message_group_pkid_idx` also serves as the index of the group foreign key
+        cursor.execute(f"CREATE INDEX message_group_pkid_idx ON {message} (group_id, pkid DESC)")
+        cursor.execute(f"CREATE INDEX {message}_user_id_idx ON {message} (user_id)")
+        cursor.execute(f"CREATE INDEX {message}_key_id_idx ON {message} (key_id)")
+        for column, table in (("user_id", tables["user"]), ("key_id", tables["key"]), ("group_id", tables["group"])):
+            cursor.execute(
+                f"ALTER TABLE {message} ADD CONSTRAINT {message}_{column}_fk FOREIGN KEY ({column}) "
+                f"REFERENCES {table} (id) DEFERRABLE INITIALLY DEFERRED"
+            )
+
+
+def unpartition_messages(apps, schema_editor):
+    """
+    Move messages back into a single table, including any in partitions that have not been archived. The table is
+    recreated from the model, so that its constraints and indexes have the names Django gave them originally
+    """
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    model = apps.get_model("custom_messages", "Message")
+    message = model._meta.db_table
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"LOCK TABLE {message} IN ACCESS EXCLUSIVE MODE")
+        cursor.execute(f"ALTER TABLE {message} RENAME TO {message}_partitioned")
+        # free the names the recreated table uses
+        cursor.execute(f"ALTER TABLE {message}_partitioned DROP CONSTRAINT {message}_pkey")
+        cursor.execute(f"ALTER TABLE {message}_partitioned ALTER COLUMN pkid DROP DEFAULT")
+        cursor.execute(f"DROP SEQUENCE {message}_pkid_seq")
+        cursor.execute("DROP INDEX message_group_pkid_idx")
+    schema_editor.create_model(model)
+    columns = ", ".join(schema_editor.quote_name(field.column) for field in model._meta.local_concrete_fields)
+    with schema_editor.connection.cursor() as cursor:
+        # the table and column names come from the model rather than user input, so are safe to interpolate
+        cursor.execute(
+            f"INSERT INTO {message} ({columns}) OVERRIDING SYSTEM VALUE "  # nosec: B608
+            f"SELECT {columns} FROM {message}_partitioned"
+        )
+        cursor.execute(f"DROP TABLE {message}_partitioned CASCADE")
+        cursor.execute(
+            f"SELECT setval(pg_get_serial_sequence('{message}', 'pkid'), "  # nosec: B608
+            f"COALESCE(MAX(pkid), 0) + 1, false) FROM {message}"
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("accounts", "0001_initial"),
+        ("crypto", "0004_symmetrickey_asymmetricpublickey_indexes"),
+        ("custom_messages", "0016_message_sequence_unique"),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_messages, unpartition_messages),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.0.3 on 2026-10-18 16:00
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("custom_messages", "0017_partition_message"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="messagegroup",
+            name="retention_days",
+            field=models.PositiveIntegerField(
+                blank=True, null=True, validators=[django.core.validators.MinValueValidator(1)]
+            ),
+        ),
+    ]
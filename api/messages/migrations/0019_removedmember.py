@@ -0,0 +1,35 @@
+# Generated by Django 5.0.3 on 2026-10-18 16:34
+
+import uuid
+
+import django.utils.timezone
+import model_utils.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("custom_messages", "0018_messagegroup_retention_days"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RemovedMember",
+            fields=[
+                ("pkid", models.BigAutoField(primary_key=True, serialize=False)),
+                ("id", models.UUIDField(default=uuid.uuid4, editable=False, unique=True)),
+                ("created_at", model_utils.fields.AutoCreatedField(default=django.utils.timezone.now, editable=False)),
+                (
+                    "updated_at",
+                    model_utils.fields.AutoLastModifiedField(default=django.utils.timezone.now, editable=False),
+                ),
+                ("group_id", models.UUIDField()),
+                ("user_id", models.UUIDField()),
+            ],
+            options={
+                "ordering": ("-pkid",),
+                "indexes": [models.Index(fields=["group_id", "pkid"], name="removed_member_group_pkid_idx")],
+            },
+        ),
+    ]
@@ -1,4 +1,5 @@
-from django.db import models
+from django.core.validators import MinValueValidator
+from django.db import models, transaction
 
 from api import settings
 from api.models import BaseModel
@@ -7,6 +8,10 @@ from api.models import BaseModel
 class MessageGroup(BaseModel):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, to_field="id")
     group_name = models.CharField(max_length=255)
+    # the sequence number of the latest message in the group, see `messages.services.sequences`
+    message_sequence = models.BigIntegerField(null=False, default=0)
+    # messages older than this many days are deleted by the `purge_expired` command, with no limit when not set
+    retention_days = models.PositiveIntegerField(null=True, blank=True, validators=(MinValueValidator(1),))
 
     class Meta:
         ordering = ("-pkid",)
@@ -15,20 +20,60 @@ class MessageGroup(BaseModel):
 
 class Message(BaseModel):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="messages", to_field="id")
-    cipher_text = models.TextField(null=False, blank=False)
+    cipher_text = models.BinaryField(null=False, blank=False, editable=True)
     group = models.ForeignKey(MessageGroup, on_delete=models.CASCADE, to_field="id")
-    initialisation_vector = models.CharField(null=False, max_length=32)
+    initialisation_vector = models.BinaryField(null=False, max_length=16, editable=True)
     key = models.ForeignKey("crypto.SymmetricKey", on_delete=models.CASCADE, to_field="id", null=True)
+    # the position of the message in its group, counting up from 1 without gaps
+    sequence = models.BigIntegerField(null=False)
 
     class Meta:
         ordering = ("-pkid",)
         app_label = "custom_messages"
+        indexes = [
+            # backs the keyset pagination of a group's messages in both directions
+            models.Index(fields=["group", "-pkid"], name="message_group_pkid_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["group", "sequence"], name="unique_message_group_sequence"),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.sequence is not None:
+            return super().save(*args, **kwargs)
+        # a new message is given its sequence number by `pre_save`, with the group's counter locked until it is inserted
+        with transaction.atomic(using=kwargs.get("using"), savepoint=False):
+            return super().save(*args, **kwargs)
 
 
 class UserGroup(BaseModel):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, to_field="id")
     group = models.ForeignKey(MessageGroup, on_delete=models.CASCADE, to_field="id")
+    # the pkid of the latest message in the group the user has read, with every later message being unread
+    last_read_pkid = models.BigIntegerField(null=False, default=0)
+
+    class Meta:
+        ordering = ("-pkid",)
+        app_label = "custom_messages"
+        constraints = [
+            # also backs looking up a user's membership of a group
+            models.UniqueConstraint(fields=["user", "group"], name="unique_user_group"),
+        ]
+
+
+class RemovedMember(BaseModel):
+    """
+    A record of a user being removed from a group, so that clients catching up through `/messages/sync/` are told
+    about removals as well as additions. The ids are not foreign keys, as removals are also recorded while the group or
+    user is being deleted
+    """
+
+    group_id = models.UUIDField(null=False)
+    user_id = models.UUIDField(null=False)
 
     class Meta:
         ordering = ("-pkid",)
         app_label = "custom_messages"
+        indexes = [
+            models.Index(fields=["group_id", "pkid"], name="removed_member_group_pkid_idx"),
+        ]
@@ -0,0 +1,112 @@
+import base64
+from typing import List, Optional
+
+from django.db.models import QuerySet
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset pagination of messages, newest first. Rather than an offset, pages are requested relative to a message using
+    the opaque `before` (older messages) and `after` (newer messages) cursors, so deep pages are as cheap to fetch as
+    the first, and no `COUNT(*)` query is made. Relies on messages being filtered to a single group, so that the
+    `(group, pkid)` index can be used.
+
+    Views can provide `get_archived_messages(before, limit)` to continue pages of older messages into those that have
+    been archived out of the database, which are older than every message still in the database. The archive is not
+    filtered, so it is only read when paging back through a group with no query parameters other than
+    `archive_query_params`
+    """
+
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = 200
+    before_query_param = "before"
+    after_query_param = "after"
+    archive_query_params = (before_query_param, page_size_query_param, "compact", "format")
+
+    def paginate_queryset(self, queryset: QuerySet, request, view=None) -> List:
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        self.after = self.decode_cursor(request.query_params.get(self.after_query_param))
+        if self.after is not None:
+            # fetch the oldest messages newer than the cursor, returning them newest first like every other page. The
+            # archive is not read, so pages of newer messages continue from the database
+            page = list(queryset.filter(pkid__gt=self.after).order_by("pkid")[: self.page_size + 1])
+            self.has_more = len(page) > self.page_size
+            self.page = page[: self.page_size][::-1]
+            return self.page
+        if self.before is not None:
+            queryset = queryset.filter(pkid__lt=self.before)
+        # fetch one extra message to find out if there are more messages without counting them
+        page = list(queryset.order_by("-pkid")[: self.page_size + 1])
+        if len(page) <= self.page_size and self.reads_archive(request, view):
+            # the database has run out of older messages, so the page continues into the archive
+            before = page[-1].pkid if page else self.before
+            page += view.get_archived_messages(before=before, limit=self.page_size + 1 - len(page))
+        self.has_more = len(page) > self.page_size
+        self.page = page[: self.page_size]
+        return self.page
+
+    def reads_archive(self, request, view) -> bool:
+        """Whether pages continue into the archive, which only holds whole groups and cannot be filtered"""
+        return hasattr(view, "get_archived_messages") and set(request.query_params) <= set(self.archive_query_params)
+
+    def get_paginated_response(self, data) -> Response:
+        return Response({"next": self.get_next_link(), "previous": self.get_previous_link(), "results": data})
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "previous": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+    def get_page_size(self, request) -> int:
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_next_link(self) -> Optional[str]:
+        """Link to the page of older messages"""
+        older_exist = self.after is not None or self.has_more
+        if not self.page or not older_exist:
+            return None
+        return self._link(self.before_query_param, self.page[-1].pkid)
+
+    def get_previous_link(self) -> Optional[str]:
+        """Link to the page of newer messages, which is only known to exist if we are not on the first page"""
+        newer_exist = self.has_more if self.after is not None else self.before is not None
+        if not self.page or not newer_exist:
+            return None
+        return self._link(self.after_query_param, self.page[0].pkid)
+
+    def _link(self, query_param: str, pkid: int) -> str:
+        url = self.request.build_absolute_uri()
+        url = remove_query_param(url, self.before_query_param)
+        url = remove_query_param(url, self.after_query_param)
+        return replace_query_param(url, query_param, self.encode_cursor(pkid))
+
+    @staticmethod
+    def encode_cursor(pkid: int) -> str:
+        return base64.urlsafe_b64encode(str(pkid).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: Optional[str]) -> Optional[int]:
+        if cursor is None:
+            return None
+        try:
+            return int(base64.urlsafe_b64decode(cursor.encode()).decode())
+        except (TypeError, ValueError, UnicodeDecodeError):
+            raise NotFound(detail="Invalid cursor")
@@ -1,6 +1,11 @@
+import base64
+from typing import Optional
+
 from rest_framework import serializers
 
 from accounts.serializers import UserSerializer
+from api import settings
+from api.fields import Base64BinaryField
 from crypto.models import SymmetricKey
 
 from .models import Message, MessageGroup, UserGroup
@@ -18,24 +23,57 @@ class CreateUserGroupSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = UserGroup
-        exclude = ("pkid",)
+        exclude = ("pkid", "last_read_pkid")
         read_only_fields = ("group", "created_at", "updated_at", "id")
 
     def create(self, validated_data):
         request = self.context["request"]
         group_id = request.parser_context["kwargs"]["parent_lookup_group_id"]
         group = MessageGroup.objects.get(id=group_id)
+        if UserGroup.objects.filter(group=group, user=validated_data["user"]).exists():
+            raise serializers.ValidationError({"user": ["The user is already a member of the group."]})
         return super().create({**validated_data, "group": group})
 
 
+class ReadReceiptSerializer(serializers.Serializer):
+    message = serializers.UUIDField(required=False)
+
+
+class BulkMembershipSerializer(serializers.Serializer):
+    add = serializers.ListField(child=serializers.UUIDField(), required=False, default=list)
+    remove = serializers.ListField(child=serializers.UUIDField(), required=False, default=list)
+
+    def validate(self, attrs):
+        if not attrs["add"] and not attrs["remove"]:
+            raise serializers.ValidationError("Users must be given to add or remove.")
+        return attrs
+
+
 class MessageGroupSerializer(serializers.ModelSerializer):
     users = NestedUserGroupSerializer(many=True, required=False, source="usergroup_set")
     created_by = UserSerializer(source="user", required=False)
+    # annotated by `MessageGroupViewSet`, with the defaults being those of a group without any messages
+    last_message = serializers.UUIDField(read_only=True, source="last_message_id", default=None)
+    last_message_at = serializers.DateTimeField(read_only=True, default=None)
+    # `None` for groups the user is not a member of
+    unread_count = serializers.IntegerField(read_only=True, allow_null=True, default=0)
 
     class Meta:
         model = MessageGroup
-        fields = ("id", "created_at", "updated_at", "group_name", "users", "created_by")
-        read_only_fields = ["id", "created_at", "updated_at", "users", "created_by"]
+        fields = (
+            "id",
+            "created_at",
+            "updated_at",
+            "group_name",
+            "users",
+            "created_by",
+            "message_sequence",
+            "retention_days",
+            "last_message",
+            "last_message_at",
+            "unread_count",
+        )
+        read_only_fields = ["id", "created_at", "updated_at", "users", "created_by", "message_sequence"]
 
     def create(self, validated_data):
         user = self.context["request"].user
@@ -47,11 +85,13 @@ class MessageGroupSerializer(serializers.ModelSerializer):
 class MessageSerializer(serializers.ModelSerializer):
     user = UserSerializer(required=False)
     key = serializers.UUIDField(required=False, source="key_id")
+    cipher_text = Base64BinaryField()
+    initialisation_vector = Base64BinaryField(max_length=16)
 
     class Meta:
         model = Message
         exclude = ("pkid",)
-        read_only_fields = ["id", "created_at", "updated_at", "group", "user"]
+        read_only_fields = ["id", "created_at", "updated_at", "group", "user", "sequence"]
 
     def create(self, validated_data):
         request = self.context["request"]
@@ -61,3 +101,57 @@ class MessageSerializer(serializers.ModelSerializer):
         key = SymmetricKey.objects.filter(id=validated_data.get("key")).first()
         instance = super().create({**validated_data, "user": user, "group": group, "key": key})
         return instance
+
+
+class BatchMessageSerializer(serializers.Serializer):
+    group = serializers.UUIDField()
+    key = serializers.UUIDField(required=False)
+    cipher_text = Base64BinaryField()
+    initialisation_vector = Base64BinaryField(max_length=16)
+
+
+class MessageBatchSerializer(serializers.Serializer):
+    messages = BatchMessageSerializer(many=True, allow_empty=False, max_length=settings.MESSAGE_BATCH_LIMIT)
+
+
+class CompactMessageSerializer(MessageSerializer):
+    """Messages referencing their author and group by id, with the authors being sent to the client separately"""
+
+    user = serializers.UUIDField(read_only=True, source="user_id")
+    group = serializers.UUIDField(read_only=True, source="group_id")
+
+
+def compact_message(message: dict) -> dict:
+    """Convert a message serialised by `MessageSerializer` into the representation of `CompactMessageSerializer`"""
+    return {**message, "user": message["user"]["id"]}
+
+
+def binary_message(message: dict) -> dict:
+    """Convert a serialised message for a binary transport, replacing its base64 cipher text and IV with raw bytes"""
+    return {
+        **message,
+        "cipher_text": base64.b64decode(message["cipher_text"]),
+        "initialisation_vector": base64.b64decode(message["initialisation_vector"]),
+    }
+
+
+def is_compact(value: Optional[str]) -> bool:
+    """Whether a `compact` query parameter asks for the compact representation of messages"""
+    return value in ("1", "true", "True")
+
+
+class CommaSeparatedUUIDField(serializers.ListField):
+    """A list of UUIDs that can be given as a comma separated query parameter, e.g. `?groups=<id>,<id>`"""
+
+    child = serializers.UUIDField()
+
+    def to_internal_value(self, data):
+        if isinstance(data, str):
+            data = [data]
+        data = [value for item in data for value in str(item).split(",") if value]
+        return super().to_internal_value(data)
+
+
+class SyncSerializer(serializers.Serializer):
+    since = serializers.CharField(required=False)
+    groups = CommaSeparatedUUIDField(required=False)
@@ -0,0 +1,264 @@
+import base64
+import gzip
+import json
+import os
+import shutil
+from collections import defaultdict, deque
+from datetime import datetime
+from typing import Any, Deque, Dict, Iterator, List, NamedTuple, Optional, TextIO
+from uuid import UUID
+
+from django.db import connection
+
+from accounts.models import User
+from api import settings
+
+from ..models import Message
+from .partitions import Partition, is_partitioned
+
+MANIFEST_FILE = "manifest.json"
+ARCHIVE_SUFFIX = ".jsonl.gz"
+FIELDS = (
+    "pkid",
+    "id",
+    "created_at",
+    "updated_at",
+    "user_id",
+    "group_id",
+    "key_id",
+    "cipher_text",
+    "initialisation_vector",
+    "sequence",
+)
+
+
+def archive_partition(partition: Partition, directory: str = settings.MESSAGE_ARCHIVE_DIR) -> int:
+    """
+    Write the messages of a partition to compressed newline delimited JSON, one file per group, returning the number of
+    messages archived. A manifest records the range of messages held for each group, so that reads only open the files
+    that can hold the messages they are after. The archive is written to a staging directory and then moved into place,
+    so a partially written archive is never read.
+
+    The partition must be detached from the message table first, so that no messages are created in it after it has
+    been archived and before it is dropped
+    """
+    target = os.path.join(directory, partition.name)
+    staging = f"{target}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    manifest: Dict[str, Any] = {
+        "partition": partition.name,
+        "start": partition.start.isoformat(),
+        "end": partition.end.isoformat(),
+    }
+    groups: Dict[str, dict] = {}
+    messages = _partition_messages(partition)
+    archive_file: Optional[TextIO] = None
+    try:
+        for message in messages:
+            group_id = str(message["group_id"])
+            if archive_file is None or group_id not in groups:
+                if archive_file is not None:
+                    archive_file.close()
+                archive_file = gzip.open(os.path.join(staging, f"{group_id}{ARCHIVE_SUFFIX}"), "wt")
+                groups[group_id] = {"messages": 0, "min_pkid": message["pkid"]}
+            archive_file.write(json.dumps(_encode(message), separators=(",", ":")) + "\n")
+            groups[group_id]["messages"] += 1
+            groups[group_id]["max_pkid"] = message["pkid"]
+    finally:
+        if archive_file is not None:
+            archive_file.close()
+    manifest["groups"] = groups
+    with open(os.path.join(staging, MANIFEST_FILE), "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(staging, target)
+    _indexes.pop(directory, None)
+    return sum(group["messages"] for group in groups.values())
+
+
+def _partition_messages(partition: Partition) -> Iterator[dict]:
+    """The messages of a partition ordered by group and pkid, read in chunks"""
+    if not is_partitioned():
+        # without partitioning, the partition's range of the message table is archived
+        yield from (
+            Message.objects.filter(created_at__gte=partition.start, created_at__lt=partition.end)
+            .order_by("group_id", "pkid")
+            .values(*FIELDS)
+            .iterator(chunk_size=2000)
+        )
+        return
+    # a detached partition is no longer part of the message table, so is read directly
+    with connection.chunked_cursor() as cursor:
+        # the partition's name is built from its month, never from user input
+        cursor.execute(f"SELECT {', '.join(FIELDS)} FROM {partition.name} ORDER BY group_id, pkid")  # nosec: B608
+        while rows := cursor.fetchmany(2000):
+            for row in rows:
+                yield dict(zip(FIELDS, row))
+
+
+class ArchivedFile(NamedTuple):
+    path: str
+    partition_end: datetime
+    min_pkid: int
+    max_pkid: int
+    messages: int
+
+
+class ArchiveIndex(NamedTuple):
+    # the modification time of the archive directory the index was built at
+    modified: int
+    # the archived files of each group, newest first
+    groups: Dict[str, List[ArchivedFile]]
+    until: Optional[datetime]
+
+
+_indexes: Dict[str, ArchiveIndex] = {}
+
+
+def archived_messages(
+    group_id: str | UUID,
+    before: Optional[int] = None,
+    limit: int = 50,
+    since: Optional[datetime] = None,
+    directory: str = settings.MESSAGE_ARCHIVE_DIR,
+) -> List[Message]:
+    """
+    Read up to `limit` of a group's archived messages older than the `before` pkid, newest first, leaving out those
+    created before `since`. The group's files are read newest first, and only until `limit` messages are found. Messages
+    are returned unsaved, with their authors attached
+    """
+    matches: List[dict] = []
+    for archived_file in _index(directory).groups.get(str(group_id), []):
+        if (before is not None and archived_file.min_pkid >= before) or (
+            since is not None and archived_file.partition_end <= since
+        ):
+            continue
+        # the remaining files only hold older messages than those already found
+        if len(matches) >= limit and archived_file.max_pkid < matches[limit - 1]["pkid"]:
+            break
+        matches.extend(_read_newest(archived_file.path, before, since, limit))
+        matches.sort(key=lambda message: message["pkid"], reverse=True)
+        del matches[limit:]
+    messages = [_decode(message) for message in matches]
+    authors = User.objects.in_bulk({message.user_id for message in messages}, field_name="id")
+    # the messages of deleted users are not shown, as they would have been deleted with the user
+    messages = [message for message in messages if message.user_id in authors]
+    for message in messages:
+        message.user = authors[message.user_id]
+    return messages
+
+
+def has_archived_messages(
+    group_id: str | UUID, before: Optional[int] = None, directory: str = settings.MESSAGE_ARCHIVE_DIR
+) -> bool:
+    """Whether any of a group's archived messages are older than the `before` pkid, without reading the archive"""
+    files = _index(directory).groups.get(str(group_id), [])
+    return any(before is None or archived_file.min_pkid < before for archived_file in files)
+
+
+def delete_archived_group(
+    group_id: str | UUID, before: Optional[datetime] = None, directory: str = settings.MESSAGE_ARCHIVE_DIR
+) -> int:
+    """
+    Remove a deleted group's messages from the archive, or with `before`, only the archived partitions ending on or
+    before it, returning the number of messages removed
+    """
+    removed = 0
+    for archived_file in _index(directory).groups.get(str(group_id), []):
+        if before is None or archived_file.partition_end <= before:
+            try:
+                os.remove(archived_file.path)
+            except FileNotFoundError:
+                continue
+            removed += archived_file.messages
+    if removed:
+        _indexes.pop(directory, None)
+    return removed
+
+
+def archived_until(directory: str = settings.MESSAGE_ARCHIVE_DIR) -> Optional[datetime]:
+    """The end of the latest archived partition, before which messages may only be held in the archive"""
+    return _index(directory).until
+
+
+def _index(directory: str) -> ArchiveIndex:
+    """
+    The index of the archive's manifests, which is built once and rebuilt when a partition is archived into the
+    directory. Files removed since the index was built are skipped when read
+    """
+    try:
+        modified = os.stat(directory).st_mtime_ns
+    except FileNotFoundError:
+        return ArchiveIndex(modified=0, groups={}, until=None)
+    index = _indexes.get(directory)
+    if index is not None and index.modified == modified:
+        return index
+    groups: Dict[str, List[ArchivedFile]] = defaultdict(list)
+    until = None
+    for manifest in _manifests(directory):
+        partition_end = datetime.fromisoformat(manifest["end"])
+        until = max(until or partition_end, partition_end)
+        for group_id, group in manifest["groups"].items():
+            path = os.path.join(directory, manifest["partition"], f"{group_id}{ARCHIVE_SUFFIX}")
+            groups[group_id].append(
+                ArchivedFile(path, partition_end, group["min_pkid"], group["max_pkid"], group["messages"])
+            )
+    for files in groups.values():
+        files.sort(key=lambda archived_file: archived_file.max_pkid, reverse=True)
+    index = _indexes[directory] = ArchiveIndex(modified=modified, groups=dict(groups), until=until)
+    return index
+
+
+def _manifests(directory: str) -> Iterator[dict]:
+    for partition in sorted(os.listdir(directory)):
+        manifest_path = os.path.join(directory, partition, MANIFEST_FILE)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as manifest_file:
+                yield json.load(manifest_file)
+
+
+def _read_newest(path: str, before: Optional[int], since: Optional[datetime], limit: int) -> List[dict]:
+    """The newest `limit` messages of an archive file older than `before`, which are written in pkid order"""
+    newest: Deque[dict] = deque(maxlen=limit)
+    try:
+        with gzip.open(path, "rt") as archive_file:
+            for line in archive_file:
+                message = json.loads(line)
+                if before is not None and message["pkid"] >= before:
+                    break
+                if since is None or datetime.fromisoformat(message["created_at"]) >= since:
+                    newest.append(message)
+    except FileNotFoundError:
+        return []
+    return list(newest)
+
+
+def _encode(message: dict) -> dict:
+    return {
+        **message,
+        "id": str(message["id"]),
+        "created_at": message["created_at"].isoformat(),
+        "updated_at": message["updated_at"].isoformat(),
+        "user_id": str(message["user_id"]),
+        "group_id": str(message["group_id"]),
+        "key_id": str(message["key_id"]) if message["key_id"] else None,
+        "cipher_text": base64.b64encode(bytes(message["cipher_text"])).decode(),
+        "initialisation_vector": base64.b64encode(bytes(message["initialisation_vector"])).decode(),
+    }
+
+
+def _decode(message: dict) -> Message:
+    return Message(
+        **{
+            **message,
+            "id": UUID(message["id"]),
+            "created_at": datetime.fromisoformat(message["created_at"]),
+            "updated_at": datetime.fromisoformat(message["updated_at"]),
+            "user_id": UUID(message["user_id"]),
+            "group_id": UUID(message["group_id"]),
+            "key_id": UUID(message["key_id"]) if message["key_id"] else None,
+            "cipher_text": base64.b64decode(message["cipher_text"]),
+            "initialisation_vector": base64.b64decode(message["initialisation_vector"]),
+        }
+    )
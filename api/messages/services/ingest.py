@@ -0,0 +1,62 @@
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+from django.db import transaction
+from rest_framework.exceptions import PermissionDenied, ValidationError
+
+from accounts.models import User
+from crypto.models import SymmetricKey
+from websockets.services.event_dispatcher import broadcast
+
+from ..models import Message, MessageGroup, UserGroup
+from ..serializers import MessageSerializer
+from .sequences import allocate_sequences
+
+
+def create_messages(user: User, messages: List[dict]) -> List[Message]:
+    """
+    Create a batch of messages, possibly spanning several groups, for a user. Membership of every group and the keys the
+    messages were encrypted with are checked with one query each, the messages are inserted together, and each group is
+    sent a single `new_messages` websocket event holding all of its new messages in order
+    """
+    group_ids = {message["group"] for message in messages}
+    member_of = set(UserGroup.objects.filter(user=user, group_id__in=group_ids).values_list("group_id", flat=True))
+    if not_member_of := group_ids - member_of:
+        raise PermissionDenied(f"Not a member of the groups {', '.join(sorted(map(str, not_member_of)))}")
+
+    key_ids = {message["key"] for message in messages if message.get("key")}
+    key_groups = dict(SymmetricKey.objects.filter(id__in=key_ids).values_list("id", "group_id"))
+    errors = {
+        index: {"key": ["The key does not belong to the message's group."]}
+        for index, message in enumerate(messages)
+        if message.get("key") and key_groups.get(message["key"]) != message["group"]
+    }
+    if errors:
+        raise ValidationError({"messages": errors})
+
+    with transaction.atomic():
+        # reserve each group's sequence numbers in a consistent order, so that concurrent batches cannot deadlock
+        counts = Counter(message["group"] for message in messages)
+        next_sequences = {group_id: allocate_sequences(group_id, counts[group_id]) for group_id in sorted(counts)}
+        # the messages are serialised with their group, which is fetched once rather than once per message
+        groups = MessageGroup.objects.in_bulk(list(counts), field_name="id")
+        instances = []
+        for message in messages:
+            instances.append(
+                Message(
+                    user=user,
+                    group=groups[message["group"]],
+                    key_id=message.get("key"),
+                    cipher_text=message["cipher_text"],
+                    initialisation_vector=message["initialisation_vector"],
+                    sequence=next_sequences[message["group"]],
+                )
+            )
+            next_sequences[message["group"]] += 1
+        created = Message.objects.bulk_create(instances)
+        messages_by_group: Dict[str, List[dict]] = defaultdict(list)
+        for instance, data in zip(created, MessageSerializer(created, many=True).data):
+            messages_by_group[str(instance.group_id)].append({**data, "group": str(instance.group_id)})
+        for group_id, group_messages in messages_by_group.items():
+            broadcast(group_id, "new_messages", group_messages)
+    return created
@@ -0,0 +1,39 @@
+from typing import List, Tuple
+from uuid import UUID
+
+from rest_framework.exceptions import ValidationError
+
+from accounts.models import User
+from crypto.services import key_management_service
+from websockets.services.event_dispatcher import broadcast
+
+from ..models import MessageGroup, UserGroup
+from .membership_cache import membership_cache
+
+
+def update_members(group: MessageGroup, add: List[UUID], remove: List[UUID]) -> Tuple[List[UUID], List[UUID]]:
+    """
+    Add and remove many members of a group at once, returning the ids of the users that were added and removed. The
+    group's key is rotated once for all of the removals, after the new members have been added so that they receive
+    it too, and the new members are announced in a single `new_users` websocket event
+    """
+    if overlap := set(add) & set(remove):
+        raise ValidationError({"add": [f"Users cannot be both added and removed: {', '.join(map(str, overlap))}"]})
+
+    with key_management_service.coalesce_key_rotations():
+        removals = UserGroup.objects.filter(group=group, user_id__in=remove)
+        removed = list(removals.values_list("user_id", flat=True).distinct())
+        # each removal notifies the group through the `post_delete` signals, which defer the key rotation to the end
+        removals.delete()
+
+        existing = set(UserGroup.objects.filter(group=group, user_id__in=add).values_list("user_id", flat=True))
+        added = list(User.objects.filter(id__in=set(add) - existing).values_list("id", flat=True))
+        if unknown := set(add) - existing - set(added):
+            raise ValidationError({"add": [f"Unknown users: {', '.join(map(str, unknown))}"]})
+        UserGroup.objects.bulk_create(
+            (UserGroup(group=group, user_id=user_id) for user_id in added), ignore_conflicts=True
+        )
+        if added:
+            membership_cache.invalidate(group.id)
+            broadcast(str(group.id), "new_users", [str(user_id) for user_id in added])
+    return added, removed
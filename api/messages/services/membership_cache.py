@@ -0,0 +1,71 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import FrozenSet, Optional, Tuple
+from uuid import UUID
+
+from api import settings
+
+from ..models import UserGroup
+
+
+class MembershipCache:
+    """
+    A bounded, thread-safe LRU cache of the ids of the members of each group, with entries expiring after a fixed time.
+
+    Entries are removed when a `UserGroup` is created or deleted (see `messages/signals.py`) in the process making the
+    change. Websocket consumers also invalidate entries when they are told about membership changes, so processes that
+    only serve websockets do not have to wait for the TTL.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._members: OrderedDict[str, Tuple[float, FrozenSet[UUID]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get_cached(self, group_id: str | UUID) -> Optional[FrozenSet[UUID]]:
+        """Fetch the members of a group if they are cached, without querying the database"""
+        key = str(group_id)
+        with self._lock:
+            cached = self._members.get(key)
+            if cached and cached[0] > time.monotonic():
+                self._members.move_to_end(key)
+                self.hits += 1
+                return cached[1]
+            return None
+
+    def get(self, group_id: str | UUID) -> FrozenSet[UUID]:
+        """Fetch the members of a group, only querying the database if they are not cached"""
+        members = self.get_cached(group_id)
+        if members is not None:
+            return members
+        key = str(group_id)
+        expires_at = time.monotonic() + self.ttl
+        members = frozenset(UserGroup.objects.filter(group_id=key).values_list("user_id", flat=True))
+        with self._lock:
+            self.misses += 1
+            self._members[key] = (expires_at, members)
+            self._members.move_to_end(key)
+            while len(self._members) > self.max_size:
+                self._members.popitem(last=False)
+        return members
+
+    def is_member(self, group_id: str | UUID, user_id: UUID) -> bool:
+        return user_id in self.get(group_id)
+
+    def invalidate(self, group_id: str | UUID) -> None:
+        with self._lock:
+            self._members.pop(str(group_id), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._members.clear()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._members)}
+
+
+membership_cache = MembershipCache(max_size=settings.MEMBERSHIP_CACHE["MAX_SIZE"], ttl=settings.MEMBERSHIP_CACHE["TTL"])
@@ -0,0 +1,118 @@
+import re
+from datetime import date, datetime, timezone
+from functools import lru_cache
+from typing import List, NamedTuple, Optional
+
+from django.db import connection
+
+from ..models import Message
+
+MESSAGE_TABLE = Message._meta.db_table
+# monthly partitions are named after the month they hold, e.g. `custom_messages_message_p2024_05`
+PARTITION_NAME = re.compile(rf"^{MESSAGE_TABLE}_p(\d{{4}})_(\d{{2}})$")
+
+
+class Partition(NamedTuple):
+    name: str
+    start: datetime
+    end: datetime
+
+
+def add_months(month: date, months: int) -> date:
+    month_index = month.year * 12 + month.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def month_partition(month: date) -> Partition:
+    """The partition holding the messages created in a month, with its range being in UTC"""
+    month = month.replace(day=1)
+    next_month = add_months(month, 1)
+    return Partition(
+        name=f"{MESSAGE_TABLE}_p{month:%Y_%m}",
+        start=datetime(month.year, month.month, 1, tzinfo=timezone.utc),
+        end=datetime(next_month.year, next_month.month, 1, tzinfo=timezone.utc),
+    )
+
+
+@lru_cache(maxsize=None)
+def is_partitioned() -> bool:
+    """
+    Whether the message table is partitioned, which is only possible with PostgreSQL. This only changes when migrating,
+    so is looked up once per process
+    """
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = %s",
+            [MESSAGE_TABLE],
+        )
+        return cursor.fetchone() is not None
+
+
+def list_partitions() -> List[Partition]:
+    """The monthly partitions attached to the message table, oldest first"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = %s",
+            [MESSAGE_TABLE],
+        )
+        names = [name for (name,) in cursor.fetchall()]
+    partitions = []
+    for name in names:
+        if match := PARTITION_NAME.match(name):
+            partitions.append(month_partition(date(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda partition: partition.start)
+
+
+def create_partition(month: date) -> Optional[Partition]:
+    """Create the partition for a month, returning it, or `None` if it already exists"""
+    partition = month_partition(month)
+    if partition in list_partitions():
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(f"CREATE TABLE {partition.name} (LIKE {MESSAGE_TABLE} INCLUDING DEFAULTS)")
+        add_unique_indexes(cursor, partition.name)
+        # messages in the month that were caught by the default partition must be moved into the new partition. The
+        # table names are built from the model's table and the month, never from user input
+        cursor.execute(
+            f"WITH moved AS (DELETE FROM {MESSAGE_TABLE}_default "  # nosec: B608
+            f"WHERE created_at >= %s AND created_at < %s RETURNING *) INSERT INTO {partition.name} SELECT * FROM moved",
+            [partition.start, partition.end],
+        )
+    attach_partition(partition)
+    return partition
+
+
+def add_unique_indexes(cursor, name: str) -> None:
+    """
+    Make `id` and `(group, sequence)` unique within a partition. The unique keys of a partitioned table must include the
+    partition key, so the database cannot make them unique across partitions. Ids are random UUIDs, while sequence
+    numbers are checked against the rest of the group when they are allocated, see `allocate_sequences`
+    """
+    cursor.execute(f"CREATE UNIQUE INDEX {name}_id_key ON {name} (id)")
+    cursor.execute(f"CREATE UNIQUE INDEX {name}_group_sequence_key ON {name} (group_id, sequence)")
+
+
+def attach_partition(partition: Partition) -> None:
+    """Attach a partition to the message table, which fails if the default partition holds any messages in its range"""
+    bounds = f"FROM ('{partition.start.isoformat()}') TO ('{partition.end.isoformat()}')"
+    with connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {MESSAGE_TABLE} ATTACH PARTITION {partition.name} FOR VALUES {bounds}")
+
+
+def detach_partition(partition: Partition) -> None:
+    """
+    Detach a partition from the message table, keeping it as a table of its own. Messages created in its range from
+    then on are caught by the default partition
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(f"ALTER TABLE {MESSAGE_TABLE} DETACH PARTITION {partition.name}")
+
+
+def drop_partition(partition: Partition) -> None:
+    """Drop a partition that has been detached from the message table"""
+    with connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE {partition.name}")
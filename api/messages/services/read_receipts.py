@@ -0,0 +1,62 @@
+from typing import Optional, Tuple
+from uuid import UUID
+
+from django.db.models import Case, Count, IntegerField, OuterRef, QuerySet, Subquery, Value, When
+from django.db.models.functions import Coalesce
+from rest_framework.exceptions import NotFound
+
+from accounts.models import User
+
+from ..models import Message, MessageGroup, UserGroup
+
+
+def annotate_summaries(queryset: QuerySet, user: User) -> QuerySet:
+    """
+    Annotate groups with their latest message's id and creation time, and the number of messages from other members the
+    user has not read, so that an inbox can be shown from a single query. Users only have read receipts for groups they
+    are members of, so the unread count of any other group is `None`
+    """
+    latest = Message.objects.filter(group_id=OuterRef("id")).order_by("-pkid")
+    last_read = UserGroup.objects.filter(group_id=OuterRef("id"), user=user).values("last_read_pkid")[:1]
+    unread = (
+        Message.objects.filter(group_id=OuterRef("id"), pkid__gt=OuterRef("last_read_pkid"))
+        .exclude(user=user)
+        .order_by()
+        .values("group_id")
+        .annotate(count=Count("pkid"))
+        .values("count")
+    )
+    return queryset.annotate(
+        last_message_id=Subquery(latest.values("id")[:1]),
+        last_message_at=Subquery(latest.values("created_at")[:1]),
+        last_read_pkid=Subquery(last_read),
+    ).annotate(
+        # the count is only made for the user's own groups, rather than over the whole history of every other group
+        unread_count=Case(
+            When(last_read_pkid__isnull=True, then=Value(None)),
+            default=Coalesce(Subquery(unread), 0),
+            output_field=IntegerField(),
+        )
+    )
+
+
+def mark_read(user: User, group: MessageGroup, message_id: Optional[UUID] = None) -> Tuple[Optional[Message], int]:
+    """
+    Move the user's read receipt for a group up to a message, or the group's latest message, returning the message and
+    the number of messages that remain unread. Receipts never move backwards, so out of order requests are harmless
+    """
+    messages = Message.objects.filter(group=group)
+    if message_id is not None:
+        message = messages.filter(id=message_id).only("id", "pkid").first()
+        if message is None:
+            raise NotFound("Message not found")
+    else:
+        message = messages.order_by("-pkid").only("id", "pkid").first()
+    membership = UserGroup.objects.filter(group=group, user=user)
+    if not membership.exists():
+        raise NotFound("Not a member of the group")
+    if message is not None:
+        membership.filter(last_read_pkid__lt=message.pkid).update(last_read_pkid=message.pkid)
+    last_read_pkid = membership.values_list("last_read_pkid", flat=True).first()
+    unread_count = messages.filter(pkid__gt=last_read_pkid).exclude(user=user).count()
+    return message, unread_count
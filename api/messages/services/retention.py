@@ -0,0 +1,111 @@
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Callable, Dict, Iterator, Optional
+
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, pre_delete
+from django.utils import timezone
+
+from api import settings
+
+from ..models import Message, MessageGroup
+from . import archive
+
+
+@contextmanager
+def delete_signals_disabled() -> Iterator[None]:
+    """
+    Disconnect every `pre_delete` and `post_delete` receiver for the duration of a block, so that deletes are made in
+    bulk rather than row by row, and per-row handlers (such as removing a deleted group's archive) are not triggered.
+    Receivers are disconnected for the whole process, so this is only for use by management commands
+    """
+    saved = []
+    for signal in (pre_delete, post_delete):
+        with signal.lock:
+            saved.append((signal, signal.receivers))
+            signal.receivers = []
+            signal.sender_receivers_cache.clear()
+    try:
+        yield
+    finally:
+        for signal, receivers in saved:
+            with signal.lock:
+                signal.receivers = receivers
+                signal.sender_receivers_cache.clear()
+
+
+def delete_in_batches(
+    queryset: QuerySet,
+    batch_size: int = 1000,
+    pause: float = 0.0,
+    progress: Optional[Callable[[int, int, float], None]] = None,
+) -> int:
+    """
+    Delete the rows of a queryset in batches of consecutive pkids, each in its own short transaction, pausing between
+    batches so that the purge does not starve other queries. Rows are deleted with `delete_signals_disabled`, with the
+    rows referencing them cascaded in bulk. `progress` is called after each batch with the rows deleted so far, the rows
+    left and the rate of deletion
+    """
+    model = queryset.model
+    remaining = queryset.count()
+    deleted = 0
+    started = time.monotonic()
+    last_pkid = None
+    while True:
+        batch = queryset if last_pkid is None else queryset.filter(pkid__gt=last_pkid)
+        bounds = list(batch.order_by("pkid").values_list("pkid", flat=True)[:batch_size])
+        if not bounds:
+            return deleted
+        last_pkid = bounds[-1]
+        with transaction.atomic(using=queryset.db), delete_signals_disabled():
+            # the condition is checked again within the range, with the rows locked until they are gone
+            pkids = list(
+                queryset.filter(pkid__gte=bounds[0], pkid__lte=last_pkid)
+                .order_by()
+                .select_for_update()
+                .values_list("pkid", flat=True)
+            )
+            _, deleted_by_model = model._base_manager.using(queryset.db).filter(pkid__in=pkids).delete()
+        batch_deleted = deleted_by_model.get(model._meta.label, 0)
+        deleted += batch_deleted
+        remaining = max(remaining - batch_deleted, 0)
+        if progress is not None:
+            progress(deleted, remaining, deleted / max(time.monotonic() - started, 1e-6))
+        if pause:
+            time.sleep(pause)
+
+
+def retention_cutoff(group: MessageGroup) -> Optional[datetime]:
+    """The time before which a group's messages have expired, or `None` if they are kept forever"""
+    if group.retention_days is None:
+        return None
+    return timezone.now() - timedelta(days=group.retention_days)
+
+
+def expired_messages(group: MessageGroup) -> QuerySet[Message]:
+    """The messages of a group that are older than its retention period"""
+    if group.retention_days is None:
+        return Message.objects.none()
+    return Message.objects.filter(group_id=group.id, created_at__lt=retention_cutoff(group))
+
+
+def purge_expired_messages(
+    batch_size: int = 1000,
+    pause: float = 0.0,
+    progress: Optional[Callable[[MessageGroup, int, int, float], None]] = None,
+    archive_directory: str = settings.MESSAGE_ARCHIVE_DIR,
+) -> Dict[str, int]:
+    """
+    Delete the messages of every group with a retention period that are older than it, from both the database and the
+    archive, returning the number of messages deleted from each
+    """
+    deleted = {"database": 0, "archive": 0}
+    for group in MessageGroup.objects.filter(retention_days__isnull=False).order_by("pkid").iterator():
+        group_progress = partial(progress, group) if progress is not None else None
+        deleted["database"] += delete_in_batches(expired_messages(group), batch_size, pause, progress=group_progress)
+        # archived partitions are removed whole, with any expired messages left in them hidden when read
+        deleted["archive"] += archive.delete_archived_group(group.id, retention_cutoff(group), archive_directory)
+    return deleted
@@ -0,0 +1,28 @@
+from uuid import UUID
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.db.transaction import TransactionManagementError
+
+from ..models import Message, MessageGroup
+from . import partitions
+
+
+def allocate_sequences(group_id: UUID, count: int = 1) -> int:
+    """
+    Reserve the next `count` sequence numbers of a group's messages, returning the first of them. Incrementing the
+    group's counter locks its row until the transaction ends, so messages inserted in the same transaction are committed
+    in the order of their sequence numbers, without gaps, while other groups are unaffected. The messages must be
+    inserted in the same transaction, which the caller is required to have started
+    """
+    if not transaction.get_connection().in_atomic_block:
+        # outside a transaction the lock would be released as soon as the counter is incremented, before the insert
+        raise TransactionManagementError("Sequence numbers must be allocated in the transaction inserting the messages")
+    groups = MessageGroup.objects.filter(id=group_id)
+    if not groups.update(message_sequence=F("message_sequence") + count):
+        raise MessageGroup.DoesNotExist(f"Message group {group_id} does not exist")
+    first = groups.values_list("message_sequence", flat=True).get() - count + 1
+    # the database only keeps sequence numbers unique within each partition of a partitioned message table
+    if partitions.is_partitioned() and Message.objects.filter(group_id=group_id, sequence__gte=first).exists():
+        raise IntegrityError(f"Sequence numbers from {first} are already used in message group {group_id}")
+    return first
@@ -0,0 +1,173 @@
+import json
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional
+from uuid import UUID
+
+from asgiref.sync import sync_to_async
+from django.core import signing
+from django.db.models import Max, Q, QuerySet
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from accounts.models import User
+from crypto.models import SymmetricKey
+from crypto.services import key_management_service
+
+from ..models import Message, MessageGroup, RemovedMember, UserGroup
+from ..serializers import MessageSerializer
+
+# the maximum number of messages returned by a single sync, clients continue from the returned watermark if there are
+# more messages to fetch
+SYNC_LIMIT = 1000
+# the watermarks of keys and memberships only move past rows this old. A row can commit after rows with later pkids, so
+# rows within the window are sent again by the next sync rather than risking skipping one that has not committed yet
+IN_FLIGHT_WINDOW = timedelta(seconds=60)
+# the number of events sent to the client in each chunk of the response
+CHUNK_SIZE = 100
+# watermarks of the tables synced by pkid
+PKID_WATERMARKS = ("keys", "users", "removals")
+WATERMARK_SALT = "messages.sync.watermark"
+
+
+def encode_watermark(watermark: Dict[str, Any], user: User) -> str:
+    """
+    Sign a watermark for the user it was made for, so that clients cannot forge one to be sent events from before they
+    were allowed to see them
+    """
+    return signing.dumps({**watermark, "user": str(user.id)}, salt=WATERMARK_SALT, compress=True)
+
+
+def decode_watermark(watermark: str, user: User) -> Dict[str, Any]:
+    try:
+        decoded = signing.loads(watermark, salt=WATERMARK_SALT)
+        if decoded["user"] != str(user.id):
+            raise ValueError("Watermark of another user")
+        messages = {str(UUID(group_id)): int(sequence) for group_id, sequence in decoded["messages"].items()}
+        return {"messages": messages, **{key: int(decoded[key]) for key in PKID_WATERMARKS}}
+    except (signing.BadSignature, TypeError, ValueError, KeyError, AttributeError):
+        raise ValidationError(detail="Invalid watermark")
+
+
+def current_watermark(group_ids: List[UUID]) -> Dict[str, Any]:
+    """A watermark from which only events that happen from now on will be synced, other than those in flight"""
+    settled_before = timezone.now() - IN_FLIGHT_WINDOW
+    return {
+        # messages are synced by each group's sequence numbers, which are committed in order
+        "messages": {
+            str(group_id): sequence
+            for group_id, sequence in MessageGroup.objects.filter(id__in=group_ids).values_list(
+                "id", "message_sequence"
+            )
+        },
+        "keys": _settled_pkid(SymmetricKey.objects.all(), settled_before),
+        "users": _settled_pkid(UserGroup.objects.all(), settled_before),
+        "removals": _settled_pkid(RemovedMember.objects.all(), settled_before),
+    }
+
+
+def get_group_ids_for_sync(user: User, group_ids: Optional[List[UUID]]) -> List[UUID]:
+    """The groups to sync, which are all of the user's groups if `group_ids` is not provided"""
+    member_group_ids = set(UserGroup.objects.filter(user=user).values_list("group_id", flat=True))
+    if group_ids is None:
+        return list(member_group_ids)
+    if non_member_group_ids := set(group_ids) - member_group_ids:
+        raise ValidationError(
+            detail=f"User is not a member of groups {', '.join(sorted(map(str, non_member_group_ids)))}!"
+        )
+    return group_ids
+
+
+def stream_events(user: User, group_ids: List[UUID], watermark: Dict[str, Any]) -> Iterator[str]:
+    """
+    Yield every event for the groups since the watermark as lines of JSON, in the same shape as the messages sent along
+    the multiplexed websocket. Membership and key changes are sent before messages, so that clients have the keys
+    needed to decrypt the messages. The user is also told about their own removal from any group. The final line holds
+    the watermark to use for the next sync.
+
+    Messages are synced by each group's sequence numbers, while keys and memberships are synced by pkid, with those
+    created within the `IN_FLIGHT_WINDOW` being sent again by the next sync, so clients must ignore repeated events
+    """
+    watermark = {**watermark, "messages": dict(watermark["messages"])}
+    settled_before = timezone.now() - IN_FLIGHT_WINDOW
+
+    user_groups = UserGroup.objects.filter(group_id__in=group_ids)
+    for user_group in _since(user_groups, watermark, "users", settled_before):
+        yield _event("new_user", user_group.group_id, str(user_group.user_id))
+
+    removals = RemovedMember.objects.filter(Q(group_id__in=group_ids) | Q(user_id=user.id))
+    for removal in _since(removals, watermark, "removals", settled_before):
+        yield _event("member_removed", removal.group_id, str(removal.user_id))
+
+    # the user is only sent the keys they are entitled to, however old their watermark, as the history endpoint does
+    symmetric_keys = list(
+        _since(key_management_service.entitled_symmetric_keys(user, group_ids), watermark, "keys", settled_before)
+    )
+    for symmetric_key, key in zip(symmetric_keys, _wrap_keys_for_user(user, symmetric_keys)):
+        yield _event("new_key", symmetric_key.group_id, {"id": str(symmetric_key.id), **key})
+
+    count = 0
+    if group_ids:
+        after_watermark = Q()
+        for group_id in group_ids:
+            # groups the watermark does not know about, such as those the user has since joined, are synced in full
+            after_watermark |= Q(group_id=group_id, sequence__gt=watermark["messages"].get(str(group_id), 0))
+        messages = Message.objects.filter(after_watermark).select_related("user").order_by("pkid")[: SYNC_LIMIT + 1]
+        for message in messages.iterator(chunk_size=200):
+            count += 1
+            if count > SYNC_LIMIT:
+                break
+            watermark["messages"][str(message.group_id)] = message.sequence
+            data = MessageSerializer(instance=message).data
+            data["group"] = str(message.group_id)
+            yield _event("new_message", message.group_id, data)
+
+    yield json.dumps(
+        {"type": "watermark", "message": encode_watermark(watermark, user), "has_more": count > SYNC_LIMIT}
+    ) + "\n"
+
+
+async def astream_events(user: User, group_ids: List[UUID], watermark: Dict[str, Any]) -> AsyncIterator[str]:
+    """
+    `stream_events` as an asynchronous iterator, so that ASGI servers send each chunk of events as soon as it is read
+    rather than buffering the whole response. The events are read in the thread shared by synchronous code, so the
+    database cursor stays on one connection
+    """
+    events = stream_events(user, group_ids, watermark)
+    read_chunk = sync_to_async(lambda: "".join(islice(events, CHUNK_SIZE)), thread_sensitive=True)
+    while chunk := await read_chunk():
+        yield chunk
+
+
+def _since(queryset: QuerySet, watermark: Dict[str, Any], key: str, settled_before: datetime) -> Iterator:
+    """
+    The rows of a queryset after the watermark, in pkid order. The watermark is moved past each row created before
+    `settled_before`, up to the first row that is still within the in flight window
+    """
+    settled = True
+    for row in queryset.filter(pkid__gt=watermark[key]).order_by("pkid"):
+        settled = settled and row.created_at < settled_before
+        if settled:
+            watermark[key] = row.pkid
+        yield row
+
+
+def _settled_pkid(queryset: QuerySet, settled_before: datetime) -> int:
+    return queryset.filter(created_at__lt=settled_before).aggregate(pkid=Max("pkid"))["pkid"] or 0
+
+
+def _wrap_keys_for_user(user: User, symmetric_keys: List[SymmetricKey]) -> Iterable[Dict[str, str]]:
+    """The keys encrypted for the user, in the same shape as the `new_key` websocket message"""
+    if not symmetric_keys:
+        return []
+    try:
+        rsa_key = key_management_service.get_public_key_for_user(user)
+    except ValidationError:
+        # the user has no valid RSA key, they will have to fetch the keys once they have registered one
+        return [{} for _ in symmetric_keys]
+    wrapped_keys = key_management_service.get_wrapped_keys(symmetric_keys, rsa_key)
+    return [{"key": wrapped_key.encrypted_key, "signature": wrapped_key.signature} for wrapped_key in wrapped_keys]
+
+
+def _event(message_type: str, group_id: UUID, message) -> str:
+    return json.dumps({"type": message_type, "group": str(group_id), "message": message}, separators=(",", ":")) + "\n"
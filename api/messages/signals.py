@@ -1,25 +1,35 @@
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-from django.db.models.signals import post_delete, post_save
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.dispatch import receiver
 
 from crypto.services import key_management_service
+from websockets.services.event_dispatcher import broadcast
 
-from .models import Message, MessageGroup, UserGroup
+from .models import Message, MessageGroup, RemovedMember, UserGroup
 from .serializers import MessageSerializer
+from .services import archive
+from .services.membership_cache import membership_cache
+from .services.sequences import allocate_sequences
+
+
+@receiver(pre_save, sender=Message)
+def assign_message_sequence(sender, instance: Message, raw: bool, **kwargs):
+    """Give a new message the next sequence number of its group"""
+    if instance.sequence is None and not raw:
+        instance.sequence = allocate_sequences(instance.group_id)
 
 
 @receiver(post_save, sender=Message)
 def send_websockets_messages(sender, instance: Message, created: bool, **kwargs):
     """Send a websocket message to the group is a message has been created for the group"""
     if created:
-        channel_layer = get_channel_layer()
-        group_id = str(instance.group.id)
+        group_id = str(instance.group_id)
         # convert the message record in the database into a serialisable JSON format
         message = MessageSerializer(instance=instance).data
         message["group"] = group_id
-        message = {"type": "send.message", "message_type": "new_message", "message": message}
-        async_to_sync(channel_layer.group_send)(group_id, message)
+        broadcast(group_id, "new_message", message)
 
 
 @receiver(post_save, sender=MessageGroup)
@@ -31,13 +41,39 @@ def generate_group_key(sender, instance: MessageGroup, created: bool, **kwargs):
     key_management_service.generate_key_for_group(instance)
 
 
+@receiver(post_delete, sender=MessageGroup)
+def delete_archived_messages(sender, instance: MessageGroup, **kwargs):
+    """
+    Messages archived out of the database are not deleted with their group by the database, so are removed here once
+    the group's deletion commits, as the files cannot be restored if it is rolled back
+    """
+    transaction.on_commit(partial(archive.delete_archived_group, instance.id))
+
+
+@receiver(post_delete, sender=UserGroup)
+def notify_user_of_removal(sender, instance: UserGroup, **kwargs):
+    """
+    Triggered when a user is removed from a message group. Websocket consumers of the removed user unsubscribe them from
+    the group on receiving this, so this must be sent before the group's new key
+    """
+    membership_cache.invalidate(instance.group_id)
+    broadcast(str(instance.group_id), "member_removed", f"{instance.user_id}")
+
+
+@receiver(post_delete, sender=UserGroup)
+def record_member_removal(sender, instance: UserGroup, **kwargs):
+    """Record the removal for clients that were not connected when it happened, see `messages.services.sync`"""
+    RemovedMember.objects.create(group_id=instance.group_id, user_id=instance.user_id)
+
+
 @receiver(post_delete, sender=UserGroup)
 def generate_new_group_key(sender, instance: UserGroup, **kwargs):
     """
     Triggered when a user is removed from a message group, we want to generate a new AES key for the group to ensure
-    the old group member cannot decrypt future messages
+    the old group member cannot decrypt future messages. Within `coalesce_key_rotations`, one key is generated for all
+    of the removals from the group
     """
-    key_management_service.generate_key_for_group(instance.group)
+    key_management_service.rotate_key_for_group(instance.group_id)
 
 
 @receiver(post_save, sender=UserGroup)
@@ -45,10 +81,8 @@ def notify_user_of_joining(sender, instance: UserGroup, created: bool, **kwargs)
     """Triggered when a user is added to a group"""
     if not created:
         return
+    membership_cache.invalidate(instance.group_id)
     # send this message to the whole channel to notify everyone listening that a new group member has joined.
     # in the case where the new user receives the notification, they will attempt to retrieve the latest AES key from
     # the server
-    channel_layer = get_channel_layer()
-    group_id = str(instance.group.id)
-    message = {"type": "send.message", "message_type": "new_user", "message": f"{instance.user.id}"}
-    async_to_sync(channel_layer.group_send)(group_id, message)
+    broadcast(str(instance.group_id), "new_user", f"{instance.user_id}")
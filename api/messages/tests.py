@@ -1,3 +1,912 @@
-from django.test import TestCase
+import base64
+import copy
+import json
+import os
+import tempfile
+from datetime import date, datetime, timedelta
+from datetime import timezone as dt_timezone
+from io import StringIO
+from typing import Optional
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+from django.core import signing
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.transaction import TransactionManagementError
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework import status
+
+from accounts.models import User
+from api import settings
+from api.testing import UserTestCase, create_group, create_user
+from crypto.models import SymmetricKey
+from crypto.services import key_management_service
+from websockets.services.event_dispatcher import event_dispatcher
+
+from .management.commands import explain_hot_queries, load_test
+from .models import Message, MessageGroup, RemovedMember, UserGroup
+from .pagination import MessageCursorPagination
+from .services import archive, ingest, retention, sequences, sync
+from .services.partitions import month_partition
+
+
+class ListQueryCountTests(UserTestCase):
+    """The number of queries made by the list endpoints should not depend on the number of results"""
+
+    user_count = 5
+
+    def create_messages(self, group: MessageGroup, authors) -> None:
+        for author in authors:
+            Message.objects.create(user=author, group=group, cipher_text=b"cipher", initialisation_vector=bytes(16))
+
+    def count_queries(self, url: str) -> int:
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+
+    def test_group_list(self):
+        url = reverse("messages:groups-list")
+        self.create_group(self.users[:1])
+        expected = self.count_queries(url)
+        for _ in range(5):
+            self.create_group(self.users)
+        self.assertEqual(self.count_queries(url), expected)
+
+    def test_group_message_list(self):
+        group = self.create_group(self.users)
+        url = reverse("messages:groups-message-list", kwargs={"parent_lookup_group_id": group.id})
+        self.create_messages(group, self.users[:1])
+        expected = self.count_queries(url)
+        self.create_messages(group, self.users * 5)
+        self.assertEqual(self.count_queries(url), expected)
+
+    def test_group_user_list(self):
+        group = self.create_group(self.users[:1])
+        url = reverse("messages:groups-users-list", kwargs={"parent_lookup_group_id": group.id})
+        expected = self.count_queries(url)
+        for user in self.users[1:]:
+            UserGroup.objects.create(user=user, group=group)
+        self.assertEqual(self.count_queries(url), expected)
+
+
+class MessageTestCase(UserTestCase):
+    """A group of users, authenticated as the first of them"""
+
+    def setUp(self):
+        super().setUp()
+        self.group = self.create_group(self.users)
+
+    def create_messages(self, count: int, group: Optional[MessageGroup] = None, author: Optional[User] = None) -> list:
+        return [
+            Message.objects.create(
+                user=author or self.users[1],
+                group=group or self.group,
+                cipher_text=f"{index}".encode(),
+                initialisation_vector=bytes(16),
+            )
+            for index in range(count)
+        ]
+
+    def messages_url(self, group: Optional[MessageGroup] = None) -> str:
+        return reverse("messages:groups-message-list", kwargs={"parent_lookup_group_id": (group or self.group).id})
+
+
+class MessageCursorPaginationTests(MessageTestCase):
+    """Pages of a group's messages should be fetched relative to a message, newest first, without counting them"""
+
+    def setUp(self):
+        super().setUp()
+        self.messages = self.create_messages(12)
+        # newest first, as every page is
+        self.ids = [str(message.id) for message in reversed(self.messages)]
+
+    def get_page(self, url: str, **params) -> dict:
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data
+
+    def page_ids(self, page: dict) -> list:
+        return [str(message["id"]) for message in page["results"]]
+
+    def test_first_page(self):
+        page = self.get_page(self.messages_url(), page_size=5)
+        self.assertEqual(self.page_ids(page), self.ids[:5])
+        self.assertIsNotNone(page["next"])
+        self.assertIsNone(page["previous"])
+
+    def test_older_pages(self):
+        page = self.get_page(self.messages_url(), page_size=5)
+        ids = self.page_ids(page)
+        while page["next"]:
+            page = self.get_page(page["next"])
+            ids += self.page_ids(page)
+        self.assertEqual(ids, self.ids)
+        self.assertIsNotNone(page["previous"])
+
+    def test_newer_pages(self):
+        before = MessageCursorPagination.encode_cursor(self.messages[2].pkid)
+        page = self.get_page(self.messages_url(), before=before, page_size=5)
+        # the page after a cursor holds the oldest messages newer than it, still newest first
+        page = self.get_page(page["previous"])
+        self.assertEqual(self.page_ids(page), self.ids[5:10])
+        page = self.get_page(page["previous"])
+        self.assertEqual(self.page_ids(page), self.ids[:5])
+        self.assertIsNone(page["previous"])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.messages_url(), {"before": "not-a-cursor"})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_page_size_limited(self):
+        self.create_messages(MessageCursorPagination.max_page_size)
+        page = self.get_page(self.messages_url(), page_size=MessageCursorPagination.max_page_size + 1)
+        self.assertEqual(len(page["results"]), MessageCursorPagination.max_page_size)
+
+    def test_not_counted(self):
+        with CaptureQueriesContext(connection) as context:
+            self.get_page(self.messages_url(), before=MessageCursorPagination.encode_cursor(self.messages[6].pkid))
+        self.assertFalse(any("COUNT(" in query["sql"].upper() for query in context.captured_queries))
+
+
+class CompactMessageTests(MessageTestCase):
+    """Compact pages of messages should reference their authors by id, with each author's details sent once"""
+
+    def test_users_map(self):
+        messages = self.create_messages(3) + self.create_messages(2, author=self.user)
+        response = self.client.get(self.messages_url(), {"compact": "true"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [message["user"] for message in response.data["results"]],
+            [str(message.user_id) for message in reversed(messages)],
+        )
+        self.assertEqual(set(response.data["users"]), {str(self.users[1].id), str(self.user.id)})
+        self.assertEqual(response.data["users"][str(self.users[1].id)]["last_name"], "User1")
+
+    def test_same_messages_as_full(self):
+        self.create_messages(3)
+        full = self.client.get(self.messages_url()).data
+        compact = self.client.get(self.messages_url(), {"compact": "true"}).data
+        fields = ("id", "cipher_text", "initialisation_vector", "sequence")
+        for full_message, compact_message in zip(full["results"], compact["results"], strict=True):
+            self.assertEqual(
+                {field: full_message[field] for field in fields}, {field: compact_message[field] for field in fields}
+            )
+            self.assertEqual(str(compact_message["user"]), full_message["user"]["id"])
+        self.assertNotIn("users", full)
+
+    def test_empty_page(self):
+        response = self.client.get(self.messages_url(), {"compact": "true"})
+        self.assertEqual((response.data["results"], response.data["users"]), ([], {}))
+
+
+class BinaryMessageTests(MessageTestCase):
+    """Cipher texts and IVs should be stored as bytes, sent as base64 over JSON and as raw bytes over MessagePack"""
+
+    cipher_text = bytes(range(256))
+    initialisation_vector = bytes(range(16))
+
+    def post_msgpack(self, body: dict):
+        return self.client.post(
+            self.messages_url(),
+            msgpack.packb(body),
+            content_type="application/msgpack",
+            HTTP_ACCEPT="application/msgpack",
+        )
+
+    def stored_message(self) -> Message:
+        return Message.objects.get(group=self.group)
+
+    def test_json_round_trip(self):
+        body = {
+            "cipher_text": base64.b64encode(self.cipher_text).decode(),
+            "initialisation_vector": base64.b64encode(self.initialisation_vector).decode(),
+        }
+        response = self.client.post(self.messages_url(), body, format="json")
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        message = self.stored_message()
+        self.assertEqual(
+            (bytes(message.cipher_text), bytes(message.initialisation_vector)),
+            (self.cipher_text, self.initialisation_vector),
+        )
+        listed = self.client.get(self.messages_url()).data["results"][0]
+        self.assertEqual({field: listed[field] for field in body}, body)
+
+    def test_msgpack_round_trip(self):
+        response = self.post_msgpack(
+            {"cipher_text": self.cipher_text, "initialisation_vector": self.initialisation_vector}
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(msgpack.unpackb(response.content)["cipher_text"], self.cipher_text)
+        self.assertEqual(bytes(self.stored_message().cipher_text), self.cipher_text)
+        response = self.client.get(self.messages_url(), HTTP_ACCEPT="application/msgpack")
+        listed = msgpack.unpackb(response.content)["results"][0]
+        self.assertEqual(
+            (listed["cipher_text"], listed["initialisation_vector"]), (self.cipher_text, self.initialisation_vector)
+        )
+        # the same message is base64 over JSON
+        listed = self.client.get(self.messages_url()).data["results"][0]
+        self.assertEqual(listed["cipher_text"], base64.b64encode(self.cipher_text).decode())
+
+    def test_msgpack_accepts_base64(self):
+        body = {"cipher_text": "YWJj", "initialisation_vector": base64.b64encode(self.initialisation_vector).decode()}
+        self.assertEqual(self.post_msgpack(body).status_code, status.HTTP_201_CREATED)
+        self.assertEqual(bytes(self.stored_message().cipher_text), b"abc")
+
+    def test_invalid(self):
+        valid = {"cipher_text": "YWJj", "initialisation_vector": base64.b64encode(self.initialisation_vector).decode()}
+        for field, value in (
+            ("cipher_text", "not base64!"),
+            ("cipher_text", ""),
+            ("cipher_text", 123),
+            ("initialisation_vector", base64.b64encode(bytes(17)).decode()),
+        ):
+            with self.subTest(field=field, value=value):
+                response = self.client.post(self.messages_url(), {**valid, field: value}, format="json")
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn(field, response.data)
+        response = self.post_msgpack({**valid, "initialisation_vector": bytes(17)})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Message.objects.filter(group=self.group).exists())
+
+    def test_invalid_msgpack(self):
+        response = self.client.post(self.messages_url(), b"\xc1", content_type="application/msgpack")
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ArchiveTests(MessageTestCase):
+    """Pages of older messages should continue into the archive, unless they are filtered or of newer messages"""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        read_index = archive._index
+        for patch in (
+            # every read, including the view's, is of the test's archive
+            mock.patch.object(archive, "_index", side_effect=lambda _: read_index(self.directory)),
+            # the month is archived from the message table, as it is without partitioning
+            mock.patch.object(archive, "is_partitioned", return_value=False),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.archived = self.archive_messages(self.create_messages(5), date(2024, 1, 1))
+        self.messages = self.create_messages(5)
+        # newest first, as every page is
+        self.ids = [str(message.id) for message in reversed(self.archived + self.messages)]
+
+    def archive_messages(self, messages: list, month: date) -> list:
+        """Move messages into the archived partition of a month, out of the database"""
+        partition = month_partition(month)
+        queryset = Message.objects.filter(pkid__in=[message.pkid for message in messages])
+        queryset.update(created_at=partition.start + timedelta(days=1))
+        archive.archive_partition(partition, self.directory)
+        queryset.delete()
+        return messages
+
+    def page_ids(self, **params) -> list:
+        response = self.client.get(self.messages_url(), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [str(message["id"]) for message in response.data["results"]]
+
+    def test_pages_continue_into_archive(self):
+        response = self.client.get(self.messages_url(), {"page_size": 3})
+        ids, pages = [], 0
+        while True:
+            ids += [str(message["id"]) for message in response.data["results"]]
+            pages += 1
+            if not response.data["next"]:
+                break
+            response = self.client.get(response.data["next"])
+        self.assertEqual(ids, self.ids)
+        self.assertEqual(pages, 4)
+
+    def test_archived_messages_decoded(self):
+        response = self.client.get(self.messages_url(), {"page_size": 10})
+        oldest = response.data["results"][-1]
+        self.assertEqual(oldest["id"], str(self.archived[0].id))
+        self.assertEqual((oldest["cipher_text"], oldest["sequence"]), ("MA==", 1))
+        self.assertEqual(oldest["user"]["id"], str(self.users[1].id))
+
+    def test_filtered_pages_not_read_from_archive(self):
+        # every archived message would match the filter, but the archive cannot be filtered, so is not read
+        self.assertEqual(self.page_ids(sequence__gte=1, page_size=20), self.ids[:5])
+        self.assertEqual(self.page_ids(sequence__lte=7, page_size=20), self.ids[3:5])
+
+    def test_newer_pages_not_read_from_archive(self):
+        after = MessageCursorPagination.encode_cursor(self.archived[0].pkid)
+        self.assertEqual(self.page_ids(after=after, page_size=20), self.ids[:5])
+
+    def test_reads_stop_at_limit(self):
+        newer = self.archive_messages(self.create_messages(3), date(2024, 2, 1))
+        with mock.patch.object(archive, "_read_newest", wraps=archive._read_newest) as read_newest:
+            messages = archive.archived_messages(self.group.id, limit=3)
+        # the older month's file cannot hold any of the newest messages, so is not opened
+        self.assertEqual(read_newest.call_count, 1)
+        self.assertEqual([message.id for message in messages], [message.id for message in reversed(newer)])
+        messages = archive.archived_messages(self.group.id, before=newer[1].pkid, limit=3)
+        self.assertEqual([message.id for message in messages], [newer[0].id, self.archived[4].id, self.archived[3].id])
+
+    def test_archive_index(self):
+        self.assertEqual(archive.archived_until(), datetime(2024, 2, 1, tzinfo=dt_timezone.utc))
+        self.assertTrue(archive.has_archived_messages(self.group.id))
+        self.assertTrue(archive.has_archived_messages(self.group.id, before=self.archived[1].pkid))
+        self.assertFalse(archive.has_archived_messages(self.group.id, before=self.archived[0].pkid))
+        self.assertFalse(archive.has_archived_messages(self.create_group(self.users).id))
+
+    def test_deleted_group_removed_from_archive(self):
+        archived_file = os.path.join(
+            self.directory, month_partition(date(2024, 1, 1)).name, f"{self.group.id}.jsonl.gz"
+        )
+        # the removals of the group's members are broadcast once it commits
+        with mock.patch.object(event_dispatcher, "enqueue"), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(reverse("messages:groups-detail", kwargs={"id": self.group.id}))
+            self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+            # the group could still be restored by a rollback until the transaction commits
+            self.assertTrue(os.path.exists(archived_file))
+        self.assertFalse(os.path.exists(archived_file))
+        self.assertEqual(archive.archived_messages(self.group.id), [])
+
+
+class ExplainHotQueriesTests(UserTestCase):
+    """The hot queries should be planned without scanning whole tables, with the seeded dataset rolled back"""
+
+    options = {"users": 30, "groups": 5, "members": 4, "keys": 3, "messages": 10}
+
+    def setUp(self):
+        super().setUp()
+        if connection.vendor == "postgresql":
+            # the planner prefers reading tables this small in full, so is made to use an index wherever there is one,
+            # until the test's transaction is rolled back
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+
+    def explain(self, **options) -> str:
+        stdout = StringIO()
+        call_command("explain_hot_queries", **{**self.options, **options}, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_no_sequential_scans(self):
+        output = self.explain()
+        self.assertIn("No sequential scans found", output)
+        self.assertIn("page of group messages:", output)
+        self.assertEqual(User.objects.count(), self.user_count)
+        self.assertFalse(MessageGroup.objects.exists())
+
+    def test_sequential_scans_reported(self):
+        command = explain_hot_queries.Command
+        # the seeded tables are small enough that scans of them would otherwise be allowed on PostgreSQL
+        with mock.patch.object(
+            command, "hot_queries", return_value={"every user": User.objects.all()}
+        ), mock.patch.object(command, "single_page_tables", return_value=set()):
+            with self.assertRaisesMessage(CommandError, "every user scans"):
+                self.explain()
+        self.assertFalse(Message.objects.exists())
+
+
+class LoadTestTests(TransactionTestCase):
+    """A small load test should run every phase and deliver each message to every connection, without failures"""
+
+    def setUp(self):
+        # the command would otherwise set up a test database of its own, so it is run against this one
+        for patch in (
+            mock.patch.object(load_test, "setup_databases"),
+            mock.patch.object(load_test, "teardown_databases"),
+            mock.patch.object(settings, "KEY_WRAPPING_WORKERS", 0),
+            mock.patch.dict(connection.settings_dict, copy.deepcopy(connection.settings_dict)),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_smoke(self):
+        options = {"users": 3, "groups": 2, "members": 2, "messages": 4, "concurrency": 2, "drain_timeout": 5}
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "report.json")
+            stdout = StringIO()
+            call_command("load_test", **options, output=output, stdout=stdout, stderr=StringIO())
+            with open(output) as report_file:
+                report = json.load(report_file)
+        self.assertIn("Load test complete", stdout.getvalue())
+        self.assertEqual(report["failures"], {})
+        self.assertEqual(report["connections"], 4)
+        self.assertEqual(report["fan_out"]["delivered"], report["fan_out"]["expected"])
+        self.assertEqual(report["fan_out"]["expected"], 8)
+        self.assertEqual(report["operations"]["post message"]["count"], 4)
+
+
+class RetentionTests(MessageTestCase):
+    """Messages older than their group's retention period should be purged in batches, along with unneeded keys"""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        # months are archived from the message table, as they are without partitioning
+        patch = mock.patch.object(archive, "is_partitioned", return_value=False)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def backdate(self, messages: list, days: int) -> None:
+        Message.objects.filter(pkid__in=[message.pkid for message in messages]).update(
+            created_at=timezone.now() - timedelta(days=days)
+        )
+
+    def purge(self, archive_dir: str) -> str:
+        stdout = StringIO()
+        call_command("purge_expired", pause=0, archive_dir=archive_dir, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_delete_in_batches(self):
+        self.create_messages(7)
+        progress = []
+        deleted = retention.delete_in_batches(
+            Message.objects.filter(group=self.group),
+            batch_size=3,
+            progress=lambda deleted, remaining, rate: progress.append((deleted, remaining)),
+        )
+        self.assertEqual(deleted, 7)
+        self.assertEqual(progress, [(3, 4), (6, 1), (7, 0)])
+        self.assertFalse(Message.objects.filter(group=self.group).exists())
+
+    def test_expired_messages_purged(self):
+        MessageGroup.objects.filter(pk=self.group.pk).update(retention_days=30)
+        self.backdate(self.create_messages(3), days=31)
+        kept = self.create_messages(2)
+        other_group = self.create_group(self.users)
+        self.backdate(self.create_messages(2, group=other_group), days=365)
+        deleted = retention.purge_expired_messages(batch_size=2, archive_directory=self.directory)
+        self.assertEqual(deleted, {"database": 3, "archive": 0})
+        self.assertEqual(list(Message.objects.filter(group=self.group)), kept[::-1])
+        # groups without a retention period keep their messages forever
+        self.assertEqual(Message.objects.filter(group=other_group).count(), 2)
+
+    def test_expired_archive_purged(self):
+        MessageGroup.objects.filter(pk=self.group.pk).update(retention_days=30)
+        self.create_messages(4)
+        partition = month_partition(date(2024, 1, 1))
+        Message.objects.update(created_at=partition.start)
+        archive.archive_partition(partition, self.directory)
+        Message.objects.all().delete()
+        deleted = retention.purge_expired_messages(archive_directory=self.directory)
+        self.assertEqual(deleted, {"database": 0, "archive": 4})
+        self.assertEqual(archive.archived_messages(self.group.id, directory=self.directory), [])
+
+    def test_missing_archive_dir(self):
+        # without the archive, keys still encrypting archived messages would be deleted
+        with self.assertRaises(CommandError):
+            self.purge(os.path.join(self.directory, "missing"))
+
+    def test_superseded_keys_kept_for_archive(self):
+        first_key = SymmetricKey.objects.get(group=self.group)
+        SymmetricKey.objects.filter(pk=first_key.pk).update(created_at=datetime(2024, 1, 10, tzinfo=dt_timezone.utc))
+        SymmetricKey.objects.create(
+            group=self.group, key="key", created_at=datetime(2024, 2, 10, tzinfo=dt_timezone.utc)
+        )
+        empty_directory = os.path.join(self.directory, "empty")
+        archive_directory = os.path.join(self.directory, "archive")
+        os.makedirs(empty_directory)
+        # the archived month may hold messages encrypted with the first key
+        archive.archive_partition(month_partition(date(2024, 1, 1)), archive_directory)
+        self.purge(archive_directory)
+        self.assertTrue(SymmetricKey.objects.filter(pk=first_key.pk).exists())
+        output = self.purge(empty_directory)
+        self.assertIn("Deleted 1 superseded", output)
+        self.assertFalse(SymmetricKey.objects.filter(pk=first_key.pk).exists())
+        self.assertEqual(SymmetricKey.objects.filter(group=self.group).count(), 1)
+
+
+class SyncTests(MessageTestCase):
+    """Reconnecting clients should be streamed every event since their watermark, each group by its sequence numbers"""
+
+    def setUp(self):
+        super().setUp()
+        self.other_group = self.create_group(self.users[:2])
+        self.url = reverse("messages:sync-list")
+
+    def sync(self, since: Optional[str] = None, **params) -> list:
+        if since is not None:
+            params["since"] = since
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        events = [json.loads(line) for line in b"".join(response).decode().splitlines()]
+        self.assertEqual(events[-1]["type"], "watermark")
+        return events
+
+    def settle(self) -> None:
+        # rows within the in flight window are sent again by every sync, so those made so far are moved out of it
+        for model in (UserGroup, RemovedMember, SymmetricKey):
+            model.objects.update(created_at=timezone.now() - sync.IN_FLIGHT_WINDOW - timedelta(seconds=1))
+
+    def of_type(self, events: list, message_type: str) -> list:
+        return [(event["group"], event["message"]) for event in events if event["type"] == message_type]
+
+    def test_first_sync(self):
+        self.create_messages(2)
+        self.settle()
+        events = self.sync()
+        # without a watermark, only the watermark to continue from is returned
+        self.assertEqual([event["type"] for event in events], ["watermark"])
+
+    def test_messages_since_watermark(self):
+        self.create_messages(2)
+        watermark = self.sync()[-1]["message"]
+        new_messages = self.create_messages(2) + self.create_messages(1, group=self.other_group)
+        events = self.sync(watermark)
+        self.assertEqual(
+            [message["id"] for _, message in self.of_type(events, "new_message")],
+            [str(message.id) for message in new_messages],
+        )
+        # the returned watermark is past every message sent
+        self.assertEqual(self.of_type(self.sync(events[-1]["message"]), "new_message"), [])
+
+    def test_groups(self):
+        self.settle()
+        watermark = self.sync()[-1]["message"]
+        self.create_messages(1)
+        message = self.create_messages(1, group=self.other_group)[0]
+        events = self.sync(watermark, groups=str(self.other_group.id))
+        self.assertEqual([message["id"] for _, message in self.of_type(events, "new_message")], [str(message.id)])
+
+    def test_not_member(self):
+        group = self.create_group(self.users[1:])
+        response = self.client.get(self.url, {"groups": str(group.id)})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_invalid_watermark(self):
+        response = self.client.get(self.url, {"since": "not-a-watermark"})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_forged_watermark(self):
+        watermark = sync.decode_watermark(self.sync()[-1]["message"], self.user)
+        forged = signing.dumps({**watermark, "keys": 0, "user": str(self.user.id)}, key="not-the-secret-key")
+        self.assertEqual(self.client.get(self.url, {"since": forged}).status_code, status.HTTP_400_BAD_REQUEST)
+        unsigned = base64.urlsafe_b64encode(json.dumps({**watermark, "keys": 0}).encode()).decode()
+        self.assertEqual(self.client.get(self.url, {"since": unsigned}).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_watermark_of_another_user(self):
+        watermark = self.sync()[-1]["message"]
+        self.client.force_authenticate(self.users[1])
+        response = self.client.get(self.url, {"since": watermark})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_keys_from_before_joining(self):
+        self.settle()
+        watermark = self.sync()[-1]["message"]
+        group = self.create_group(self.users[1:])
+        for _ in range(2):
+            key_management_service.generate_key_for_group(group)
+        self.settle()
+        UserGroup.objects.create(user=self.user, group=group)
+        events = self.sync(watermark)
+        # only the key in use when the user joined is sent, as with the key history, not the keys before it
+        latest_key = SymmetricKey.objects.filter(group=group).latest("pkid")
+        self.assertEqual(self.of_type(events, "new_key"), [(str(group.id), {"id": str(latest_key.id)})])
+
+    def test_membership_and_keys_before_messages(self):
+        self.settle()
+        watermark = self.sync()[-1]["message"]
+        self.create_messages(1)
+        UserGroup.objects.create(user=self.users[2], group=self.other_group)
+        symmetric_key = key_management_service.generate_key_for_group(self.group)
+        events = self.sync(watermark)
+        self.assertEqual([event["type"] for event in events], ["new_user", "new_key", "new_message", "watermark"])
+        self.assertEqual(self.of_type(events, "new_user"), [(str(self.other_group.id), str(self.users[2].id))])
+        # the user has no RSA key to wrap the key with, so is only told its id
+        self.assertEqual(self.of_type(events, "new_key"), [(str(self.group.id), {"id": str(symmetric_key.id)})])
+
+    def test_removals(self):
+        self.settle()
+        watermark = self.sync()[-1]["message"]
+        UserGroup.objects.filter(user=self.users[1], group=self.group).delete()
+        UserGroup.objects.filter(user=self.user, group=self.other_group).delete()
+        removals = self.of_type(self.sync(watermark), "member_removed")
+        # the user is told about their own removal, even though they no longer sync the group
+        self.assertCountEqual(
+            removals, [(str(self.group.id), str(self.users[1].id)), (str(self.other_group.id), str(self.user.id))]
+        )
+
+    def test_in_flight_rows_sent_again(self):
+        self.settle()
+        watermark = self.sync()[-1]["message"]
+        symmetric_key = key_management_service.generate_key_for_group(self.group)
+        events = self.sync(watermark)
+        # the key may have been created after a key that has not committed yet, so the watermark stays before it
+        self.assertEqual(self.of_type(self.sync(events[-1]["message"]), "new_key"), self.of_type(events, "new_key"))
+        self.settle()
+        events = self.sync(events[-1]["message"])
+        self.assertEqual([key["id"] for _, key in self.of_type(events, "new_key")], [str(symmetric_key.id)])
+        self.assertEqual(self.of_type(self.sync(events[-1]["message"]), "new_key"), [])
+
+    def test_limit(self):
+        watermark = self.sync()[-1]["message"]
+        messages = self.create_messages(5)
+        with mock.patch.object(sync, "SYNC_LIMIT", 3):
+            events = self.sync(watermark)
+            self.assertEqual(len(self.of_type(events, "new_message")), 3)
+            self.assertTrue(events[-1]["has_more"])
+            events = self.sync(events[-1]["message"])
+        self.assertEqual(
+            [message["id"] for _, message in self.of_type(events, "new_message")],
+            [str(message.id) for message in messages[3:]],
+        )
+        self.assertFalse(events[-1]["has_more"])
+
+
+class MessageBatchTests(MessageTestCase):
+    """Many messages, to one or more groups, should be created together, with one event per group"""
+
+    def setUp(self):
+        super().setUp()
+        self.other_group = self.create_group(self.users[:2])
+        self.url = reverse("messages:batch-list")
+
+    def batch(self, groups: list, key=None) -> list:
+        messages = []
+        for group in groups:
+            message = {"group": str(group.id), "cipher_text": "YWJj", "initialisation_vector": "A" * 22 + "=="}
+            if key is not None:
+                message["key"] = str(key.id)
+            messages.append(message)
+        return messages
+
+    def post(self, messages: list):
+        with mock.patch.object(ingest, "broadcast") as broadcast:
+            response = self.client.post(self.url, {"messages": messages}, format="json")
+        self.broadcasts = broadcast.call_args_list
+        return response
+
+    def test_created_in_order(self):
+        self.create_messages(2)
+        key = SymmetricKey.objects.filter(group=self.group).first()
+        groups = [self.group, self.other_group, self.group, self.group, self.other_group]
+        response = self.post(self.batch(groups[:1], key) + self.batch(groups[1:]))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        created = response.data["messages"]
+        self.assertEqual([message["group"] for message in created], [group.id for group in groups])
+        self.assertEqual([message["sequence"] for message in created], [3, 1, 4, 5, 2])
+        self.assertEqual(created[0]["key"], str(key.id))
+        self.assertEqual(Message.objects.filter(user=self.user).count(), 5)
+
+    def test_one_event_per_group(self):
+        response = self.post(self.batch([self.group, self.other_group, self.group]))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        events = {call.args[0]: call.args[1:] for call in self.broadcasts}
+        self.assertEqual(set(events), {str(self.group.id), str(self.other_group.id)})
+        message_type, messages = events[str(self.group.id)]
+        self.assertEqual(message_type, "new_messages")
+        self.assertEqual([message["sequence"] for message in messages], [1, 2])
+
+    def test_not_member(self):
+        group = self.create_group(self.users[1:])
+        response = self.post(self.batch([self.group, group]))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(Message.objects.exists())
+
+    def test_key_of_other_group(self):
+        key = SymmetricKey.objects.filter(group=self.other_group).first()
+        response = self.post(self.batch([self.group], key))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Message.objects.exists())
+
+    def test_limit(self):
+        response = self.post(self.batch([self.group] * (settings.MESSAGE_BATCH_LIMIT + 1)))
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_count(self):
+        with CaptureQueriesContext(connection) as context:
+            self.post(self.batch([self.group, self.other_group]))
+        expected = len(context.captured_queries)
+        with CaptureQueriesContext(connection) as context:
+            self.post(self.batch([self.group, self.other_group] * 20))
+        self.assertEqual(len(context.captured_queries), expected)
+
+
+class KeyRotationTests(MessageTestCase):
+    """A group's key should be rotated once for however many of its members are removed together"""
+
+    def setUp(self):
+        super().setUp()
+        self.users += [create_user(index) for index in range(3, 5)]
+        for user in self.users[3:]:
+            UserGroup.objects.create(user=user, group=self.group)
+        self.bulk_url = reverse(
+            "messages:groups-users-bulk-update-members", kwargs={"parent_lookup_group_id": self.group.id}
+        )
+        self.keys = SymmetricKey.objects.filter(group=self.group)
+        self.key_count = self.keys.count()
+
+    def new_keys(self) -> int:
+        return self.keys.count() - self.key_count
+
+    def members(self) -> set:
+        return set(UserGroup.objects.filter(group=self.group).values_list("user_id", flat=True))
+
+    def test_bulk_removal(self):
+        response = self.client.post(self.bulk_url, {"remove": [str(user.id) for user in self.users[2:]]}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertCountEqual(response.data["removed"], [user.id for user in self.users[2:]])
+        self.assertEqual(self.members(), {self.users[0].id, self.users[1].id})
+        self.assertEqual(self.new_keys(), 1)
+
+    def test_members_added_before_rotation(self):
+        new_user = create_user(5)
+        members_at_rotation = []
+        generate_key_for_group = key_management_service.generate_key_for_group
+
+        def record_members(group):
+            members_at_rotation.append(self.members())
+            return generate_key_for_group(group)
+
+        with mock.patch.object(key_management_service, "generate_key_for_group", side_effect=record_members):
+            response = self.client.post(
+                self.bulk_url, {"add": [str(new_user.id)], "remove": [str(self.users[2].id)]}, format="json"
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["added"], [new_user.id])
+        # the new member is given the new key along with everyone else
+        self.assertEqual(members_at_rotation, [self.members()])
+        self.assertIn(new_user.id, members_at_rotation[0])
+
+    def test_additions_not_rotated(self):
+        new_user = create_user(5)
+        response = self.client.post(self.bulk_url, {"add": [str(new_user.id)]}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.new_keys(), 0)
+
+    def test_invalid_changes_not_made(self):
+        for body in (
+            {"add": [str(self.users[1].id)], "remove": [str(self.users[1].id)]},
+            {"add": [str(User().id)], "remove": [str(self.users[2].id)]},
+            {},
+        ):
+            with self.subTest(body=body):
+                response = self.client.post(self.bulk_url, body, format="json")
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(self.members()), 5)
+        self.assertEqual(self.new_keys(), 0)
+
+    def test_not_member(self):
+        self.client.force_authenticate(create_user(5))
+        response = self.client.post(self.bulk_url, {"remove": [str(self.users[2].id)]}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(len(self.members()), 5)
+
+    def test_nested_blocks_rotate_once(self):
+        with key_management_service.coalesce_key_rotations():
+            UserGroup.objects.filter(user=self.users[2], group=self.group).delete()
+            with key_management_service.coalesce_key_rotations():
+                UserGroup.objects.filter(user=self.users[3], group=self.group).delete()
+            self.assertEqual(self.new_keys(), 0)
+        self.assertEqual(self.new_keys(), 1)
+
+    def test_deleted_group_not_rotated(self):
+        response = self.client.delete(reverse("messages:groups-detail", kwargs={"id": self.group.id}))
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(SymmetricKey.objects.filter(group_id=self.group.id).exists())
+
+
+class ReadReceiptTests(MessageTestCase):
+    """Groups should be listed with their latest message and the user's unread count, which marking read moves"""
+
+    def setUp(self):
+        super().setUp()
+        self.read_url = reverse("messages:groups-mark-read", kwargs={"id": self.group.id})
+
+    def summary(self, group: Optional[MessageGroup] = None) -> dict:
+        response = self.client.get(reverse("messages:groups-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return next(summary for summary in response.data["results"] if summary["id"] == str((group or self.group).id))
+
+    def test_summary(self):
+        self.assertEqual(
+            {key: self.summary()[key] for key in ("last_message", "last_message_at", "unread_count")},
+            {"last_message": None, "last_message_at": None, "unread_count": 0},
+        )
+        messages = self.create_messages(3)
+        # the user's own messages are never unread
+        self.create_messages(1, author=self.user)
+        latest = self.create_messages(1)[0]
+        summary = self.summary()
+        self.assertEqual(summary["last_message"], str(latest.id))
+        self.assertIsNotNone(summary["last_message_at"])
+        self.assertEqual(summary["unread_count"], len(messages) + 1)
+
+    def test_not_member(self):
+        group = self.create_group(self.users[1:])
+        UserGroup.objects.filter(group=group, user=self.user).delete()
+        self.create_messages(2, group=group)
+        # the user has no read receipt for the group, so no count is made over its history
+        self.assertIsNone(self.summary(group)["unread_count"])
+
+    def test_mark_read(self):
+        messages = self.create_messages(4)
+        response = self.client.post(self.read_url, {"message": str(messages[1].id)}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {"last_read": messages[1].id, "unread_count": 2})
+        self.assertEqual(self.summary()["unread_count"], 2)
+        response = self.client.post(self.read_url, {}, format="json")
+        self.assertEqual(response.data, {"last_read": messages[3].id, "unread_count": 0})
+        self.assertEqual(self.summary()["unread_count"], 0)
+
+    def test_never_moves_backwards(self):
+        messages = self.create_messages(4)
+        self.client.post(self.read_url, {"message": str(messages[2].id)}, format="json")
+        response = self.client.post(self.read_url, {"message": str(messages[0].id)}, format="json")
+        self.assertEqual(response.data["unread_count"], 1)
+
+    def test_unknown_message(self):
+        other_message = self.create_messages(1, group=self.create_group(self.users))[0]
+        response = self.client.post(self.read_url, {"message": str(other_message.id)}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_mark_read_not_member(self):
+        UserGroup.objects.filter(group=self.group, user=self.user).delete()
+        response = self.client.post(self.read_url, {}, format="json")
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class SequenceTests(MessageTestCase):
+    """Each group's messages should be numbered from 1 without gaps, independently of other groups"""
+
+    def post_message(self, group: Optional[MessageGroup] = None) -> dict:
+        response = self.client.post(
+            self.messages_url(group), {"cipher_text": "YWJj", "initialisation_vector": "A" * 22 + "=="}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data
+
+    def test_numbered_per_group(self):
+        other_group = self.create_group(self.users)
+        sequences = [self.post_message(group)["sequence"] for group in (self.group, other_group, self.group)]
+        self.assertEqual(sequences, [1, 1, 2])
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.message_sequence, 2)
+
+    def test_allocate_range(self):
+        self.create_messages(2)
+        with transaction.atomic():
+            self.assertEqual(sequences.allocate_sequences(self.group.id, 5), 3)
+            self.assertEqual(sequences.allocate_sequences(self.group.id), 8)
+
+    def test_allocate_outside_transaction(self):
+        # the group's counter would be unlocked before the messages are inserted
+        with mock.patch.object(connection, "in_atomic_block", False):
+            with self.assertRaises(TransactionManagementError):
+                sequences.allocate_sequences(self.group.id)
+
+    def test_unknown_group(self):
+        with transaction.atomic(), self.assertRaises(MessageGroup.DoesNotExist):
+            sequences.allocate_sequences(MessageGroup().id)
+
+    def test_filtered_by_sequence(self):
+        self.create_messages(10)
+        response = self.client.get(self.messages_url(), {"sequence__gt": 3, "sequence__lt": 7})
+        self.assertEqual([message["sequence"] for message in response.data["results"]], [6, 5, 4])
+
+
+class SequenceTransactionTests(TransactionTestCase):
+    """Messages saved outside a transaction should still be numbered within the transaction inserting them"""
+
+    def setUp(self):
+        # the changes are committed, so the work done after commit is left out
+        for patch in (
+            mock.patch.object(event_dispatcher, "enqueue"),
+            mock.patch.object(key_management_service, "run_in_background"),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_saved_outside_transaction(self):
+        user = create_user(0)
+        group = create_group(user, [])
+        self.assertFalse(connection.in_atomic_block)
+        for _ in range(3):
+            Message.objects.create(user=user, group=group, cipher_text=b"cipher", initialisation_vector=bytes(16))
+        self.assertEqual(list(Message.objects.filter(group=group).values_list("sequence", flat=True)), [3, 2, 1])
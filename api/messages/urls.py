@@ -9,5 +9,7 @@ router = ExtendedDefaultRouter()
 groups_route = router.register(r"groups", views.MessageGroupViewSet, basename="groups")
 groups_route.register(r"messages", views.MessageViewSet, basename="groups-message", parents_query_lookups=["group_id"])
 groups_route.register(r"users", views.UserGroupViewSet, basename="groups-users", parents_query_lookups=["group_id"])
+router.register(r"batch", views.MessageBatchViewSet, basename="batch")
+router.register(r"sync", views.SyncViewSet, basename="sync")
 
 urlpatterns = router.urls
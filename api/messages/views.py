@@ -1,15 +1,37 @@
+from django.db import transaction
+from django.db.models import Prefetch
+from django.http import StreamingHttpResponse
 from rest_framework import mixins, settings, status, viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied
+from rest_framework.generics import get_object_or_404
 from rest_framework.response import Response
 
+from accounts.serializers import UserSerializer
 from api.permissions import IsAuthenticated
+from crypto.services import key_management_service
 
 from .models import Message, MessageGroup, UserGroup
-from .serializers import CreateUserGroupSerializer, MessageGroupSerializer, MessageSerializer
+from .pagination import MessageCursorPagination
+from .serializers import (
+    BulkMembershipSerializer,
+    CompactMessageSerializer,
+    CreateUserGroupSerializer,
+    MessageBatchSerializer,
+    MessageGroupSerializer,
+    MessageSerializer,
+    ReadReceiptSerializer,
+    SyncSerializer,
+    is_compact,
+)
+from .services import archive, ingest, membership, read_receipts, retention, sync
 
 
 class MessageGroupViewSet(viewsets.ModelViewSet):
-    queryset = MessageGroup.objects.all()
+    # the creator and every member are serialised for each group, so are fetched up front rather than one at a time
+    queryset = MessageGroup.objects.select_related("user").prefetch_related(
+        Prefetch("usergroup_set", queryset=UserGroup.objects.select_related("user"))
+    )
     serializer_class = MessageGroupSerializer
     permission_classes = [IsAuthenticated]
     filter_backends = settings.api_settings.DEFAULT_FILTER_BACKENDS
@@ -20,21 +42,101 @@ class MessageGroupViewSet(viewsets.ModelViewSet):
     }
     ordering = ("-pkid",)
 
+    def get_queryset(self):
+        # each group is sent with a summary of its latest message and the user's unread messages for the inbox
+        return read_receipts.annotate_summaries(super().get_queryset(), self.request.user)
+
+    def perform_destroy(self, instance):
+        # removing the members of a group being deleted must not give it new keys
+        with key_management_service.coalesce_key_rotations():
+            super().perform_destroy(instance)
+
+    @action(methods=["post"], detail=True, url_path="read")
+    def mark_read(self, request, *args, **kwargs):
+        """
+        Mark the group's messages as read by the user, up to and including the given `message`, or the latest message
+        if none is given
+        """
+        serializer = ReadReceiptSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        group = get_object_or_404(MessageGroup, id=kwargs["id"])
+        message, unread_count = read_receipts.mark_read(request.user, group, serializer.validated_data.get("message"))
+        return Response({"last_read": message.id if message else None, "unread_count": unread_count})
+
 
 class MessageViewSet(viewsets.ReadOnlyModelViewSet, mixins.CreateModelMixin):
-    queryset = Message.objects.all()
+    queryset = Message.objects.select_related("user", "group")
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated]
     filter_backends = settings.api_settings.DEFAULT_FILTER_BACKENDS
+    pagination_class = MessageCursorPagination
     ordering = ("-pkid",)
+    # lets clients fetch only the messages missing between two sequence numbers, e.g. after a reconnect
+    filterset_fields = {
+        "sequence": ["gt", "gte", "lt", "lte"],
+    }
 
     def filter_queryset(self, queryset):
         parent_id = self.request.parser_context["kwargs"]["parent_lookup_group_id"]
         return super().filter_queryset(queryset.filter(group_id=parent_id))
 
+    def get_archived_messages(self, before=None, limit=None):
+        """
+        Messages of the group that have been archived, used to continue pages past the messages in the database. Those
+        older than the group's retention period are hidden until they are purged
+        """
+        group_id = self.kwargs["parent_lookup_group_id"]
+        # the archive's index answers whether any messages before the cursor have been archived, without reading them
+        if archive.archived_until() is None or not archive.has_archived_messages(group_id, before):
+            return []
+        group = get_object_or_404(MessageGroup, id=group_id)
+        return archive.archived_messages(group.id, before, limit, since=retention.retention_cutoff(group))
+
+    def perform_create(self, serializer):
+        # the group's sequence counter stays locked until the message is inserted, so messages commit in sequence order
+        with transaction.atomic():
+            super().perform_create(serializer)
+
+    def get_serializer_class(self):
+        if self.action == "list" and is_compact(self.request.query_params.get("compact")):
+            return CompactMessageSerializer
+        return super().get_serializer_class()
+
+    def list(self, request, *args, **kwargs):
+        """
+        List a group's messages. With `?compact=true`, messages only hold their author's id and each author is
+        included once in the `users` map of the response, rather than once per message
+        """
+        if not is_compact(request.query_params.get("compact")):
+            return super().list(request, *args, **kwargs)
+        page = self.paginate_queryset(self.filter_queryset(self.get_queryset()))
+        response = self.get_paginated_response(self.get_serializer(page, many=True).data)
+        authors = {message.user_id: message.user for message in page}
+        response.data["users"] = {str(user_id): UserSerializer(user).data for user_id, user in authors.items()}
+        return response
+
+
+class MessageBatchViewSet(viewsets.ViewSet):
+    """
+    Class that handles the HTTP(S) requests sent to the `/messages/batch/` endpoint, allowing integrations to post many
+    messages, to one or more groups, in a single request
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def create(self, request, *args, **kwargs):
+        serializer = MessageBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        messages = ingest.create_messages(request.user, serializer.validated_data["messages"])
+        data = MessageSerializer(messages, many=True, context=self.get_serializer_context()).data
+        return Response({"messages": data}, status=status.HTTP_201_CREATED)
+
+    def get_serializer_context(self):
+        return {"request": self.request, "format": self.format_kwarg, "view": self}
+
 
 class UserGroupViewSet(viewsets.ReadOnlyModelViewSet, mixins.CreateModelMixin):
-    queryset = UserGroup.objects.all()
+    queryset = UserGroup.objects.select_related("user", "group")
     serializer_class = CreateUserGroupSerializer
     permission_classes = [IsAuthenticated]
     filter_backends = settings.api_settings.DEFAULT_FILTER_BACKENDS
@@ -43,5 +145,46 @@ class UserGroupViewSet(viewsets.ReadOnlyModelViewSet, mixins.CreateModelMixin):
     @action(methods=["delete"], detail=False, url_path="remove")
     def remove_user_from_group(self, request, *args, **kwargs):
         parent_id = self.request.parser_context["kwargs"]["parent_lookup_group_id"]
-        self.get_queryset().filter(group_id=parent_id, user_id=request.data.get("user_id")).delete()
+        with key_management_service.coalesce_key_rotations():
+            self.get_queryset().filter(group_id=parent_id, user_id=request.data.get("user_id")).delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @action(methods=["post"], detail=False, url_path="bulk")
+    def bulk_update_members(self, request, *args, **kwargs):
+        """
+        Add and remove many members of the group at once, with `{"add": [<user id>...], "remove": [<user id>...]}`. The
+        group's key is rotated once however many members are removed
+        """
+        parent_id = self.request.parser_context["kwargs"]["parent_lookup_group_id"]
+        group = get_object_or_404(MessageGroup, id=parent_id)
+        if not UserGroup.objects.filter(group=group, user=request.user).exists():
+            raise PermissionDenied("Not a member of the group")
+        serializer = BulkMembershipSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        added, removed = membership.update_members(
+            group, serializer.validated_data["add"], serializer.validated_data["remove"]
+        )
+        return Response({"added": added, "removed": removed})
+
+
+class SyncViewSet(viewsets.ViewSet):
+    """
+    Class that handles the HTTP(S) requests sent to the `/messages/sync/` endpoint, allowing clients to catch up on
+    everything that happened in their groups while they were disconnected
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def list(self, request, *args, **kwargs):
+        """
+        Stream every event since the `since` watermark for the given groups, or all of the user's groups, as newline
+        delimited JSON. Without a watermark, only the current watermark is returned. The events are streamed from an
+        asynchronous iterator, as ASGI servers buffer the whole of a response streamed from a synchronous one
+        """
+        serializer = SyncSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        since = serializer.validated_data.get("since")
+        group_ids = sync.get_group_ids_for_sync(request.user, serializer.validated_data.get("groups"))
+        watermark = sync.decode_watermark(since, request.user) if since else sync.current_watermark(group_ids)
+        events = sync.astream_events(request.user, group_ids, watermark)
+        return StreamingHttpResponse(events, content_type="application/x-ndjson")
@@ -1,33 +1,219 @@
+from abc import ABC, abstractmethod
+from functools import cached_property
+from typing import Optional, Set
+from urllib.parse import parse_qs
 from uuid import UUID
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import JsonWebsocketConsumer
+import msgpack
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
 
+from messages.serializers import is_compact
+from messages.services.membership_cache import membership_cache
 
-class MessageConsumer(JsonWebsocketConsumer):
-    """A simple consumer class the allows for the receipt and sending of messages along a websocket channel"""
+from .services.event_dispatcher import user_channel_group
+from .services.frames import MESSAGE_EVENTS, MSGPACK_SUBPROTOCOL, Frame, encode_frame, event_authors, frame_cache
+
+# application specific close codes, mirroring the HTTP status codes
+UNAUTHENTICATED_CLOSE_CODE = 4401
+FORBIDDEN_CLOSE_CODE = 4403
+
+
+class GroupMemberConsumer(AsyncJsonWebsocketConsumer, ABC):
+    """
+    Abstract base class for consumers that only allow authenticated users to listen to the groups they are members of.
+    The user is set by `websockets.middleware.JWTAuthMiddleware`.
+
+    Connecting with `?compact=true` sends new messages with only their author's id. Each author's details are sent
+    once per connection, in the `users` map of the first message of theirs that the connection receives.
+
+    Clients that request the `msgpack` subprotocol when connecting are sent MessagePack binary frames, in which the
+    cipher text and IV of messages are raw bytes rather than base64, and send their own frames as MessagePack.
+
+    The frames of broadcast events are encoded once per process for each representation, and shared by every connection
+    needing it (see `websockets.services.frames.FrameCache`). Besides its groups, every connection listens to its user's
+    channel for the events sent to the user alone, such as their wrapping of a group's new key, which are only forwarded
+    for the groups it listens to
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # ids of the users whose details have already been sent along this connection
+        self.known_users: Set[str] = set()
+
+    @cached_property
+    def compact(self) -> bool:
+        values = parse_qs(self.scope.get("query_string", b"").decode()).get("compact")
+        return is_compact(values[0] if values else None)
+
+    @cached_property
+    def subprotocol(self) -> Optional[str]:
+        """The subprotocol negotiated with the client, with JSON text frames being used when there is none"""
+        return MSGPACK_SUBPROTOCOL if MSGPACK_SUBPROTOCOL in self.scope.get("subprotocols", []) else None
+
+    async def accept(self, subprotocol=None):
+        await super().accept(subprotocol or self.subprotocol)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if self.subprotocol != MSGPACK_SUBPROTOCOL:
+            await super().receive(text_data, bytes_data, **kwargs)
+            return
+        try:
+            content = msgpack.unpackb(bytes_data or b"", raw=False)
+        except (ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError):
+            await self.send_json({"type": "error", "message": "Frames must be MessagePack encoded"})
+            return
+        await self.receive_json(content, **kwargs)
+
+    async def send_json(self, content, close=False):
+        await self.send_frame(encode_frame(content, self.subprotocol), close)
+
+    async def send_frame(self, frame: Frame, close=False):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame, close=close)
+        else:
+            await self.send(text_data=frame, close=close)
+
+    async def join_user_channel(self):
+        await self.channel_layer.group_add(user_channel_group(self.scope["user"].id), self.channel_name)
+
+    async def leave_user_channel(self):
+        if self.scope["user"].is_authenticated:
+            await self.channel_layer.group_discard(user_channel_group(self.scope["user"].id), self.channel_name)
+
+    @abstractmethod
+    def listens_to(self, message_group: str) -> bool:
+        """Whether the connection is listening to a group"""
+
+    async def is_member(self, message_group: str) -> bool:
+        """Check the user is a member of the group, only querying the database if the group's members are not cached"""
+        members = membership_cache.get_cached(message_group)
+        if members is None:
+            members = await database_sync_to_async(membership_cache.get)(message_group)
+        return self.scope["user"].id in members
+
+    async def send_message(self, event):
+        """Triggered by the server to send messages to the client"""
+        message_type = event["message_type"]
+        if not self.listens_to(event["group"]):
+            return
+        if message_type in ("new_user", "new_users", "member_removed"):
+            # the change may have been made by another process, whose signal handlers do not affect our cache
+            membership_cache.invalidate(event["group"])
+        compact = self.compact and message_type in MESSAGE_EVENTS
+        users = None
+        if compact:
+            # authors' details are only sent the first time they are seen along this connection
+            authors = event_authors(event)
+            if not self.known_users.issuperset(authors):
+                self.known_users.update(authors)
+                users = authors
+        await self.send_frame(frame_cache.get(event, self.subprotocol, compact, users))
+        if message_type == "member_removed" and event["message"] == str(self.scope["user"].id):
+            await self.remove_from_group(event["group"])
+
+    @abstractmethod
+    async def remove_from_group(self, message_group: str):
+        """Triggered when the user has been removed from a group they are listening to"""
+
+
+class MessageConsumer(GroupMemberConsumer):
+    """
+    A simple consumer class the allows for the receipt and sending of messages along a websocket channel. The consumer
+    is asynchronous, so idle connections do not each hold a thread from the sync worker pool
+    """
 
     message_group: str | UUID
 
-    def connect(self):
+    async def connect(self):
         """Triggered by the client library when a new websocket connection is initiated"""
         # `message_group` is the id of the message group, meaning that messages are only sent to clients watching a
         # specific group
         self.message_group = self.scope["url_route"]["kwargs"]["message_group"]
+        if not self.scope["user"].is_authenticated:
+            await self.close(code=UNAUTHENTICATED_CLOSE_CODE)
+            return
+        if not await self.is_member(self.message_group):
+            await self.close(code=FORBIDDEN_CLOSE_CODE)
+            return
 
-        async_to_sync(self.channel_layer.group_add)(self.message_group, self.channel_name)
+        await self.channel_layer.group_add(self.message_group, self.channel_name)
+        await self.join_user_channel()
 
-        self.accept()
+        await self.accept()
 
-    def disconnect(self, code):
+    async def disconnect(self, code):
         """Triggered on disconnection and removes the client from the group to clean up resources"""
-        async_to_sync(self.channel_layer.group_discard)(
+        await self.channel_layer.group_discard(
             self.message_group,
             self.channel_name,
         )
+        await self.leave_user_channel()
 
-    def send_message(self, event):
-        """Triggered by the server to send messages to the client"""
-        message = event["message"]
-        message_type = event["message_type"]
-        self.send_json({"type": message_type, "message": message})
+    def listens_to(self, message_group: str) -> bool:
+        return message_group == self.message_group
+
+    async def remove_from_group(self, message_group: str):
+        await self.close(code=FORBIDDEN_CLOSE_CODE)
+
+
+class MultiplexMessageConsumer(GroupMemberConsumer):
+    """
+    A consumer that allows a single websocket connection to receive messages for many groups. Clients subscribe and
+    unsubscribe by sending `{"action": "subscribe" | "unsubscribe", "group": <group id>}` frames, and every message
+    sent to the client includes the id of the group it belongs to
+    """
+
+    message_groups: Set[str]
+
+    async def connect(self):
+        """Triggered by the client library when a new websocket connection is initiated"""
+        self.message_groups = set()
+        if not self.scope["user"].is_authenticated:
+            await self.close(code=UNAUTHENTICATED_CLOSE_CODE)
+            return
+        await self.join_user_channel()
+        await self.accept()
+
+    async def disconnect(self, code):
+        """Triggered on disconnection and removes the client from all of its groups to clean up resources"""
+        for message_group in self.message_groups:
+            await self.channel_layer.group_discard(message_group, self.channel_name)
+        self.message_groups.clear()
+        await self.leave_user_channel()
+
+    def listens_to(self, message_group: str) -> bool:
+        return message_group in self.message_groups
+
+    async def receive_json(self, content, **kwargs):
+        """Triggered by the client sending a control frame to subscribe to or unsubscribe from a group"""
+        action = content.get("action") if isinstance(content, dict) else None
+        try:
+            message_group = str(UUID(str(content.get("group"))))
+        except (AttributeError, ValueError):
+            await self.send_json({"type": "error", "message": "A valid group id must be provided"})
+            return
+        if action == "subscribe":
+            await self.subscribe(message_group)
+        elif action == "unsubscribe":
+            await self.unsubscribe(message_group)
+        else:
+            await self.send_json({"type": "error", "group": message_group, "message": f"Unknown action {action}"})
+
+    async def subscribe(self, message_group: str):
+        if message_group not in self.message_groups:
+            if not await self.is_member(message_group):
+                await self.send_json({"type": "error", "group": message_group, "message": "Not a member of the group"})
+                return
+            await self.channel_layer.group_add(message_group, self.channel_name)
+            self.message_groups.add(message_group)
+        await self.send_json({"type": "subscribed", "group": message_group})
+
+    async def unsubscribe(self, message_group: str):
+        if message_group in self.message_groups:
+            await self.channel_layer.group_discard(message_group, self.channel_name)
+            self.message_groups.discard(message_group)
+        await self.send_json({"type": "unsubscribed", "group": message_group})
+
+    async def remove_from_group(self, message_group: str):
+        await self.unsubscribe(message_group)
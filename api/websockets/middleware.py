@@ -0,0 +1,21 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+
+from api.authentication import get_user_from_token
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Authenticates websocket connections using an access token. Browsers cannot set headers on websocket requests, so
+    the token is passed in the `token` query parameter. `scope["user"]` is anonymous if the token is missing or invalid
+    """
+
+    async def __call__(self, scope, receive, send):
+        query = parse_qs(scope.get("query_string", b"").decode())
+        tokens = query.get("token")
+        user = await database_sync_to_async(get_user_from_token)(tokens[0]) if tokens else None
+        scope = dict(scope, user=user or AnonymousUser())
+        return await super().__call__(scope, receive, send)
@@ -7,4 +7,6 @@ websocket_urlpatterns = [
         r"websockets/messages/(?P<message_group>[0-9a-f]{8}-[0-9a-f]{4}-4[0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12})/$",
         consumers.MessageConsumer.as_asgi(),
     ),
+    # a single connection for all of a user's groups, with groups subscribed to over the websocket
+    re_path(r"websockets/messages/$", consumers.MultiplexMessageConsumer.as_asgi()),
 ]
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from api import settings
+
+logging.basicConfig()
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# (time the event was queued, channel layer group, event)
+QueuedEvent = Tuple[float, str, Dict[str, Any]]
+
+
+class EventDispatcher:
+    """
+    Publishes websocket events to the channel layer from a background thread running its own event loop, so that the
+    code producing an event does not wait for the publish.
+
+    Every event queued by the time the loop next runs is published as one batch. Groups within a batch are published
+    concurrently, while events for the same group are published in the order they were queued so that clients see
+    them in order.
+
+    At most `max_size` events are queued behind the batch being published, without a limit when it is 0. Producers are
+    never blocked on the channel layer, so once the queue is full new events are dropped and counted, rather than
+    letting a slow or unavailable channel layer exhaust memory.
+
+    While events are being published, the dispatcher's `stats` are logged every `stats_interval` seconds, or never
+    when it is 0.
+    """
+
+    def __init__(self, max_size: int = 0, stats_interval: float = 0.0):
+        self.max_size = max_size
+        self.stats_interval = stats_interval
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # the queue is bound to the dispatcher's loop when it is first waited on
+        self._queue: asyncio.Queue[QueuedEvent] = asyncio.Queue(maxsize=max_size)
+        self.published = 0
+        self.failed = 0
+        self.dropped = 0
+        self.batches = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def enqueue(self, group: str, event: Dict[str, Any]) -> None:
+        """Queue an event to be sent to every channel in a channel layer group"""
+        loop = self._ensure_started()
+        loop.call_soon_threadsafe(self._put, (time.monotonic(), group, event))
+
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """Block until every queued event has been published"""
+        if self._loop is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._queue.join(), self._loop)
+        try:
+            future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            logger.error(f"Timed out waiting for {self.queue_depth} websocket events to be published")
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> Dict[str, float]:
+        published = self.published + self.failed
+        return {
+            "queue_depth": self.queue_depth,
+            "published": self.published,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "mean_latency": self.total_latency / published if published else 0.0,
+            "max_latency": self.max_latency,
+        }
+
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        if self._loop is not None:
+            return self._loop
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                ready = threading.Event()
+                threading.Thread(
+                    target=self._run_loop, args=(loop, ready), name="websocket-event-dispatcher", daemon=True
+                ).start()
+                ready.wait()
+                self._loop = loop
+                # publish anything still queued when the process exits. This must happen before `concurrent.futures`
+                # stops accepting work, as channel layers resolve their hosts in the loop's default executor, so the
+                # flush is registered to run before interpreter shutdown just as `concurrent.futures` registers its own
+                threading._register_atexit(self.flush, 5)  # type: ignore[attr-defined]
+        return self._loop
+
+    def _run_loop(self, loop: asyncio.AbstractEventLoop, ready: threading.Event) -> None:
+        asyncio.set_event_loop(loop)
+        loop.create_task(self._consume())
+        if self.stats_interval:
+            loop.create_task(self._log_stats())
+        ready.set()
+        loop.run_forever()
+
+    def _put(self, queued_event: QueuedEvent) -> None:
+        try:
+            self._queue.put_nowait(queued_event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            logger.warning(
+                f"Dropped {queued_event[2].get('message_type')} event to group {queued_event[1]}, as "
+                f"{self.max_size} events are waiting to be published"
+            )
+
+    async def _consume(self) -> None:
+        channel_layer = get_channel_layer()
+        while True:
+            batch = [await self._queue.get()]
+            while not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            events_by_group: Dict[str, List[QueuedEvent]] = defaultdict(list)
+            for queued_event in batch:
+                events_by_group[queued_event[1]].append(queued_event)
+            await asyncio.gather(*(self._publish(channel_layer, events) for events in events_by_group.values()))
+            self.batches += 1
+            for _ in batch:
+                self._queue.task_done()
+
+    async def _log_stats(self) -> None:
+        """Log the stats every `stats_interval` seconds, skipping intervals in which no events were queued"""
+        logged_events = 0
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            events = self.published + self.failed + self.dropped + self.queue_depth
+            if events == logged_events:
+                continue
+            logged_events = events
+            logger.info(
+                "Websocket event dispatcher " + ", ".join(f"{key}={value:g}" for key, value in self.stats().items())
+            )
+
+    async def _publish(self, channel_layer, events: List[QueuedEvent]) -> None:
+        for queued_at, group, event in events:
+            try:
+                await channel_layer.group_send(group, event)
+                self.published += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Unable to publish {event.get('message_type')} event to group {group}: {e}")
+            latency = time.monotonic() - queued_at
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+
+event_dispatcher = EventDispatcher(
+    max_size=settings.EVENT_DISPATCHER_QUEUE_SIZE, stats_interval=settings.EVENT_DISPATCHER_STATS_INTERVAL
+)
+
+
+def user_channel_group(user_id: str) -> str:
+    """The channel layer group that every websocket connection of a user listens to"""
+    return f"user.{user_id}"
+
+
+def broadcast(group: str, message_type: str, message: Any) -> None:
+    """
+    Send a message to every client listening to a group's websocket channel. The message is queued once the current
+    database transaction commits, so clients are never told about changes that are rolled back, and is then published
+    in the background.
+
+    Events are published in one canonical form, with an id that consumers cache the frames they encode under (see
+    `websockets.services.frames.FrameCache`)
+    """
+    _publish_on_commit(group, group, message_type, message)
+
+
+def send_to_user(user_id: str, group: str, message_type: str, message: Any) -> None:
+    """
+    Send a message about a group to only one of its members, on each of their connections listening to the group, such
+    as the group's new key wrapped with their public key
+    """
+    _publish_on_commit(user_channel_group(user_id), group, message_type, message)
+
+
+def _publish_on_commit(channel_group: str, group: str, message_type: str, message: Any) -> None:
+    def enqueue():
+        event = {
+            "type": "send.message",
+            "id": uuid4().hex,
+            "message_type": message_type,
+            "group": group,
+            "message": message,
+        }
+        event_dispatcher.enqueue(channel_group, event)
+
+    transaction.on_commit(enqueue)
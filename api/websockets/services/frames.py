@@ -0,0 +1,98 @@
+import json
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple, Union
+
+import msgpack
+
+from messages.serializers import binary_message, compact_message
+
+# the websocket subprotocol a client can request to receive MessagePack binary frames rather than JSON text frames
+MSGPACK_SUBPROTOCOL = "msgpack"
+
+Frame = Union[str, bytes]
+
+# the events holding a new message, or a list of new messages, that have compact and binary representations
+MESSAGE_EVENTS = ("new_message", "new_messages")
+
+
+def _map_messages(message_type: str, message: Any, fn: Callable[[dict], dict]) -> Any:
+    return [fn(item) for item in message] if message_type == "new_messages" else fn(message)
+
+
+def event_authors(event: Dict[str, Any]) -> Dict[str, dict]:
+    """The authors of the messages in a `new_message` or `new_messages` event, keyed by id"""
+    messages = event["message"] if event["message_type"] == "new_messages" else [event["message"]]
+    return {message["user"]["id"]: message["user"] for message in messages}
+
+
+def frame_content(event: Dict[str, Any], compact: bool = False, users: Optional[dict] = None) -> Dict[str, Any]:
+    """The content of the frame sent to clients for a broadcast event"""
+    message = event["message"]
+    if compact and event["message_type"] in MESSAGE_EVENTS:
+        message = _map_messages(event["message_type"], message, compact_message)
+    content = {"type": event["message_type"], "group": event["group"], "message": message}
+    if users:
+        content["users"] = users
+    return content
+
+
+def encode_frame(content: Dict[str, Any], subprotocol: Optional[str] = None) -> Frame:
+    """Encode a frame as MessagePack bytes for clients using the `msgpack` subprotocol, or as JSON text otherwise"""
+    if subprotocol == MSGPACK_SUBPROTOCOL:
+        if content.get("type") in MESSAGE_EVENTS:
+            content = {**content, "message": _map_messages(content["type"], content["message"], binary_message)}
+        return msgpack.packb(content)
+    return json.dumps(content, separators=(",", ":"))
+
+
+def frame_key(subprotocol: Optional[str] = None, compact: bool = False, with_users: bool = False) -> str:
+    """The key of the pre-encoded frame for a connection's subprotocol and representation"""
+    key = subprotocol or "json"
+    if compact:
+        key += ".compact"
+    if with_users:
+        key += ".users"
+    return key
+
+
+class FrameCache:
+    """
+    A bounded LRU cache of the frames encoded for broadcast events, keyed by the event's id and the frame's
+    representation. Every consumer in a process receives its own copy of an event from the channel layer, so this lets
+    each representation of the event be encoded once per process rather than once per socket. Consumers all run on the
+    server's event loop, so no locking is needed
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._frames: OrderedDict[Tuple[str, str], Frame] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(
+        self,
+        event: Dict[str, Any],
+        subprotocol: Optional[str] = None,
+        compact: bool = False,
+        users: Optional[dict] = None,
+    ) -> Frame:
+        """The frame of an event for a connection's subprotocol and representation, only encoding it if not cached"""
+        if "id" not in event:
+            return encode_frame(frame_content(event, compact, users), subprotocol)
+        key = (event["id"], frame_key(subprotocol, compact, bool(users)))
+        frame = self._frames.get(key)
+        if frame is not None:
+            self._frames.move_to_end(key)
+            self.hits += 1
+            return frame
+        self.misses += 1
+        frame = self._frames[key] = encode_frame(frame_content(event, compact, users), subprotocol)
+        while len(self._frames) > self.max_size:
+            self._frames.popitem(last=False)
+        return frame
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._frames)}
+
+
+frame_cache = FrameCache(max_size=1024)
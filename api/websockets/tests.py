@@ -1,3 +1,516 @@
-from django.test import TestCase
+import asyncio
+import json
+import random
+import threading
+from typing import List, Optional, Tuple
+from unittest import mock
 
-# Create your tests here.
+import msgpack
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from accounts.models import User
+from api import settings
+from api.testing import create_group, create_users
+from crypto.services import key_management_service
+from messages.models import Message, MessageGroup, UserGroup
+from messages.services.membership_cache import membership_cache
+
+from . import consumers
+from .consumers import FORBIDDEN_CLOSE_CODE, UNAUTHENTICATED_CLOSE_CODE
+from .middleware import JWTAuthMiddleware
+from .routing import websocket_urlpatterns
+from .services import event_dispatcher as dispatcher_module
+from .services.event_dispatcher import EventDispatcher, broadcast
+from .services.frames import MSGPACK_SUBPROTOCOL, FrameCache
+
+application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+
+class RecordingChannelLayer:
+    """Records the events sent to it, taking a random time over each and failing to send to `fail_groups`"""
+
+    def __init__(self, fail_groups=()):
+        self.sent = []
+        self.fail_groups = fail_groups
+
+    async def group_send(self, group, event):
+        # the delay only varies the order sends finish in, so need not be secure
+        await asyncio.sleep(random.random() / 100)  # nosec: B311
+        if group in self.fail_groups:
+            raise ConnectionError("channel layer unavailable")
+        self.sent.append((group, event))
+
+
+class BlockedChannelLayer(RecordingChannelLayer):
+    """Holds the events sent to it until released, as an unavailable channel layer would"""
+
+    def __init__(self):
+        super().__init__()
+        self.blocked = threading.Event()
+        self.release = threading.Event()
+
+    async def group_send(self, group, event):
+        self.blocked.set()
+        while not self.release.is_set():
+            await asyncio.sleep(0.01)
+        await super().group_send(group, event)
+
+
+class EventDispatcherTests(SimpleTestCase):
+    """Events should be published in the background, in order within each group, with a bounded backlog"""
+
+    def setUp(self):
+        self.channel_layer = RecordingChannelLayer()
+        patch = mock.patch.object(dispatcher_module, "get_channel_layer", side_effect=lambda: self.channel_layer)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def test_published_in_order_per_group(self):
+        dispatcher = EventDispatcher()
+        events = [(f"group-{i % 3}", {"type": "send.message", "index": i}) for i in range(30)]
+        for group, event in events:
+            dispatcher.enqueue(group, event)
+        dispatcher.flush(10)
+        for group in ("group-0", "group-1", "group-2"):
+            sent = [event["index"] for sent_group, event in self.channel_layer.sent if sent_group == group]
+            self.assertEqual(sent, [event["index"] for event_group, event in events if event_group == group])
+        self.assertEqual(dispatcher.stats()["published"], 30)
+        self.assertEqual(dispatcher.stats()["queue_depth"], 0)
+
+    def test_failures_counted(self):
+        self.channel_layer = RecordingChannelLayer(fail_groups=("down",))
+        dispatcher = EventDispatcher()
+        with self.assertLogs(level="ERROR"):
+            dispatcher.enqueue("up", {"message_type": "new_message"})
+            dispatcher.enqueue("down", {"message_type": "new_message"})
+            dispatcher.flush(10)
+        self.assertEqual((dispatcher.stats()["published"], dispatcher.stats()["failed"]), (1, 1))
+
+    def test_backlog_bounded(self):
+        self.channel_layer = BlockedChannelLayer()
+        dispatcher = EventDispatcher(max_size=5)
+        dispatcher.enqueue("group", {"message_type": "new_message", "index": 0})
+        self.assertTrue(self.channel_layer.blocked.wait(5))
+        with self.assertLogs(level="WARNING"):
+            for index in range(1, 10):
+                dispatcher.enqueue("group", {"message_type": "new_message", "index": index})
+            # events are added to the queue on the dispatcher's loop, which runs callbacks in the order they are made
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0), dispatcher._loop).result(5)
+        self.assertEqual(dispatcher.stats()["queue_depth"], 5)
+        self.channel_layer.release.set()
+        dispatcher.flush(10)
+        stats = dispatcher.stats()
+        self.assertEqual((stats["published"], stats["dropped"]), (6, 4))
+        # the oldest events are kept, with the newest dropped
+        self.assertEqual([event["index"] for _, event in self.channel_layer.sent], list(range(6)))
+
+    def test_stats_logged(self):
+        dispatcher = EventDispatcher(stats_interval=0.01)
+        with self.assertLogs(level="INFO") as logs:
+            dispatcher.enqueue("group", {"message_type": "new_message"})
+            dispatcher.flush(10)
+            asyncio.run_coroutine_threadsafe(asyncio.sleep(0.05), dispatcher._loop).result(5)
+        stats_logs = [output for output in logs.output if "event dispatcher" in output]
+        # intervals in which no events were queued or published are not logged
+        self.assertLessEqual(len(stats_logs), 2)
+        self.assertIn("published=1", stats_logs[-1])
+
+
+class BroadcastTests(TestCase):
+    """Events should only be queued once the transaction producing them commits"""
+
+    def test_queued_on_commit(self):
+        with mock.patch.object(dispatcher_module.event_dispatcher, "enqueue") as enqueue:
+            with self.captureOnCommitCallbacks(execute=True):
+                broadcast("group", "new_message", {"id": "message"})
+                enqueue.assert_not_called()
+        enqueue.assert_called_once()
+        channel_group, event = enqueue.call_args.args
+        self.assertEqual(channel_group, "group")
+        self.assertEqual(
+            {key: event[key] for key in ("type", "message_type", "group", "message")},
+            {"type": "send.message", "message_type": "new_message", "group": "group", "message": {"id": "message"}},
+        )
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class ConsumerTestCase(TransactionTestCase):
+    """
+    Websocket connections made through the ASGI application, by members of a group. The events produced by changes to
+    the database are recorded rather than dispatched, and are passed to the in-memory channel layer by `publish`, so
+    that the test controls when connections receive them. Keys are wrapped and sent as soon as they are created
+    """
+
+    def setUp(self):
+        self.events: List[Tuple[str, dict]] = []
+        for patch in (
+            mock.patch.object(
+                dispatcher_module.event_dispatcher, "enqueue", side_effect=lambda *event: self.events.append(event)
+            ),
+            mock.patch.object(key_management_service, "run_in_background", side_effect=lambda fn, *args: fn(*args)),
+            mock.patch.object(settings, "KEY_WRAPPING_WORKERS", 0),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+        membership_cache.clear()
+        self.users = create_users(3)
+        self.user = self.users[0]
+        self.group = create_group(self.user, self.users[:2])
+        self.other_group = create_group(self.user, self.users[:2])
+        # the events of the groups being set up are never received
+        self.events.clear()
+
+    def communicator(
+        self,
+        path: str = "",
+        user: Optional[User] = None,
+        token: Optional[str] = None,
+        subprotocols: Optional[List[str]] = None,
+        query: str = "",
+    ) -> WebsocketCommunicator:
+        if token is None:
+            token = str(AccessToken.for_user(user or self.user))
+        url = f"/websockets/messages/{path}?token={token}{query}"
+        return WebsocketCommunicator(application, url, subprotocols=subprotocols)
+
+    async def connect(self, path: str = "", **kwargs) -> WebsocketCommunicator:
+        communicator = self.communicator(path, **kwargs)
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def subscribe(self, communicator: WebsocketCommunicator, group: MessageGroup) -> None:
+        await communicator.send_json_to({"action": "subscribe", "group": str(group.id)})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "subscribed", "group": str(group.id)})
+
+    async def publish(self) -> None:
+        """Send the events recorded so far to the connections listening for them"""
+        channel_layer = get_channel_layer()
+        events, self.events = self.events, []
+        for group, event in events:
+            await channel_layer.group_send(group, event)
+
+    @database_sync_to_async
+    def create_message(self, group: MessageGroup, author: Optional[User] = None) -> Message:
+        return Message.objects.create(
+            user=author or self.users[1], group=group, cipher_text=b"cipher", initialisation_vector=bytes(16)
+        )
+
+    @database_sync_to_async
+    def remove_member(self, group: MessageGroup, user: User) -> None:
+        UserGroup.objects.filter(group=group, user=user).delete()
+
+    @database_sync_to_async
+    def rotate_key(self, group: MessageGroup):
+        return key_management_service.generate_key_for_group(group)
+
+
+class ConsumerAuthTests(ConsumerTestCase):
+    """Only authenticated members of a group should be able to listen to it, for as long as they are members"""
+
+    async def test_missing_token(self):
+        for path in (f"{self.group.id}/", ""):
+            with self.subTest(path=path):
+                communicator = WebsocketCommunicator(application, f"/websockets/messages/{path}")
+                self.assertEqual(await communicator.connect(), (False, UNAUTHENTICATED_CLOSE_CODE))
+
+    async def test_invalid_token(self):
+        for path in (f"{self.group.id}/", ""):
+            with self.subTest(path=path):
+                communicator = self.communicator(path, token="not-a-token")  # nosec: B106
+                self.assertEqual(await communicator.connect(), (False, UNAUTHENTICATED_CLOSE_CODE))
+
+    async def test_not_member(self):
+        communicator = self.communicator(f"{self.group.id}/", user=self.users[2])
+        self.assertEqual(await communicator.connect(), (False, FORBIDDEN_CLOSE_CODE))
+        communicator = await self.connect(user=self.users[2])
+        await communicator.send_json_to({"action": "subscribe", "group": str(self.group.id)})
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {"type": "error", "group": str(self.group.id), "message": "Not a member of the group"},
+        )
+        await communicator.disconnect()
+
+    async def test_removed_member_closed(self):
+        communicator = await self.connect(f"{self.group.id}/", user=self.users[1])
+        await self.remove_member(self.group, self.users[1])
+        await self.publish()
+        removal = await communicator.receive_json_from()
+        self.assertEqual((removal["type"], removal["message"]), ("member_removed", str(self.users[1].id)))
+        self.assertEqual(await communicator.receive_output(), {"type": "websocket.close", "code": FORBIDDEN_CLOSE_CODE})
+
+    async def test_removed_member_unsubscribed(self):
+        communicator = await self.connect(user=self.users[1])
+        await self.subscribe(communicator, self.group)
+        await self.remove_member(self.group, self.users[1])
+        await self.publish()
+        self.assertEqual((await communicator.receive_json_from())["type"], "member_removed")
+        self.assertEqual(await communicator.receive_json_from(), {"type": "unsubscribed", "group": str(self.group.id)})
+        # messages sent to the group after the removal are not received
+        await self.create_message(self.group, author=self.user)
+        await self.publish()
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_other_members_not_closed(self):
+        communicator = await self.connect(f"{self.group.id}/")
+        await self.remove_member(self.group, self.users[1])
+        await self.publish()
+        self.assertEqual((await communicator.receive_json_from())["type"], "member_removed")
+        # the members that are left are sent the key the group is given after the removal
+        self.assertEqual((await communicator.receive_json_from())["type"], "new_key")
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_keys_only_for_listened_groups(self):
+        communicator = await self.connect()
+        await self.subscribe(communicator, self.group)
+        # the user is sent each of their groups' new keys along their own channel, not only those they listen to
+        await self.rotate_key(self.other_group)
+        symmetric_key = await self.rotate_key(self.group)
+        await self.publish()
+        self.assertEqual(
+            await communicator.receive_json_from(),
+            {"type": "new_key", "group": str(self.group.id), "message": {"id": str(symmetric_key.id)}},
+        )
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+
+class MessageConsumerTests(ConsumerTestCase):
+    """Connections to a group should receive its events as JSON, with many connections served at once"""
+
+    async def test_new_message(self):
+        communicator = await self.connect(f"{self.group.id}/")
+        message = await self.create_message(self.group)
+        await self.create_message(self.other_group)
+        await self.publish()
+        frame = await communicator.receive_json_from()
+        self.assertEqual((frame["type"], frame["group"]), ("new_message", str(self.group.id)))
+        self.assertEqual(frame["message"]["id"], str(message.id))
+        self.assertEqual(frame["message"]["user"]["id"], str(self.users[1].id))
+        self.assertEqual(frame["message"]["cipher_text"], "Y2lwaGVy")
+        # messages of other groups are not received
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_many_connections(self):
+        communicators = await asyncio.gather(*(self.connect(f"{self.group.id}/") for _ in range(20)))
+        message = await self.create_message(self.group)
+        await self.publish()
+        frames = await asyncio.gather(*(communicator.receive_json_from() for communicator in communicators))
+        self.assertEqual({frame["message"]["id"] for frame in frames}, {str(message.id)})
+        await asyncio.gather(*(communicator.disconnect() for communicator in communicators))
+
+    async def test_disconnect_leaves_groups(self):
+        communicator = await self.connect(f"{self.group.id}/")
+        channel_layer = get_channel_layer()
+        self.assertEqual(len(channel_layer.groups[str(self.group.id)]), 1)
+        await communicator.disconnect()
+        self.assertFalse(channel_layer.groups.get(str(self.group.id)))
+        self.assertFalse(channel_layer.groups.get(dispatcher_module.user_channel_group(self.user.id)))
+
+
+class MultiplexConsumerTests(ConsumerTestCase):
+    """A single connection should receive the events of every group it subscribes to, until it unsubscribes"""
+
+    async def test_many_groups(self):
+        communicator = await self.connect()
+        for group in (self.group, self.other_group):
+            await self.subscribe(communicator, group)
+        messages = [await self.create_message(group) for group in (self.group, self.other_group)]
+        await self.publish()
+        frames = [await communicator.receive_json_from() for _ in messages]
+        self.assertEqual(
+            [(frame["group"], frame["message"]["id"]) for frame in frames],
+            [(str(message.group_id), str(message.id)) for message in messages],
+        )
+        await communicator.disconnect()
+
+    async def test_unsubscribe(self):
+        communicator = await self.connect()
+        await self.subscribe(communicator, self.group)
+        # subscribing again is acknowledged without listening to the group twice
+        await self.subscribe(communicator, self.group)
+        await communicator.send_json_to({"action": "unsubscribe", "group": str(self.group.id)})
+        self.assertEqual(await communicator.receive_json_from(), {"type": "unsubscribed", "group": str(self.group.id)})
+        await self.create_message(self.group)
+        await self.publish()
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_invalid_frames(self):
+        communicator = await self.connect()
+        for content, error in (
+            ({"action": "subscribe"}, {"type": "error", "message": "A valid group id must be provided"}),
+            (
+                {"action": "subscribe", "group": "not-a-group"},
+                {"type": "error", "message": "A valid group id must be provided"},
+            ),
+            (["subscribe"], {"type": "error", "message": "A valid group id must be provided"}),
+            (
+                {"action": "join", "group": str(self.group.id)},
+                {"type": "error", "group": str(self.group.id), "message": "Unknown action join"},
+            ),
+        ):
+            with self.subTest(content=content):
+                await communicator.send_json_to(content)
+                self.assertEqual(await communicator.receive_json_from(), error)
+        await communicator.disconnect()
+
+    async def test_no_groups_until_subscribed(self):
+        communicator = await self.connect()
+        await self.create_message(self.group)
+        await self.publish()
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+
+class MessagePackTests(ConsumerTestCase):
+    """Connections negotiating the `msgpack` subprotocol should send and receive MessagePack binary frames"""
+
+    async def receive(self, communicator: WebsocketCommunicator) -> dict:
+        return msgpack.unpackb(await communicator.receive_from(), raw=False)
+
+    async def test_negotiated(self):
+        communicator = self.communicator(subprotocols=[MSGPACK_SUBPROTOCOL])
+        self.assertEqual(await communicator.connect(), (True, MSGPACK_SUBPROTOCOL))
+        await communicator.disconnect()
+        # other subprotocols are not supported, so JSON is used
+        communicator = self.communicator(subprotocols=["cbor"])
+        self.assertEqual(await communicator.connect(), (True, None))
+        await communicator.disconnect()
+
+    async def test_binary_messages(self):
+        communicator = await self.connect(f"{self.group.id}/", subprotocols=[MSGPACK_SUBPROTOCOL])
+        message = await self.create_message(self.group)
+        await self.publish()
+        frame = await self.receive(communicator)
+        self.assertEqual((frame["type"], frame["message"]["id"]), ("new_message", str(message.id)))
+        # the cipher text and IV are sent as raw bytes rather than base64
+        self.assertEqual(frame["message"]["cipher_text"], b"cipher")
+        self.assertEqual(frame["message"]["initialisation_vector"], bytes(16))
+        await communicator.disconnect()
+
+    async def test_control_frames(self):
+        communicator = await self.connect(subprotocols=[MSGPACK_SUBPROTOCOL])
+        await communicator.send_to(bytes_data=msgpack.packb({"action": "subscribe", "group": str(self.group.id)}))
+        self.assertEqual(await self.receive(communicator), {"type": "subscribed", "group": str(self.group.id)})
+        await self.remove_member(self.group, self.users[1])
+        await self.publish()
+        # events other than messages are MessagePack encoded too
+        self.assertEqual(
+            await self.receive(communicator),
+            {"type": "member_removed", "group": str(self.group.id), "message": str(self.users[1].id)},
+        )
+        await communicator.disconnect()
+
+    async def test_invalid_frames(self):
+        communicator = await self.connect(subprotocols=[MSGPACK_SUBPROTOCOL])
+        error = {"type": "error", "message": "Frames must be MessagePack encoded"}
+        for frame in (b"\xc1", msgpack.packb(1) + b"extra"):
+            with self.subTest(frame=frame):
+                await communicator.send_to(bytes_data=frame)
+                self.assertEqual(await self.receive(communicator), error)
+        # text frames are not accepted either
+        await communicator.send_to(text_data='{"action": "subscribe"}')
+        self.assertEqual(await self.receive(communicator), error)
+        await communicator.disconnect()
+
+
+class FrameCacheTests(SimpleTestCase):
+    """Each representation of a broadcast event should be encoded once, however many connections it is sent to"""
+
+    def setUp(self):
+        self.cache = FrameCache(max_size=2)
+        self.event = {
+            "type": "send.message",
+            "id": "event",
+            "message_type": "new_message",
+            "group": "group",
+            "message": {
+                "id": "message",
+                "user": {"id": "user"},
+                "cipher_text": "YWJj",
+                "initialisation_vector": "AA==",
+            },
+        }
+
+    def test_reused_per_event_and_representation(self):
+        frame = self.cache.get(self.event)
+        self.assertIs(self.cache.get(self.event), frame)
+        representations = [
+            self.cache.get(self.event, MSGPACK_SUBPROTOCOL),
+            self.cache.get(self.event, compact=True),
+            self.cache.get(self.event, compact=True, users={"user": {"id": "user"}}),
+        ]
+        self.assertEqual(self.cache.stats()["misses"], 4)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+        self.assertEqual(json.loads(frame)["message"]["user"], {"id": "user"})
+        self.assertEqual(msgpack.unpackb(representations[0])["message"]["cipher_text"], b"abc")
+        self.assertEqual(json.loads(representations[1])["message"]["user"], "user")
+        self.assertEqual(json.loads(representations[2])["users"], {"user": {"id": "user"}})
+
+    def test_events_without_id_not_cached(self):
+        event = {key: value for key, value in self.event.items() if key != "id"}
+        self.assertEqual(self.cache.get(event), self.cache.get(event))
+        self.assertEqual(self.cache.stats(), {"hits": 0, "misses": 0, "size": 0})
+
+    def test_least_recently_used_evicted(self):
+        events = [{**self.event, "id": f"event-{index}"} for index in range(3)]
+        for event in (events[0], events[1], events[0], events[2]):
+            self.cache.get(event)
+        self.assertEqual(self.cache.stats()["size"], 2)
+        self.cache.get(events[0])
+        self.cache.get(events[1])
+        self.assertEqual(self.cache.stats(), {"hits": 2, "misses": 4, "size": 2})
+
+
+class SharedFrameTests(ConsumerTestCase):
+    """Connections should share the frames of each event encoded for their representation"""
+
+    def setUp(self):
+        super().setUp()
+        self.frame_cache = FrameCache(max_size=16)
+        patch = mock.patch.object(consumers, "frame_cache", self.frame_cache)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    async def test_frames_shared(self):
+        communicators = [await self.connect(f"{self.group.id}/") for _ in range(3)]
+        communicators.append(await self.connect(f"{self.group.id}/", subprotocols=[MSGPACK_SUBPROTOCOL]))
+        await self.create_message(self.group)
+        await self.publish()
+        frames = [await communicator.receive_output() for communicator in communicators]
+        self.assertEqual(len({frame["text"] for frame in frames[:3]}), 1)
+        self.assertIn("bytes", frames[3])
+        # encoded once for the JSON connections and once for the MessagePack one
+        self.assertEqual(self.frame_cache.stats(), {"hits": 2, "misses": 2, "size": 2})
+        for communicator in communicators:
+            await communicator.disconnect()
+
+
+class CompactFrameTests(ConsumerTestCase):
+    """Connections asking for compact messages should be sent each author's details only once"""
+
+    async def test_compact_authors_sent_once(self):
+        communicator = await self.connect(f"{self.group.id}/", query="&compact=true")
+        await self.create_message(self.group)
+        await self.create_message(self.group)
+        await self.create_message(self.group, author=self.user)
+        await self.publish()
+        frames = [await communicator.receive_json_from() for _ in range(3)]
+        self.assertEqual(
+            [frame["message"]["user"] for frame in frames],
+            [str(self.users[1].id), str(self.users[1].id), str(self.user.id)],
+        )
+        self.assertEqual(
+            [list(frame.get("users", {})) for frame in frames], [[str(self.users[1].id)], [], [str(self.user.id)]]
+        )
+        self.assertEqual(frames[0]["users"][str(self.users[1].id)]["last_name"], "User1")
+        await communicator.disconnect()
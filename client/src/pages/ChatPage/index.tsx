@@ -1,5 +1,6 @@
 import React, { useCallback, useContext, useEffect, useRef, useState } from 'react';
 import {
+    Alert,
     Box,
     Button,
     Card,
@@ -28,8 +29,21 @@ import { decryptBase64FromPEM, verify } from '../../services/rsa';
 
 enum MessageType {
     NEW_MESSAGE = 'new_message',
+    NEW_MESSAGES = 'new_messages',
     NEW_KEY = 'new_key',
     NEW_USER = 'new_user',
+    NEW_USERS = 'new_users',
+    MEMBER_REMOVED = 'member_removed',
+}
+
+// the close code the server uses when the user is not, or is no longer, a member of the group
+const FORBIDDEN_CLOSE_CODE = 4403;
+
+// the contents of a `new_key` message, holding the new key encrypted for the user, if they have a valid public key
+interface NewKeyMessage {
+    id: string;
+    key?: string;
+    signature?: string;
 }
 
 const safeGetKey = (groupId: string, keyId: string): string | null | { key: string; id: string } => {
@@ -65,12 +79,16 @@ const ChatPage: React.FC = () => {
     const [message, setMessage] = useState('');
     const [chatMessages, setChatMessages] = useState<IMessage[]>([]);
     const [group, setGroup] = useState<MessageGroup>();
-    const { user } = useContext(AuthContext);
+    const { user, tokens } = useContext(AuthContext);
     const userName = `${user?.first_name} ${user?.last_name}`;
     const messagesViewBoxRef = useRef<HTMLElement>(null);
+    // the sequence number of the latest message shown, used to detect messages the websocket did not deliver
+    const lastSequence = useRef<number>(0);
     const isGroupCreator = group?.created_by?.id === user?.id;
     const [users, setUsers] = useState<User[]>();
     const [nonSelectedUsers, setNonSelectedUsers] = useState<User[]>();
+    // set once the server tells us the user has been removed from the group, after which the socket is closed
+    const [removed, setRemoved] = useState(false);
 
     const fetchGroup = useCallback(async () => {
         const { data } = await api.get(`/messages/groups/${groupId}/`);
@@ -78,7 +96,13 @@ const ChatPage: React.FC = () => {
     }, []);
 
     useEffect(() => {
-        const webSocket = new WebSocket(`ws://localhost:8001/websockets/messages/${groupId}/`);
+        // browsers cannot set headers on websocket requests, so the access token is sent as a query parameter
+        const webSocket = new WebSocket(`ws://localhost:8001/websockets/messages/${groupId}/?token=${tokens?.access}`);
+        // move the user's read receipt for the group up to its latest message
+        const markRead = async () => {
+            await api.post(`/messages/groups/${groupId}/read/`, {});
+        };
+
         // when the user initially joins the room, we want to prepopulate their screen with past messages which
         // they attempt to decrypt but may not be able to depending on if they have been invited to the group
         const fetchMessages = async () => {
@@ -88,7 +112,33 @@ const ChatPage: React.FC = () => {
                 const decryptedMessage = await decryptMessage(groupId ?? '', message);
                 decryptedMessages?.push(decryptedMessage);
             }
+            lastSequence.current = Math.max(0, ...decryptedMessages.map(message => message?.sequence ?? 0));
             setChatMessages(decryptedMessages);
+            await markRead();
+        };
+
+        // fetch the messages sent between the latest one shown and the next one received, if any were missed
+        const fetchMissedMessages = async (nextSequence: number) => {
+            if (!lastSequence.current || !nextSequence || nextSequence <= lastSequence.current + 1) {
+                return [];
+            }
+            const { data } = await api.get(
+                `/messages/groups/${groupId}/messages/?sequence__gt=${lastSequence.current}&sequence__lt=${nextSequence}&page_size=200`,
+            );
+            return await Promise.all(
+                (data?.results ?? []).reverse().map((message: IMessage) => decryptMessage(groupId ?? '', message)),
+            );
+        };
+
+        // show messages received along the websocket, in the order they were created
+        const showMessages = async (messages: IMessage[]) => {
+            const missedMessages = await fetchMissedMessages(messages[0]?.sequence);
+            const decryptedMessages = await Promise.all(
+                messages.map(message => decryptMessage(groupId ?? '', message)),
+            );
+            lastSequence.current = Math.max(lastSequence.current, ...messages.map(message => message?.sequence ?? 0));
+            setChatMessages(previous => [...previous, ...missedMessages, ...decryptedMessages]);
+            await markRead();
         };
 
         const fetchUsers = async () => {
@@ -96,19 +146,27 @@ const ChatPage: React.FC = () => {
             setUsers(data?.results);
         };
 
+        // verify a key sent by the server and decrypt it using the user's private key
+        const unwrapKey = (key: string, signature: string) => {
+            const publicKey = JSON.parse(localStorage?.getItem('serverPublicKey') ?? `{}`);
+            // verify the signature before attempting to decrypt
+            if (!verify(key, signature, publicKey)) {
+                console.error(`Key signature is not from recognised party!`);
+                return;
+            }
+            return decryptBase64FromPEM(key, JSON.parse(localStorage?.getItem('privateKey') ?? `{}`));
+        };
+
         // attempt to fetch the latest key from the server for the group.
         const fetchLatestKey = async () => {
             try {
                 const { data } = await api.get(`/crypto/aes/?group=${groupId}`);
                 const { key, id, signature } = data;
-                const publicKey = JSON.parse(localStorage?.getItem('serverPublicKey') ?? `{}`);
-                // verify the signature before attempting to decrypt
-                if (!verify(key, signature, publicKey)) {
-                    console.error(`Key signature is not from recognised party!`);
+                // get the decrypted key and return it
+                const decryptedKey = unwrapKey(key, signature);
+                if (!decryptedKey) {
                     return;
                 }
-                // get the decrypted key and return it
-                const decryptedKey = decryptBase64FromPEM(key, JSON.parse(localStorage?.getItem('privateKey') ?? `{}`));
                 return {
                     id,
                     key: decryptedKey,
@@ -118,13 +176,8 @@ const ChatPage: React.FC = () => {
             }
         };
 
-        // attempt to fetch the latest key and store it in the local storage map of keys
-        const storeLatestKey = async () => {
-            const keyAndId = await fetchLatestKey();
-            if (!keyAndId) {
-                return;
-            }
-            const { id, key } = keyAndId;
+        // store a key in the local storage map of keys, making it the current key for the group
+        const storeKey = (id: string, key: string) => {
             const existingKeys = JSON.parse(localStorage?.getItem('keys') ?? `{}`);
             // update the map and the current key
             const updatedKeys = {
@@ -141,6 +194,27 @@ const ChatPage: React.FC = () => {
             localStorage.setItem('keys', JSON.stringify(updatedKeys));
         };
 
+        // attempt to fetch the latest key and store it in the local storage map of keys
+        const storeLatestKey = async () => {
+            const keyAndId = await fetchLatestKey();
+            if (!keyAndId) {
+                return;
+            }
+            const { id, key } = keyAndId;
+            storeKey(id, key);
+        };
+
+        // the server encrypts a new key for each group member and sends each of them their own copy, so we only need
+        // to fetch it if it was not included
+        const storePushedKey = async (message: NewKeyMessage) => {
+            const key = message?.key && message?.signature && unwrapKey(message.key, message.signature);
+            if (!key) {
+                await storeLatestKey();
+                return;
+            }
+            storeKey(message.id, key);
+        };
+
         fetchGroup();
         fetchMessages();
         fetchUsers();
@@ -151,13 +225,32 @@ const ChatPage: React.FC = () => {
             const data = JSON.parse(e?.data);
             switch (data?.type) {
                 case MessageType.NEW_MESSAGE:
-                    const decryptedMessage = await decryptMessage(groupId ?? '', data?.message);
-                    setChatMessages(previous => [...previous, decryptedMessage]);
+                    await showMessages([data?.message]);
+                    break;
+                case MessageType.NEW_MESSAGES:
+                    // messages posted in bulk arrive together, in the order they were created
+                    await showMessages(data?.message ?? []);
                     break;
                 case MessageType.NEW_USER:
-                case MessageType.NEW_KEY:
+                case MessageType.NEW_USERS:
                     await Promise.all([storeLatestKey(), fetchGroup()]);
                     break;
+                case MessageType.NEW_KEY:
+                    await Promise.all([storePushedKey(data?.message), fetchGroup()]);
+                    break;
+                case MessageType.MEMBER_REMOVED:
+                    // the message holds the id of the removed member, which may be us
+                    if (data?.message === user?.id) {
+                        setRemoved(true);
+                    }
+                    await fetchGroup();
+                    break;
+            }
+        };
+
+        webSocket.onclose = e => {
+            if (e.code === FORBIDDEN_CLOSE_CODE) {
+                setRemoved(true);
             }
         };
 
@@ -240,7 +333,7 @@ const ChatPage: React.FC = () => {
     };
 
     // only members of the group can send messages
-    const canSendMessages = group?.users?.some(groupUser => groupUser?.user?.id === user?.id);
+    const canSendMessages = !removed && group?.users?.some(groupUser => groupUser?.user?.id === user?.id);
 
     return (
         <Box sx={{ display: 'flex' }}>
@@ -252,6 +345,11 @@ const ChatPage: React.FC = () => {
                     <NameAvatar name={userName} sx={{ marginRight: 2 }} />
                     <Typography variant='h6'>{userName}</Typography>
                 </Box>
+                {removed && (
+                    <Alert severity='warning' sx={{ marginBottom: 2 }}>
+                        You are no longer a member of this group
+                    </Alert>
+                )}
                 <StyledMessagesBox ref={messagesViewBoxRef}>
                     {chatMessages?.map(chat => {
                         const isOwnMessage = chat?.user?.id === user?.id;
@@ -31,6 +31,16 @@ const MessageGroupCard: React.FC<MessageGroupCardProps> = ({ group, loading }) =
             />
             <CardContent sx={{ flexGrow: 1, overflow: 'auto' }}>
                 <Typography variant='h6'>{group?.group_name}</Typography>
+                {group?.last_message_at && (
+                    <Typography variant='body2' color='text.secondary'>
+                        {`Last message ${new Date(group.last_message_at).toLocaleString()}`}
+                    </Typography>
+                )}
+                {(group?.unread_count ?? 0) > 0 && (
+                    <Typography variant='body2' color='primary'>
+                        {`${group.unread_count} unread`}
+                    </Typography>
+                )}
                 <List sx={{ marginTop: 1 }}>
                     {group?.users?.map(user => (
                         <ListItem
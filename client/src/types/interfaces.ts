@@ -30,6 +30,11 @@ export interface MessageGroup extends BaseModel {
     group_name: string;
     users: NestedUser[];
     created_by: User;
+    message_sequence: number;
+    last_message: string | null;
+    last_message_at: string | Date | null;
+    // null for groups the user is not a member of
+    unread_count: number | null;
 }
 
 interface NestedUser {
@@ -48,4 +53,5 @@ export interface Message extends BaseModel {
     group: string;
     initialisation_vector: string;
     key: string;
+    sequence: number;
 }